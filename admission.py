@@ -0,0 +1,109 @@
+import time
+
+# admission control in front of the providers: a token bucket per guild (its daily token_limit,
+# refilled continuously) and one per provider/model (from "rateLimits" in models.json).
+# a request reserves its estimate up front and is reconciled with real usage afterwards
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, scope, key):
+        super().__init__(f"{scope} {key} is over its limit")
+        self.scope = scope # "guild" or "model"
+        self.key = key
+
+
+class TokenBucket():
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def available(self):
+        self._refill()
+        return self.tokens
+
+    def can_take(self, amount):
+        return self.available() >= min(amount, self.capacity)
+
+    def take(self, amount):
+        # may go negative when reconciling a request that used more than it reserved
+        self._refill()
+        self.tokens -= amount
+
+    def give(self, amount):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class Reservation():
+    def __init__(self, buckets, amounts):
+        self.buckets = buckets
+        self.amounts = amounts
+        self.settled = False
+
+    def reconcile(self, actual):
+        # charge what the request really used instead of the estimate; actual=0 refunds it
+        if self.settled:
+            return
+        self.settled = True
+        for bucket, reserved in zip(self.buckets, self.amounts):
+            if actual > reserved:
+                bucket.take(actual - reserved)
+            else:
+                bucket.give(reserved - actual)
+
+
+class AdmissionController():
+    def __init__(self, rate_limits=None):
+        self.rate_limits = rate_limits or {}
+        self.guild_buckets = {}
+        self.model_buckets = {}
+        self.rejected = {"guild": 0, "model": 0}
+
+    def guild_bucket(self, guild_id, token_limit):
+        bucket = self.guild_buckets.get(guild_id)
+        if bucket is None:
+            bucket = self.guild_buckets[guild_id] = TokenBucket(token_limit, token_limit / 86400)
+        elif bucket.capacity != token_limit:
+            # /admin setlimit changed it
+            bucket.capacity = token_limit
+            bucket.refill_per_second = token_limit / 86400
+        return bucket
+
+    def model_bucket(self, provider, model):
+        key = f"{provider}|{model}"
+        bucket = self.model_buckets.get(key)
+        if bucket is None:
+            limits = self.rate_limits.get(key, self.rate_limits.get("default"))
+            if not limits:
+                return None
+            per_minute = limits.get("tokensPerMinute", 0)
+            bucket = self.model_buckets[key] = TokenBucket(per_minute, per_minute / 60)
+        return bucket
+
+    def admit(self, guild_id, provider, model, estimate, token_limit, bypass_limits=False):
+        # all checks happen before anything is taken, so a rejection leaves the buckets untouched
+        buckets = []
+        model_bucket = self.model_bucket(provider, model)
+        if model_bucket is not None:
+            if not model_bucket.can_take(estimate):
+                self.rejected["model"] += 1
+                raise AdmissionRejected("model", f"{provider}|{model}")
+            buckets.append(model_bucket)
+        if not bypass_limits:
+            guild_bucket = self.guild_bucket(guild_id, token_limit)
+            if not guild_bucket.can_take(estimate):
+                self.rejected["guild"] += 1
+                raise AdmissionRejected("guild", guild_id)
+            buckets.append(guild_bucket)
+        # never reserve more than a bucket can hold, or small limits would never admit anything
+        amounts = [min(estimate, bucket.capacity) for bucket in buckets]
+        for bucket, amount in zip(buckets, amounts):
+            bucket.take(amount)
+        return Reservation(buckets, amounts)
@@ -6,17 +6,29 @@ import itertools
 import json
 import logging
 import os
-import ollama
-from google.generativeai import configure as configure_google
-from google.generativeai.types import HarmBlockThreshold
-import google.generativeai as genai
-from anthropic import AsyncAnthropic
-from openai import AsyncOpenAI
+import time
+import asyncio
 from asyncio import to_thread
-import itertools
+from hedging import HedgeBudget, LatencyTracker
+from metrics import PROVIDER_FAILURES, PROVIDER_FIRST_CHUNK, PROVIDER_LATENCY, PROVIDER_TOKENS
+from ollama_pool import OllamaWarmPool
+from prompt_cache import GoogleContextCache, split_prefix
+from resilience import DEFAULT_RESILIENCE, CircuitBreaker, ProviderError, is_client_error, is_provider_fault, is_retryable, retry_delay
+from response_cache import ResponseCache
+from transport import http_client, http_timeout, pooled_transport, transport_config, with_deadline
 
 with open("models.json") as f:
-    MODELS = json.load(f).get("providers")
+    MODELS_CONFIG = json.load(f)
+MODELS = MODELS_CONFIG.get("providers")
+RESPONSE_CACHE = MODELS_CONFIG.get("responseCache", {})
+RESILIENCE = {**DEFAULT_RESILIENCE, **MODELS_CONFIG.get("resilience", {})}
+# "provider|model" -> ordered list of "provider|model" to fall back to
+FALLBACKS = MODELS_CONFIG.get("fallbacks", {})
+HEDGING = MODELS_CONFIG.get("hedging", {})
+SUMMARIES = MODELS_CONFIG.get("summaries", {})
+PROMPT_CACHING = MODELS_CONFIG.get("promptCaching", {})
+OLLAMA_WARM_POOL = MODELS_CONFIG.get("ollamaWarmPool", {})
+TRANSPORT = {provider: transport_config(MODELS_CONFIG.get("transport", {}), provider) for provider in ["ollama", "google", "anthropic", "openai", "replay"]}
 
 # models structur:
 """
@@ -29,17 +41,99 @@ with open("models.json") as f:
 
 """
 
-ollama_client = ollama.AsyncClient()
-configure_google(api_key=os.getenv("GEMINI_API_KEY"))
-google_client = genai.GenerativeModel("gemini-1.5-flash") # hardcoded model unfortunately for now
-anthropic_client = AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# provider sdks are slow to import (google-generativeai especially), so each one is
+# imported and its client built the first time a model from that provider is used
+
+def _load_ollama():
+    import ollama
+    return ollama.AsyncClient(timeout=http_timeout(TRANSPORT["ollama"]), transport=pooled_transport("ollama", TRANSPORT["ollama"]))
+
+def _load_google():
+    import google.generativeai as genai
+    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+    return genai.GenerativeModel("gemini-1.5-flash") # hardcoded model unfortunately for now
+
+def _load_anthropic():
+    from anthropic import AsyncAnthropic
+    # the sdks pass their own timeout on every request, so it has to be set on the sdk client as well
+    # retries are handled by ChatProvider, not the sdk
+    return AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), http_client=http_client("anthropic", TRANSPORT["anthropic"]), timeout=http_timeout(TRANSPORT["anthropic"]), max_retries=0)
+
+def _load_openai():
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client("openai", TRANSPORT["openai"]), timeout=http_timeout(TRANSPORT["openai"]), max_retries=0)
+
+def _load_replay():
+    from replay import ReplayBackend
+    return ReplayBackend(MODELS_CONFIG.get("replay", {}))
+
+PROVIDER_LOADERS = {
+    "ollama": _load_ollama,
+    "google": _load_google,
+    "anthropic": _load_anthropic,
+    "openai": _load_openai,
+    "replay": _load_replay,
+}
+
+CLIENTS = {} # provider -> loaded client
+LOAD_TIMES = {} # provider -> seconds spent importing and building the client
+
+
+def register_provider(name, loader):
+    PROVIDER_LOADERS[name] = loader
+
+
+def get_client(provider):
+    client = CLIENTS.get(provider)
+    if client is None:
+        if provider not in MODELS:
+            raise ValueError(f"Provider {provider} is not enabled in models.json")
+        started = time.perf_counter()
+        client = CLIENTS[provider] = PROVIDER_LOADERS[provider]()
+        LOAD_TIMES[provider] = time.perf_counter() - started
+        logging.info(f"Loaded {provider} provider in {LOAD_TIMES[provider]:.2f}s")
+    return client
+
+
+ERROR_TEXT = "There was an error."
+
+
+async def _cancel_losers(tasks):
+    # cancels what lost a hedge and waits for it, so its breaker sees the cancellation. a cancellation
+    # of the caller that lands meanwhile is passed on, never swallowed with the losers' own
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    current = asyncio.current_task()
+    if current is not None and getattr(current, "cancelling", lambda: 0)():
+        raise asyncio.CancelledError()
+
+
+def summary_history(previous, lines, max_words):
+    prompt = (
+        f"Update the running summary of a Discord conversation in at most {max_words} words. "
+        "Keep who said what, open questions and anything the assistant promised; drop small talk. "
+        "Answer with the summary only."
+    )
+    content = f"Summary so far: {previous or '(none)'}\n\nNew messages:\n" + "\n".join(lines)
+    return [{"role": "system", "content": prompt}, {"role": "user", "content": content}]
 
 
 class ChatProvider():
     def __init__(self, provider, model=None):
         self.provider = provider
         self.model = model
+        # opt-in, see "responseCache" in models.json
+        self.cache = None
+        if RESPONSE_CACHE.get("enabled"):
+            self.cache = ResponseCache(RESPONSE_CACHE.get("maxEntries", 1000), RESPONSE_CACHE.get("maxBytes", 5_000_000), RESPONSE_CACHE.get("ttl", 600))
+        self.breakers = {} # "provider|model" -> CircuitBreaker
+        # "provider|model" -> LatencyTracker, for whole responses and for the first streamed chunk
+        self.latencies = {}
+        self.first_chunk_latencies = {}
+        self.hedge_budget = HedgeBudget(HEDGING.get("maxRate", 0.05))
+        self.google_cache = GoogleContextCache(PROMPT_CACHING.get("google", {}))
+        self.ollama_pool = OllamaWarmPool(OLLAMA_WARM_POOL, lambda: get_client("ollama"))
     def set_model(self, model):
         if model not in self.available_models(self.provider):
             # swap provider
@@ -50,81 +144,453 @@ class ChatProvider():
         self.provider = provider
     def available_models(self, filter_provider=None):
         return list(itertools.chain.from_iterable([f"{provider}|{submodel}" for submodel in submodels] for provider, submodels in MODELS.items())) if not filter_provider else MODELS.get(filter_provider)
+    def context_budget(self, provider, model):
+        # max prompt tokens for a model, from "contextBudgets" in models.json
+        budgets = MODELS_CONFIG.get("contextBudgets", {})
+        return budgets.get(f"{provider}|{model}", budgets.get("default", 4000))
+    def rate_limits(self):
+        # tokens per minute per provider|model, from "rateLimits" in models.json
+        return MODELS_CONFIG.get("rateLimits", {})
     def get_config(self):
         return {
             "provider": self.provider,
             "model": self.model
         }
 
-    async def generate_text(self, history, override_provider=None, override_model=None, usage=False):
+    def _resolve(self, override_provider=None, override_model=None):
         provider = override_provider if override_provider else self.provider
         model = override_model if override_model else self.model
         if not model and not self.provider == "google":
             raise ValueError("Model not set for provider")
-        usage_dict = {"input": 0, "output": 0}
-        response_text = "There was an error."
-        if provider == "ollama":
-            try:
-                res = await ollama_client.chat(model=model, messages=history)
-            except Exception as e:
-                logging.error(e)
-                if usage:
-                    return usage_dict, response_text
-                return response_text
-            response_text = res.get("message", {}).get("content", "There was an error.")
-            usage_dict["input"] = res.get("prompt_eval_count", 0)
-            usage_dict["output"] = res.get("eval_count", 0)
-            if usage["input"] == 0 or usage["output"] == 0:
-                logging.warning("No usage data returned")
-        if provider == "google":
-            if len(history) == 1 and history[0].get("role") == "system":
-                if usage:
-                    return usage_dict, response_text
+        return provider, model
+
+    def breaker(self, provider, model):
+        key = f"{provider}|{model}"
+        if key not in self.breakers:
+            self.breakers[key] = CircuitBreaker(RESILIENCE["failureThreshold"], RESILIENCE["resetTimeout"])
+        return self.breakers[key]
+
+    def _candidates(self, provider, model):
+        # the requested model first, then its fallback chain from models.json
+        candidates = [(provider, model)]
+        for fallback in FALLBACKS.get(f"{provider}|{model}", FALLBACKS.get("default", [])):
+            fallback_provider, fallback_model = fallback.split("|", 1)
+            if (fallback_provider, fallback_model) not in candidates:
+                candidates.append((fallback_provider, fallback_model))
+        return candidates
+
+    def _latency(self, trackers, provider, model):
+        key = f"{provider}|{model}"
+        if key not in trackers:
+            trackers[key] = LatencyTracker()
+        return trackers[key]
+
+    def _hedge_plan(self, trackers, provider, model):
+        # (delay, alternate) if this call may be hedged, else None
+        if not HEDGING.get("enabled"):
+            return None
+        key = f"{provider}|{model}"
+        alternate = HEDGING.get("alternates", {}).get(key) or next(iter(FALLBACKS.get(key, [])), None)
+        tracker = trackers.get(key)
+        if not alternate or tracker is None or len(tracker) < HEDGING.get("minSamples", 20):
+            return None
+        return tracker.percentile(HEDGING.get("percentile", 95)), tuple(alternate.split("|", 1))
+
+    def _record_call(self, provider, model, seconds, usage_dict):
+        PROVIDER_LATENCY.labels(provider, model).observe(seconds)
+        PROVIDER_TOKENS.labels(provider, model, "input").inc(usage_dict.get("input", 0))
+        PROVIDER_TOKENS.labels(provider, model, "output").inc(usage_dict.get("output", 0))
+        PROVIDER_TOKENS.labels(provider, model, "cached").inc(usage_dict.get("cached", 0))
+
+    async def _backoff(self, breaker, attempt):
+        # False when the breaker will not let another call through. the half-open trial is only
+        # taken after the delay, so a call cancelled while waiting never holds it
+        if breaker.state == "open":
+            return False
+        if attempt:
+            await asyncio.sleep(retry_delay(attempt - 1, RESILIENCE["baseDelay"], RESILIENCE["maxDelay"]))
+        return breaker.allow()
+
+    async def _generate_with_failover(self, history, provider, model, usage_dict):
+        for candidate_provider, candidate_model in self._candidates(provider, model):
+            breaker = self.breaker(candidate_provider, candidate_model)
+            for attempt in range(RESILIENCE["retries"] + 1):
+                if not await self._backoff(breaker, attempt):
+                    logging.warning(f"Circuit open for {candidate_provider}|{candidate_model}, skipping")
+                    break
+                usage_dict.update({"input": 0, "output": 0, "cached": 0})
+                started = time.monotonic()
+                try:
+                    response_text = await asyncio.wait_for(getattr(self, f"_generate_{candidate_provider}")(history, candidate_model, usage_dict), TRANSPORT[candidate_provider]["totalTimeout"])
+                except asyncio.CancelledError:
+                    # a lost hedge or shutdown says nothing about the model, but must not keep the half-open trial
+                    breaker.abandon()
+                    raise
+                except Exception as e:
+                    PROVIDER_FAILURES.labels(candidate_provider, candidate_model).inc()
+                    logging.error(f"{candidate_provider}|{candidate_model} failed (attempt {attempt + 1}): {e!r}")
+                    if is_client_error(e):
+                        # this request's fault (too long, filtered...), not the model's: the breaker stays out of it
+                        breaker.abandon()
+                        raise
+                    if is_provider_fault(e):
+                        breaker.record_failure()
+                    else:
+                        breaker.abandon()
+                    if is_retryable(e):
+                        continue
+                    break # straight to the next fallback
+                breaker.record_success()
+                elapsed = time.monotonic() - started
+                self._latency(self.latencies, candidate_provider, candidate_model).record(elapsed)
+                self._record_call(candidate_provider, candidate_model, elapsed, usage_dict)
                 return response_text
-            google_history = [
-                {
-                    "parts": [{"text": message.get("content")}], 
-                    "role": "user" if message.get("role") == "user" else "model"
-                    } 
-                    for message in history]
-            logging.debug(google_history)
+        return ERROR_TEXT
+
+    async def _generate_hedged(self, history, provider, model, usage_dict):
+        # if the primary is slower than its usual p-th percentile, race an alternate model
+        plan = self._hedge_plan(self.latencies, provider, model)
+        if plan is None:
+            return await self._generate_with_failover(history, provider, model, usage_dict)
+        delay, (alternate_provider, alternate_model) = plan
+        primary_usage = {"input": 0, "output": 0}
+        primary = asyncio.create_task(self._generate_with_failover(history, provider, model, primary_usage))
+        tasks = {primary: primary_usage}
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done or not self.hedge_budget.allow():
+                if done:
+                    self.hedge_budget.record(False)
+                result = await primary
+                usage_dict.update(primary_usage)
+                return result
+            logging.info(f"Hedging {provider}|{model} with {alternate_provider}|{alternate_model} after {delay:.2f}s")
+            hedge_usage = {"input": 0, "output": 0}
+            hedge = asyncio.create_task(self._generate_with_failover(history, alternate_provider, alternate_model, hedge_usage))
+            tasks[hedge] = hedge_usage
+            result = ERROR_TEXT
+            usage_dict.update({"input": 0, "output": 0})
+            while tasks and result == ERROR_TEXT:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    # anything that ran to completion was consumed, so it is charged
+                    task_usage = tasks.pop(task)
+                    usage_dict["input"] += task_usage["input"]
+                    usage_dict["output"] += task_usage["output"]
+                    usage_dict["cached"] = usage_dict.get("cached", 0) + task_usage.get("cached", 0)
+                    if result == ERROR_TEXT and task.result() != ERROR_TEXT:
+                        result = task.result()
+                        if task is hedge:
+                            self.hedge_budget.record_win()
+            return result
+        finally:
+            # the loser is cancelled, and never charged
+            await _cancel_losers(tasks)
+
+    async def _stream_with_failover(self, history, provider, model, usage_dict):
+        error = None
+        for candidate_provider, candidate_model in self._candidates(provider, model):
+            breaker = self.breaker(candidate_provider, candidate_model)
+            for attempt in range(RESILIENCE["retries"] + 1):
+                if not await self._backoff(breaker, attempt):
+                    logging.warning(f"Circuit open for {candidate_provider}|{candidate_model}, skipping")
+                    break
+                usage_dict.update({"input": 0, "output": 0, "cached": 0})
+                started = False
+                started_at = time.monotonic()
+                try:
+                    async for chunk in with_deadline(getattr(self, f"_stream_{candidate_provider}")(history, candidate_model, usage_dict), TRANSPORT[candidate_provider]["totalTimeout"]):
+                        if chunk:
+                            if not started:
+                                elapsed = time.monotonic() - started_at
+                                self._latency(self.first_chunk_latencies, candidate_provider, candidate_model).record(elapsed)
+                                PROVIDER_FIRST_CHUNK.labels(candidate_provider, candidate_model).observe(elapsed)
+                            started = True
+                            yield chunk
+                except (asyncio.CancelledError, GeneratorExit):
+                    # cancelled, or the caller closed the stream (a lost hedge): give the half-open trial back
+                    breaker.abandon()
+                    raise
+                except Exception as e:
+                    PROVIDER_FAILURES.labels(candidate_provider, candidate_model).inc()
+                    logging.error(f"{candidate_provider}|{candidate_model} stream failed (attempt {attempt + 1}): {e!r}")
+                    if is_provider_fault(e):
+                        breaker.record_failure()
+                    else:
+                        breaker.abandon()
+                    if started or is_client_error(e):
+                        raise # part of the reply is already out, or no other model would take the request
+                    error = e
+                    if is_retryable(e):
+                        continue
+                    break
+                breaker.record_success()
+                self._record_call(candidate_provider, candidate_model, time.monotonic() - started_at, usage_dict)
+                return
+        raise error or ProviderError("No provider available")
+
+    async def _stream_hedged(self, history, provider, model, usage_dict):
+        # streams race on time to first chunk; the first one to produce output wins
+        plan = self._hedge_plan(self.first_chunk_latencies, provider, model)
+        if plan is None:
+            async for chunk in self._stream_with_failover(history, provider, model, usage_dict):
+                yield chunk
+            return
+        delay, (alternate_provider, alternate_model) = plan
+        primary_usage = {}
+        primary = self._stream_with_failover(history, provider, model, primary_usage)
+        first_chunks = {asyncio.ensure_future(primary.__anext__()): (primary, primary_usage)}
+        winner = None
+        error = None
+        try:
+            done, _ = await asyncio.wait(first_chunks, timeout=delay)
+            if done:
+                self.hedge_budget.record(False)
+            elif self.hedge_budget.allow():
+                logging.info(f"Hedging {provider}|{model} stream with {alternate_provider}|{alternate_model} after {delay:.2f}s")
+                hedge_usage = {}
+                hedge = self._stream_with_failover(history, alternate_provider, alternate_model, hedge_usage)
+                first_chunks[asyncio.ensure_future(hedge.__anext__())] = (hedge, hedge_usage)
+            while first_chunks and winner is None:
+                done, _ = await asyncio.wait(first_chunks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    stream, stream_usage = first_chunks.pop(task)
+                    try:
+                        chunk = task.result()
+                    except StopAsyncIteration:
+                        continue
+                    except Exception as e:
+                        error = e
+                        continue
+                    if winner is None:
+                        winner = (stream, stream_usage, chunk)
+                        if stream is not primary:
+                            self.hedge_budget.record_win()
+                    else:
+                        await stream.aclose()
+        finally:
+            await _cancel_losers(first_chunks)
+            for stream, _ in first_chunks.values():
+                await stream.aclose()
+        if winner is None:
+            if error:
+                raise error
+            return
+        stream, stream_usage, chunk = winner
+        yield chunk
+        async for chunk in stream:
+            yield chunk
+        usage_dict.update(stream_usage)
+
+    async def generate_text(self, history, override_provider=None, override_model=None, usage=False, use_cache=True):
+        provider, model = self._resolve(override_provider, override_model)
+        # cache hits cost nothing, so usage stays at zero
+        usage_dict = {"input": 0, "output": 0}
+        cache_key = self.cache.key(provider, model, history) if self.cache and use_cache else None
+        response_text = self.cache.get(cache_key) if cache_key else None
+        if response_text is None:
             try:
-                res = await google_client.generate_content_async(google_history, safety_settings=HarmBlockThreshold.BLOCK_NONE, generation_config={"max_output_tokens": 1000, "stop_sequences": ["<END>"]})
+                response_text = await self._generate_hedged(history, provider, model, usage_dict)
             except Exception as e:
-                logging.error(e)
-                if usage:
-                    return usage_dict, response_text
-                return response_text
-            if res.prompt_feedback:
-                logging.warning(res.prompt_feedback)
-            if not res.candidates or not res.candidates[0] or not res.candidates[0].content.parts:
-                logging.error("No parts returned")
-                logging.error(res)
-                
-                response_text = "There was an error."
-            else:
-                usage_dict["input"] = res.usage_metadata.prompt_token_count
-                usage_dict["output"] = res.usage_metadata.candidates_token_count
-                response_text = " ".join([part.text for part in res.candidates[0].content.parts])
-        if provider == "anthropic":
-            res = await anthropic_client.messages.create(
-                messages=history,
-                model=model,
-                max_tokens=1000
-            )
-            logging.debug(res)
-            response_text = res.content
-        if provider == "openai":
-            res = await openai_client.chat.completions.create(
-                model=model,
-                messages=history
-            )
-            logging.debug(res)
-            response_text = res.choices[0].message.content
+                # only a request the provider refused gets here, every other failure has been retried or failed over
+                logging.error(f"{provider}|{model} refused the request: {e!r}")
+                response_text = ERROR_TEXT
+            if cache_key and response_text and response_text != ERROR_TEXT:
+                self.cache.put(cache_key, response_text)
         if usage:
             return usage_dict, response_text
         return response_text
-    async def emoji_summary(history):
-        pass # TODO: summarize convo with singular emojis
-        
-        
\ No newline at end of file
+
+    async def generate_stream(self, history, override_provider=None, override_model=None, usage_dict=None, use_cache=True):
+        # async generator of text chunks; usage_dict (if given) is filled in once the stream ends
+        provider, model = self._resolve(override_provider, override_model)
+        if usage_dict is None:
+            usage_dict = {}
+        usage_dict.update({"input": 0, "output": 0})
+        cache_key = self.cache.key(provider, model, history) if self.cache and use_cache else None
+        if cache_key and (cached := self.cache.get(cache_key)) is not None:
+            yield cached
+            return
+        chunks = []
+        async for chunk in self._stream_hedged(history, provider, model, usage_dict):
+            chunks.append(chunk)
+            yield chunk
+        if cache_key and chunks:
+            self.cache.put(cache_key, "".join(chunks))
+
+    @staticmethod
+    def _ollama_options():
+        # keep_alive keeps the model (and the kv cache of the prompt prefix it last saw) loaded between calls
+        keep_alive = PROMPT_CACHING.get("ollama", {}).get("keepAlive")
+        return {"keep_alive": keep_alive} if keep_alive is not None else {}
+
+    async def _generate_ollama(self, history, model, usage_dict):
+        res = await get_client("ollama").chat(model=model, messages=history, **self._ollama_options())
+        usage_dict["input"] = res.get("prompt_eval_count", 0)
+        usage_dict["output"] = res.get("eval_count", 0)
+        if usage_dict["input"] == 0 or usage_dict["output"] == 0:
+            logging.warning("No usage data returned")
+        return res.get("message", {}).get("content", ERROR_TEXT)
+
+    async def _stream_ollama(self, history, model, usage_dict):
+        async for part in await get_client("ollama").chat(model=model, messages=history, stream=True, **self._ollama_options()):
+            yield part.get("message", {}).get("content", "")
+            if part.get("done"):
+                usage_dict["input"] = part.get("prompt_eval_count", 0)
+                usage_dict["output"] = part.get("eval_count", 0)
+
+    @staticmethod
+    def _google_history(history):
+        return [
+            {
+                "parts": [{"text": message.get("content")}],
+                "role": "user" if message.get("role") == "user" else "model"
+                }
+                for message in history]
+
+    async def _google_request(self, history):
+        # -> (model, contents): with context caching the stable prefix is already on the server
+        prefix, rest = split_prefix(history)
+        if self.google_cache.eligible(prefix):
+            cached_model = await self.google_cache.model_for(prefix)
+            if cached_model is not None:
+                return cached_model, self._google_history(rest)
+        return get_client("google"), self._google_history(history)
+
+    @staticmethod
+    def _google_usage(usage_metadata, usage_dict):
+        usage_dict["input"] = usage_metadata.prompt_token_count
+        usage_dict["output"] = usage_metadata.candidates_token_count
+        usage_dict["cached"] = getattr(usage_metadata, "cached_content_token_count", 0) or 0
+
+    async def _generate_google(self, history, model, usage_dict):
+        if len(history) == 1 and history[0].get("role") == "system":
+            return ERROR_TEXT
+        from google.generativeai.types import HarmBlockThreshold
+        google_model, google_history = await self._google_request(history)
+        logging.debug(google_history)
+        res = await google_model.generate_content_async(google_history, safety_settings=HarmBlockThreshold.BLOCK_NONE, generation_config={"max_output_tokens": 1000, "stop_sequences": ["<END>"]}, request_options={"timeout": TRANSPORT["google"]["readTimeout"]})
+        if res.prompt_feedback:
+            logging.warning(res.prompt_feedback)
+        if not res.candidates or not res.candidates[0] or not res.candidates[0].content.parts:
+            logging.error(res)
+            raise ProviderError("No parts returned")
+        self._google_usage(res.usage_metadata, usage_dict)
+        return " ".join([part.text for part in res.candidates[0].content.parts])
+
+    async def _stream_google(self, history, model, usage_dict):
+        if len(history) == 1 and history[0].get("role") == "system":
+            return
+        from google.generativeai.types import HarmBlockThreshold
+        google_model, google_history = await self._google_request(history)
+        res = await google_model.generate_content_async(google_history, safety_settings=HarmBlockThreshold.BLOCK_NONE, generation_config={"max_output_tokens": 1000, "stop_sequences": ["<END>"]}, request_options={"timeout": TRANSPORT["google"]["readTimeout"]}, stream=True)
+        async for chunk in res:
+            if chunk.usage_metadata:
+                self._google_usage(chunk.usage_metadata, usage_dict)
+            if chunk.candidates and chunk.candidates[0].content.parts:
+                yield "".join(part.text for part in chunk.candidates[0].content.parts)
+
+    @staticmethod
+    def _anthropic_messages(history):
+        # anthropic takes the system prompt as a separate parameter
+        messages = [message for message in history if message.get("role") != "system"]
+        if PROMPT_CACHING.get("anthropic", {}).get("enabled"):
+            # the stable prefix gets the cache breakpoint, later system messages follow it uncached
+            prefix, rest = split_prefix(history)
+            blocks = [{"type": "text", "text": message["content"]} for message in prefix + rest if message.get("role") == "system"]
+            if prefix:
+                blocks[0]["cache_control"] = {"type": "ephemeral"}
+            return ({"system": blocks} if blocks else {}), messages
+        system = "\n".join(message["content"] for message in history if message.get("role") == "system")
+        return ({"system": system} if system else {}), messages
+
+    @staticmethod
+    def _anthropic_usage(usage, usage_dict):
+        # input_tokens only counts what came after the last cache breakpoint
+        cache_read = getattr(usage, "cache_read_input_tokens", 0) or 0
+        cache_write = getattr(usage, "cache_creation_input_tokens", 0) or 0
+        usage_dict["input"] = usage.input_tokens + cache_read + cache_write
+        usage_dict["output"] = usage.output_tokens
+        usage_dict["cached"] = cache_read
+
+    async def _generate_anthropic(self, history, model, usage_dict):
+        system, messages = self._anthropic_messages(history)
+        res = await get_client("anthropic").messages.create(
+            messages=messages,
+            model=model,
+            max_tokens=1000,
+            **system
+        )
+        logging.debug(res)
+        self._anthropic_usage(res.usage, usage_dict)
+        return "".join(block.text for block in res.content if block.type == "text")
+
+    async def _stream_anthropic(self, history, model, usage_dict):
+        system, messages = self._anthropic_messages(history)
+        async with get_client("anthropic").messages.stream(messages=messages, model=model, max_tokens=1000, **system) as stream:
+            async for text in stream.text_stream:
+                yield text
+            res = await stream.get_final_message()
+        self._anthropic_usage(res.usage, usage_dict)
+
+    @staticmethod
+    def _openai_usage(usage, usage_dict):
+        # openai caches long prompt prefixes on its own, it only reports how much was reused
+        usage_dict["input"] = usage.prompt_tokens
+        usage_dict["output"] = usage.completion_tokens
+        usage_dict["cached"] = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", 0) or 0
+
+    async def _generate_openai(self, history, model, usage_dict):
+        res = await get_client("openai").chat.completions.create(
+            model=model,
+            messages=history
+        )
+        logging.debug(res)
+        if res.usage:
+            self._openai_usage(res.usage, usage_dict)
+        return res.choices[0].message.content
+
+    async def _stream_openai(self, history, model, usage_dict):
+        stream = await get_client("openai").chat.completions.create(
+            model=model,
+            messages=history,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        async for chunk in stream:
+            if chunk.usage:
+                self._openai_usage(chunk.usage, usage_dict)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def _generate_replay(self, history, model, usage_dict):
+        # the model is the capture name; recording captures pass through to their target
+        capture = get_client("replay").capture(model)
+        if not capture.recording:
+            return await capture.replay(history, usage_dict)
+        target_provider, target_model = capture.target
+        started = time.monotonic()
+        text = await getattr(self, f"_generate_{target_provider}")(history, target_model, usage_dict)
+        await capture.record(history, text, usage_dict, time.monotonic() - started)
+        return text
+
+    async def _stream_replay(self, history, model, usage_dict):
+        capture = get_client("replay").capture(model)
+        if not capture.recording:
+            async for chunk in capture.replay_stream(history, usage_dict):
+                yield chunk
+            return
+        target_provider, target_model = capture.target
+        started = last = time.monotonic()
+        chunks = []
+        async for chunk in getattr(self, f"_stream_{target_provider}")(history, target_model, usage_dict):
+            now = time.monotonic()
+            chunks.append([int((now - last) * 1000), chunk])
+            last = now
+            yield chunk
+        await capture.record(history, "".join(chunk for _, chunk in chunks), usage_dict, time.monotonic() - started, chunks)
+
+    async def summarize(self, previous, lines, provider, model, max_words=150):
+        # -> (usage, summary): folds lines ("name: message", oldest first) into the previous summary
+        history = summary_history(previous, lines, max_words)
+        return await self.generate_text(history, provider, model, usage=True, use_cache=False)
@@ -0,0 +1,79 @@
+# chunker benchmark on random markdown, up to multi-megabyte replies (the properties are tested in tests/test_chunker.py)
+# run from the repository root: python benchmarks/chunker.py [--sizes 10000,1000000,5000000] [--cases 300]
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from chunker import FENCE, MESSAGE_LIMIT, chunk_message, split_message
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "x" * 300, "y" * 2500]
+
+
+def random_markdown(rng, size):
+    out = []
+    length = 0
+    in_fence = False
+    while length < size:
+        roll = rng.random()
+        if roll < 0.05:
+            line = FENCE if in_fence else FENCE + rng.choice(["", "python", "js"])
+            in_fence = not in_fence
+        elif roll < 0.1:
+            line = ""
+        else:
+            line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 60)))
+        out.append(line)
+        length += len(line) + 1
+    return "\n".join(out)
+
+
+def one_line(rng, size):
+    # no newlines at all, so every cut falls inside a single line
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+
+def check(text, chunks, limit):
+    assert all(chunk.strip() for chunk in chunks), "empty chunk"
+    assert all(len(chunk) <= limit for chunk in chunks), "chunk over the limit"
+    for chunk in chunks:
+        fences = [line for line in chunk.splitlines() if line.strip().startswith(FENCE) and line.strip().count(FENCE) % 2 == 1 and len(line.strip()) <= 100]
+        assert len(fences) % 2 == 0, "unbalanced fence in chunk"
+    # with the fences the split added taken off, the pieces give back the text
+    pieces = split_message(text, limit)
+    assert "".join(body for _, body, _ in pieces) == text, "text not given back"
+    assert chunks == [head + body + tail for head, body, tail in pieces if (head + body + tail).strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,1000000,5000000")
+    parser.add_argument("--cases", type=int, default=300)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    for _ in range(args.cases):
+        limit = rng.choice([50, 200, MESSAGE_LIMIT])
+        text = random_markdown(rng, rng.randint(0, 20000))
+        check(text, chunk_message(text, limit), limit)
+    print(f"invariants held for {args.cases} random cases")
+
+    for size in (int(size) for size in args.sizes.split(",")):
+        for kind, text in (("markdown", random_markdown(rng, size)), ("one line", one_line(rng, size))):
+            started = time.perf_counter()
+            chunks = chunk_message(text)
+            elapsed = time.perf_counter() - started
+            check(text, chunks, MESSAGE_LIMIT)
+            print(f"{len(text) / 1e6:.2f}MB {kind} -> {len(chunks)} chunks in {elapsed * 1000:.1f}ms ({len(text) / elapsed / 1e6:.1f}MB/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# microbenchmark: MentionTranslator against the str.replace loops on_message used before
+# run from the repository root: python benchmarks/mentions.py [--names 25] [--messages 12]
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mentions import MentionTranslator
+
+BOT_NAME = "bot"
+BOT_MENTION = "<@1>"
+
+
+def legacy_to_names(contents, user_names):
+    out = []
+    for content in contents:
+        for name, id in user_names.items():
+            content = content.replace(f"<@{id}>", f"<@{name}>")
+        out.append(content)
+    return out
+
+
+def legacy_to_mentions(response, user_names, no_ping_users):
+    response = response.replace(f"<@{BOT_NAME}>", BOT_MENTION)
+    for name, id in user_names.items():
+        response = response.replace(f"<@{name}>", f"<@{id}>")
+    response = response.replace("@everyone", "@ everyone")
+    response = response.replace("@here", "@ here")
+    for user in no_ping_users:
+        response = response.replace(f"<@{user['id']}>", user['name'])
+    return response
+
+
+def translator_round_trip(contents, response, user_names, no_ping_users):
+    # the bot hands over GuildConfig.no_ping_users, which is already a map
+    no_ping = {str(user["id"]): user["name"] for user in no_ping_users}
+    translator = MentionTranslator(user_names, BOT_NAME, BOT_MENTION, no_ping)
+    return [translator.to_names(content) for content in contents], translator.to_mentions(response)
+
+
+def make_case(names, messages, length):
+    rng = random.Random(0)
+    user_names = {f"user{i}": 1000 + i for i in range(names)}
+    ids = list(user_names.values())
+    words = ["lorem", "ipsum", "dolor", "sit", "amet"]
+    contents = []
+    for _ in range(messages):
+        parts = [rng.choice(words) if rng.random() > 0.1 else f"<@{rng.choice(ids)}>" for _ in range(length)]
+        contents.append(" ".join(parts))
+    response = " ".join(rng.choice(words) if rng.random() > 0.1 else f"<@{rng.choice(list(user_names))}>" for _ in range(length * 4)) + " @everyone"
+    no_ping_users = [{"id": id, "name": name} for name, id in list(user_names.items())[::5]]
+    return contents, response, user_names, no_ping_users
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--names", type=int, default=25)
+    parser.add_argument("--messages", type=int, default=12)
+    parser.add_argument("--words", type=int, default=200)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    contents, response, user_names, no_ping_users = make_case(args.names, args.messages, args.words)
+    legacy = (legacy_to_names(contents, user_names), legacy_to_mentions(response, user_names, no_ping_users))
+    assert translator_round_trip(contents, response, user_names, no_ping_users) == legacy, "translator output differs from the legacy loops"
+
+    legacy_time = timeit.timeit(lambda: (legacy_to_names(contents, user_names), legacy_to_mentions(response, user_names, no_ping_users)), number=args.number)
+    translator_time = timeit.timeit(lambda: translator_round_trip(contents, response, user_names, no_ping_users), number=args.number)
+    print(f"{args.names} names, {args.messages} messages of {args.words} words")
+    print(f"  legacy loops: {legacy_time / args.number * 1e6:.1f}us per request")
+    print(f"  translator:   {translator_time / args.number * 1e6:.1f}us per request ({legacy_time / translator_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
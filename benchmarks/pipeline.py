@@ -0,0 +1,349 @@
+# offline load test for the message pipeline: drives the real on_message, on_message_edit and
+# on_message_delete handlers with fake nextcord objects, a stub provider and a throwaway database
+# run from the repository root: python benchmarks/pipeline.py [--guilds 10,100,1000,10000] [--output pipeline.json] [--baseline old.json]
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT) # bot.py reads botconfig.json and models.json from the working directory
+
+import ai
+import bot as bot_module
+import metrics
+from admission import AdmissionController
+from channel_queue import ChannelQueue
+from database import open_database
+from history import ChannelHistory
+from transport import transport_config
+from usage_ledger import UsageLedger
+
+IDS = itertools.count(10 ** 17)
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+
+
+class FakeUser():
+    def __init__(self, name, bot=False):
+        self.id = next(IDS)
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.mention = f"<@{self.id}>"
+
+    def mentioned_in(self, message):
+        return self in message.mentions
+
+
+class FakeGuild():
+    def __init__(self):
+        self.id = next(IDS)
+        self.name = f"guild-{self.id}"
+
+
+class FakeHistory():
+    def __init__(self, messages):
+        self.messages = messages
+
+    async def flatten(self):
+        return self.messages
+
+
+class FakeChannel():
+    def __init__(self, guild, harness):
+        self.id = next(IDS)
+        self.guild = guild
+        self.harness = harness
+        self.messages = [] # oldest first
+
+    def history(self, limit=100):
+        return FakeHistory(self.messages[::-1][:limit])
+
+    async def trigger_typing(self):
+        await self.harness.rest()
+
+    async def send(self, content=None, tts=False, mention_author=True):
+        await self.harness.rest()
+        message = FakeMessage(self, self.harness.bot_user, content)
+        self.messages.append(message)
+        self.harness.replied(self)
+        # the gateway echoes the bot's own messages back
+        await bot_module.on_message(message)
+        return message
+
+
+class FakeMessage():
+    def __init__(self, channel, author, content, mentions=()):
+        self.id = next(IDS)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.mentions = list(mentions)
+
+    async def reply(self, content=None, tts=False, mention_author=True):
+        return await self.channel.send(content, tts=tts)
+
+    async def edit(self, content=None):
+        await self.channel.harness.rest()
+        before = FakeMessage.__new__(FakeMessage)
+        before.__dict__.update(self.__dict__)
+        self.content = content
+        await bot_module.on_message_edit(before, self)
+        return self
+
+
+class StubProvider():
+    # stands in for a model: lognormal latency around latency_ms, normally distributed output tokens
+    def __init__(self, rng, latency_ms=300, jitter=0.5, output_tokens=150, chunks=8):
+        self.rng = rng
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.output_tokens = output_tokens
+        self.chunks = chunks
+
+    def _sample(self, history):
+        latency = self.rng.lognormvariate(math.log(self.latency_ms / 1000), self.jitter) if self.latency_ms else 0
+        tokens = max(1, int(self.rng.gauss(self.output_tokens, self.output_tokens / 3)))
+        text = " ".join(self.rng.choice(WORDS) for _ in range(tokens))
+        return latency, tokens, sum(len(entry["content"]) for entry in history) // 4, text
+
+    async def generate(self, history, model, usage_dict):
+        latency, tokens, input_tokens, text = self._sample(history)
+        await asyncio.sleep(latency)
+        usage_dict["input"] = input_tokens
+        usage_dict["output"] = tokens
+        return text
+
+    async def stream(self, history, model, usage_dict):
+        latency, tokens, input_tokens, text = self._sample(history)
+        step = max(1, len(text) // self.chunks)
+        for start in range(0, len(text), step):
+            await asyncio.sleep(latency / self.chunks)
+            yield text[start:start + step]
+        usage_dict["input"] = input_tokens
+        usage_dict["output"] = tokens
+
+
+class Unanswered(Exception):
+    # a message that never got its reply: the bot dropped it, which the benchmark must not hide as a hang
+    pass
+
+
+class Harness():
+    def __init__(self, args, guild_count, directory):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.bot_user = FakeUser("bench-bot", bot=True)
+        bot_module.bot._connection.user = self.bot_user
+        self.waiting = {} # channel_id -> [(message id, sent at, future)] for messages not answered yet
+        self.first_reply = {} # channel_id -> sent at of the oldest message still without any reply
+        self.latencies = []
+        self.first_reply_latencies = []
+        self.coalesced = 0
+        self.events = {"edits": 0, "deletes": 0}
+
+        self.guilds = [FakeGuild() for _ in range(guild_count)]
+        self.channels = [FakeChannel(guild, self) for guild in self.guilds]
+        data = {"guilds": {
+            str(channel.guild.id): {
+                "channel_id": channel.id,
+                "model": "stub|bench",
+                "usage": {"today": 0, "total": 0},
+                "bypass_limits": True,
+                "response_cache": False,
+            }
+            for channel in self.channels
+        }}
+        json_path = os.path.join(directory, "data.json")
+        with open(json_path, "w") as f:
+            json.dump(data, f)
+        if args.engine == "sqlite":
+            database = open_database("sqlite", os.path.join(directory, "data.db"))
+            database.import_json(json_path)
+        else:
+            database = open_database("json", json_path, args.write_behind_ms, args.write_behind_max_pending)
+        self.logical_bytes = 0
+        set_guild = database.set_guild
+
+        async def counting_set_guild(guild_id, guild):
+            # what actually changed, to compare against what reaches the disk
+            self.logical_bytes += len(json.dumps(guild))
+            await set_guild(guild_id, guild)
+        database.set_guild = counting_set_guild
+
+        bot_module.database = database
+        bot_module.usage_ledger = UsageLedger(os.path.join(directory, "usage"))
+        bot_module.channel_history = ChannelHistory(bot_module.bot_config.get("historyBufferSize", 50))
+        bot_module.admission = AdmissionController({})
+        bot_module.channel_queue = ChannelQueue(self.handle)
+        bot_module.bot_config["streamResponses"] = args.stream
+
+        for channel in self.channels:
+            # respond() needs at least one earlier message to build a conversation
+            channel.messages.append(FakeMessage(channel, FakeUser("seed"), "hello"))
+
+    async def rest(self):
+        await asyncio.sleep(self.args.rest_ms / 1000)
+
+    def replied(self, channel):
+        sent_at = self.first_reply.pop(channel.id, None)
+        if sent_at is not None:
+            self.first_reply_latencies.append(time.perf_counter() - sent_at)
+
+    async def handle(self, message):
+        try:
+            await bot_module.respond(message)
+        finally:
+            # everything up to the answered message was folded into this turn
+            now = time.perf_counter()
+            waiting = self.waiting.get(message.channel.id, [])
+            answered = [entry for entry in waiting if entry[0] <= message.id]
+            self.waiting[message.channel.id] = [entry for entry in waiting if entry[0] > message.id]
+            self.coalesced += max(0, len(answered) - 1)
+            for _, sent_at, future in answered:
+                self.latencies.append(now - sent_at)
+                future.set_result(None)
+
+    async def user(self, user, remaining):
+        channel = self.rng.choice(self.channels)
+        loop = asyncio.get_running_loop()
+        while next(remaining, None) is not None:
+            message = FakeMessage(channel, user, " ".join(self.rng.choice(WORDS) for _ in range(self.rng.randint(3, 40))))
+            channel.messages.append(message)
+            future = loop.create_future()
+            sent_at = time.perf_counter()
+            self.waiting.setdefault(channel.id, []).append((message.id, sent_at, future))
+            self.first_reply.setdefault(channel.id, sent_at)
+            await bot_module.on_message(message)
+            try:
+                await asyncio.wait_for(future, self.args.reply_timeout)
+            except asyncio.TimeoutError:
+                # handle() drops every entry it answers, so whatever is left never got a reply
+                unresolved = [message_id for message_id, _, _ in self.waiting.get(channel.id, [])]
+                raise Unanswered(f"message {message.id} in channel {channel.id} got no reply within {self.args.reply_timeout}s, unanswered ids: {unresolved}")
+            roll = self.rng.random()
+            if roll < self.args.edit_ratio:
+                self.events["edits"] += 1
+                before = FakeMessage.__new__(FakeMessage)
+                before.__dict__.update(message.__dict__)
+                message.content += " (edited)"
+                await bot_module.on_message_edit(before, message)
+            elif roll < self.args.edit_ratio + self.args.delete_ratio:
+                self.events["deletes"] += 1
+                channel.messages.remove(message)
+                await bot_module.on_message_delete(message)
+
+    async def run(self):
+        engine = self.args.engine
+        flushes = metrics.DATABASE_FLUSH.labels(engine)
+        flush_bytes = metrics.DATABASE_FLUSH_BYTES.labels()
+        flushes_before, bytes_before = flushes.count, flush_bytes.sum
+        remaining = iter(range(self.args.messages))
+        users = [FakeUser(f"user{i}") for i in range(self.args.users)]
+        started = time.perf_counter()
+        await asyncio.gather(*(self.user(user, remaining) for user in users))
+        elapsed = time.perf_counter() - started
+        await bot_module.database.flush()
+        bot_module.usage_ledger.close()
+        written = flush_bytes.sum - bytes_before if engine == "json" else None
+        result = {
+            "guilds": len(self.guilds),
+            "messages": self.args.messages,
+            "seconds": elapsed,
+            "messages_per_second": self.args.messages / elapsed,
+            "latency_ms": _percentiles(self.latencies),
+            "first_reply_ms": _percentiles(self.first_reply_latencies),
+            "coalesced": self.coalesced,
+            **self.events,
+            "db": {
+                "flushes": flushes.count - flushes_before,
+                "bytes_written": written,
+                "logical_bytes": self.logical_bytes,
+                "write_amplification": written / self.logical_bytes if written is not None and self.logical_bytes else None,
+            },
+        }
+        bot_module.database.close()
+        return result
+
+
+def _percentiles(samples):
+    if len(samples) < 2:
+        return None
+    cuts = statistics.quantiles(samples, n=100)
+    return {"p50": cuts[49] * 1000, "p95": cuts[94] * 1000, "p99": cuts[98] * 1000}
+
+
+def _change(new, old):
+    return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+
+async def run_all(args):
+    stub = StubProvider(random.Random(args.seed), args.latency_ms, args.jitter, args.output_tokens)
+    ai.TRANSPORT["stub"] = transport_config({}, "stub")
+    bot_module.chat_provider._generate_stub = stub.generate
+    bot_module.chat_provider._stream_stub = stub.stream
+    results = []
+    for guild_count in (int(count) for count in args.guilds.split(",")):
+        with tempfile.TemporaryDirectory() as directory:
+            results.append(await Harness(args, guild_count, directory).run())
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", default="10,100,1000,10000")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=100, help="concurrent users, each waits for its reply before sending again")
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--jitter", type=float, default=0.5, help="sigma of the lognormal provider latency")
+    parser.add_argument("--output-tokens", type=int, default=150)
+    parser.add_argument("--rest-ms", type=float, default=0, help="simulated discord REST latency")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--edit-ratio", type=float, default=0.05)
+    parser.add_argument("--delete-ratio", type=float, default=0.05)
+    parser.add_argument("--engine", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--write-behind-ms", type=int, default=1000)
+    parser.add_argument("--write-behind-max-pending", type=int, default=50)
+    parser.add_argument("--reply-timeout", type=float, default=60, help="seconds a message may wait for its reply before the run fails")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output")
+    parser.add_argument("--baseline", help="earlier --output file to compare against")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    try:
+        results = asyncio.run(run_all(args))
+    except Unanswered as e:
+        sys.exit(f"Benchmark failed: {e}")
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {result["guilds"]: result for result in json.load(f)["results"]}
+    for result in results:
+        latency = result["latency_ms"] or {"p50": 0, "p95": 0, "p99": 0}
+        line = f"{result['guilds']:>6} guilds: {result['messages_per_second']:8.1f} msg/s, p50 {latency['p50']:.1f}ms p95 {latency['p95']:.1f}ms p99 {latency['p99']:.1f}ms, {result['db']['flushes']} flushes"
+        if result["db"]["write_amplification"] is not None:
+            line += f", write amplification {result['db']['write_amplification']:.1f}x"
+        old = baseline.get(result["guilds"])
+        if old:
+            line += f" | vs baseline: msg/s {_change(result['messages_per_second'], old['messages_per_second'])}"
+            if old["latency_ms"] and result["latency_ms"]:
+                line += f", p95 {_change(latency['p95'], old['latency_ms']['p95'])}"
+        print(line)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
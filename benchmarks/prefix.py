@@ -0,0 +1,106 @@
+# checks that respond() keeps the cacheable prompt prefix stable: drives the pipeline benchmark's fake
+# guilds with many users and a stub model that acts like a provider-side prompt cache, then reports how
+# many distinct prefixes each guild produced (should be 1) and the share of input tokens served from cache.
+# like the real providers, the stub only caches prefixes of at least --provider's minimum size, so with
+# today's short system prompts the share is 0 unless --provider ollama (which has no minimum)
+# run from the repository root: python benchmarks/prefix.py [--guilds 20] [--messages 1000] [--provider anthropic]
+import argparse
+import asyncio
+import random
+import sys
+import tempfile
+
+from pipeline import Harness, StubProvider
+
+import ai
+import bot as bot_module
+from prompt_cache import prefix_key, split_prefix
+from tokens import estimate_tokens
+from transport import transport_config
+
+# smallest prefix each provider will cache, in tokens: anthropic's for sonnet and opus (haiku needs 2048),
+# openai's automatic caching, and gemini's context caching (promptCaching.google.minTokens)
+MIN_PREFIX_TOKENS = {
+    "anthropic": 1024,
+    "openai": 1024,
+    "google": ai.PROMPT_CACHING.get("google", {}).get("minTokens", 32768),
+    "ollama": 0,
+}
+
+
+class CachingStub(StubProvider):
+    # a prefix counts as cached once this "provider" has seen it before, if it is at least provider's minimum
+    def __init__(self, rng, provider="anthropic", **kwargs):
+        super().__init__(rng, **kwargs)
+        self.provider = provider
+        self.min_tokens = MIN_PREFIX_TOKENS[provider]
+        self.too_short = 0 # calls whose prefix was under the minimum
+        self.seen = set()
+        self.by_guild = {} # guild system prompt -> prefix keys seen with it
+        self.input = 0
+        self.cached = 0
+
+    def _observe(self, history, usage_dict):
+        prefix, _ = split_prefix(history)
+        key = prefix_key(prefix)
+        # the model never sees a guild id, so group by the guild's own system prompt
+        self.by_guild.setdefault(prefix[0]["content"].split("\n\n", 1)[0] if prefix else "", set()).add(key)
+        prefix_tokens = sum(estimate_tokens(message["content"], self.provider) for message in prefix)
+        if prefix_tokens < self.min_tokens:
+            self.too_short += 1
+            prefix_tokens = 0
+        usage_dict["cached"] = prefix_tokens if key in self.seen else 0
+        self.seen.add(key)
+        self.input += usage_dict["input"]
+        self.cached += usage_dict["cached"]
+
+    async def generate(self, history, model, usage_dict):
+        text = await super().generate(history, model, usage_dict)
+        self._observe(history, usage_dict)
+        return text
+
+    async def stream(self, history, model, usage_dict):
+        async for chunk in super().stream(history, model, usage_dict):
+            yield chunk
+        self._observe(history, usage_dict)
+
+
+async def run(args):
+    stub = CachingStub(random.Random(args.seed), args.provider, latency_ms=args.latency_ms, output_tokens=20)
+    ai.TRANSPORT["stub"] = transport_config({}, "stub")
+    bot_module.chat_provider._generate_stub = stub.generate
+    bot_module.chat_provider._stream_stub = stub.stream
+    with tempfile.TemporaryDirectory() as directory:
+        harness = Harness(args, args.guilds, directory)
+        # a distinct system prompt per guild, so prefixes can be told apart
+        for index, guild in enumerate(harness.guilds):
+            await bot_module.database.set_guild_property(guild.id, "system", f"You are assistant number {index}.")
+        await harness.run()
+    return stub
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--provider", choices=sorted(MIN_PREFIX_TOKENS), default="anthropic", help="whose minimum cacheable prefix to apply")
+    args = parser.parse_args()
+    # the rest of what Harness reads
+    args.jitter, args.rest_ms, args.edit_ratio, args.delete_ratio = 0.5, 0, 0.05, 0.05
+    args.engine, args.write_behind_ms, args.write_behind_max_pending = "json", 1000, 50
+    args.reply_timeout = 60
+
+    stub = asyncio.run(run(args))
+    unstable = {system: keys for system, keys in stub.by_guild.items() if len(keys) > 1}
+    print(f"{len(stub.by_guild)} guilds, {len(stub.seen)} distinct prefixes, {len(unstable)} guilds with an unstable prefix")
+    print(f"{stub.cached}/{stub.input} input tokens cached ({stub.cached / max(1, stub.input):.1%}), {stub.too_short} calls with a prefix under {stub.provider}'s {stub.min_tokens} tokens")
+    if unstable:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
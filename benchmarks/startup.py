@@ -0,0 +1,59 @@
+# cold start benchmark: how long "import ai" takes and how long each enabled provider takes to load
+# run from the repository root: python benchmarks/startup.py [--runs 5] [--output startup.json]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, time
+started = time.perf_counter()
+import ai
+imported = time.perf_counter() - started
+loads = {}
+for provider in ai.MODELS:
+    try:
+        ai.get_client(provider)
+        loads[provider] = ai.LOAD_TIMES[provider]
+    except Exception as e:
+        loads[provider] = None
+print(json.dumps({"import": imported, "providers": loads}))
+"""
+
+
+def run_once():
+    result = subprocess.run([sys.executable, "-c", PROBE], cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+    imports = [run["import"] for run in runs]
+    report = {
+        "runs": args.runs,
+        "import_ai": {"median": statistics.median(imports), "max": max(imports)},
+        "providers": {},
+    }
+    for provider in runs[0]["providers"]:
+        times = [run["providers"][provider] for run in runs if run["providers"][provider] is not None]
+        report["providers"][provider] = {"median": statistics.median(times), "max": max(times)} if times else None
+
+    print(f"import ai: {report['import_ai']['median'] * 1000:.1f}ms median")
+    for provider, times in report["providers"].items():
+        print(f"  first use of {provider}: " + (f"{times['median'] * 1000:.1f}ms median" if times else "failed to load"))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
+import asyncio
 import datetime
 import json
 import random
 import sys
+import time
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -11,11 +13,26 @@ import os
 import nextcord
 from nextcord import Interaction, WebhookMessage, Message
 from nextcord.ext import commands, application_checks, tasks
-from ai import ChatProvider
-from database import BotDatabase
+from ai import SUMMARIES, ChatProvider
+from database import open_database
+from history import ChannelHistory
+from channel_queue import ChannelQueue
+from streaming import StreamingReply
+from transport import pool_stats
+from admission import AdmissionController, AdmissionRejected
+from chunker import chunk_message
+from mentions import MentionTranslator
+from tokens import calibrate, calibrated, estimate_tokens, pack_history
+from usage_ledger import UsageLedger
+from shared_state import open_shared_state
+from worker_pool import GenerationPool
+from broadcast import Broadcast, channel_targets
+from summaries import BREAK, Summarizer
+from sharding import parse_shard_ids
+import metrics
 
 # comma separated list $ADMIN_USERS
-ADMIN_USERS = [int(id) for id in os.getenv("ADMIN_USERS", "").split(",")]
+ADMIN_USERS = [int(id) for id in os.getenv("ADMIN_USERS", "").split(",") if id]
 # ADMIN_USERS = [892912043240333322, 1270994103584292998]
 
 logging.basicConfig(level=logging.INFO)
@@ -25,7 +42,27 @@ if "--debug" in sys.argv:
 logging.getLogger("nextcord").setLevel(logging.INFO)
 bot_config = json.load(open("botconfig.json"))
 
-database = BotDatabase("data.json")
+# set by sharding.py when shards are split across processes; unset means one process, discord picks the shard count
+SHARD_IDS = parse_shard_ids(os.getenv("SHARD_IDS"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT")) if os.getenv("SHARD_COUNT") else None
+SHARD_PROCESS = os.getenv("SHARD_PROCESS", "0")
+
+database = open_database(
+    bot_config.get("databaseEngine", "json"),
+    bot_config.get("databasePath"),
+    write_behind_ms=bot_config.get("writeBehindMs", 0),
+    write_behind_max_pending=bot_config.get("writeBehindMaxPending", 50),
+)
+usage_ledger = UsageLedger(
+    bot_config.get("usageLedgerPath", "usage"),
+    flush_ms=bot_config.get("usageFlushMs", 2000),
+    retention_days=bot_config.get("usageRetentionDays", 14),
+    process=SHARD_PROCESS if SHARD_IDS is not None else None,
+)
+# which guilds each shard process is connected to, so owner commands can cover all of them
+shared_state = open_shared_state(bot_config.get("databaseEngine", "json"), bot_config.get("databasePath"))
+if SHARD_IDS is not None and shared_state.local:
+    raise RuntimeError("Shards in separate processes share state through sqlite, set databaseEngine to \"sqlite\"")
 """
 {
 "token_limit": 1000,
@@ -42,23 +79,29 @@ database = BotDatabase("data.json")
 
 intents = nextcord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(intents=intents)
+if SHARD_IDS is not None:
+    bot = commands.AutoShardedBot(intents=intents, shard_ids=SHARD_IDS, shard_count=SHARD_COUNT)
+else:
+    bot = commands.AutoShardedBot(intents=intents)
 
 
 # region funny presence stuff
 PRESENCES = []
-# read from CSV: type, status
-with open("presences.csv", "r") as f:
-    for line in f:
-        line = line.strip()
-        if not line:
-            continue
-        PRESENCES.append(line.split(","))
+# read from CSV: type, status (optional, the presence just stays as is without it)
+if os.path.exists("presences.csv"):
+    with open("presences.csv", "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            PRESENCES.append(line.split(","))
 
 async def set_presence(type=nextcord.ActivityType.listening, name="everything you say"):
     await bot.change_presence(activity=nextcord.Activity(type=type, name=name))
 
 async def set_random_presence():
+    if not PRESENCES:
+        return
     presence = random.choice(PRESENCES) 
     if presence[0] == "playing":
         await bot.change_presence(activity=nextcord.Game(name=presence[1]))
@@ -81,9 +124,22 @@ async def before_change_presence():
 # endregion
 
 chat_provider = ChatProvider("google", "gemini-1.5-flash")
+# with generationWorkers set, provider calls run in worker processes and this process only routes events
+worker_pool = None
+if bot_config.get("generationWorkers", 0):
+    worker_pool = GenerationPool(
+        chat_provider.provider,
+        chat_provider.model,
+        size=bot_config["generationWorkers"],
+        job_timeout=bot_config.get("workerJobTimeout", 120),
+        health_interval=bot_config.get("workerHealthInterval", 10),
+        concurrency=bot_config.get("workerConcurrency", 8),
+    )
+generator = worker_pool or chat_provider
+admission = AdmissionController(chat_provider.rate_limits())
 logging.info(f"Using model {chat_provider.model} from {chat_provider.provider}")
 
-TYPING_IN_CHANNELS = []
+channel_history = ChannelHistory(bot_config.get("historyBufferSize", 50))
 
 # captures command errors - not listener errors!
 @bot.event
@@ -98,11 +154,28 @@ async def on_application_command_error(interaction: nextcord.Interaction, error:
         await interaction.response.send_message("An error occurred during command execution. Please report this to the bot owner.", ephemeral=True)
 
 
+@bot.event
+async def on_disconnect():
+    # events may be missed while disconnected, reseed history buffers on next use
+    channel_history.invalidate()
+
 @bot.event
 async def on_ready():
     logging.info(f"Logged in as {bot.user}")
-        
-    example_request = await chat_provider.generate_text([{"content": "Hello, world!", "role": "user"}])
+    usage_ledger.seed(await database.get_guilds())
+    await shared_state.publish_guilds(SHARD_PROCESS, [(guild.id, guild.name, guild.shard_id) for guild in bot.guilds])
+    await _start_metrics()
+    global watch_task
+    if watch_task is None:
+        # picks up settings written by other shard processes
+        watch_task = asyncio.create_task(database.watch_changes())
+    # ollama models load in the background, so on_ready does not wait for them. process 0 runs the
+    # pool, the others send it their traffic
+    chat_provider.ollama_pool.start(chat_provider.available_models("ollama") or [], shared_state, SHARD_PROCESS)
+    if SHARD_PROCESS != "0":
+        return # commands are global, one process registers them
+
+    example_request = await generator.generate_text([{"content": "Hello, world!", "role": "user"}])
     logging.info(example_request)
     # black magic to have it work in all contexts below
     guild = None
@@ -120,10 +193,25 @@ async def on_ready():
     data = await bot.http.bulk_upsert_global_commands(bot.application_id, payload=default_payload)
     # logging.debug(data)
 
+metrics_server = None
+watch_task = None
+
+async def _start_metrics():
+    # on_ready fires again after reconnects, only start once
+    global metrics_server
+    port = bot_config.get("metricsPort", 0)
+    if not port or metrics_server is not None:
+        return
+    metrics.QUEUE_DEPTH.collect = channel_queue.depths
+    # one port per shard process
+    metrics_server = await metrics.serve(port + int(SHARD_PROCESS), bot_config.get("metricsHost", "127.0.0.1"))
+    asyncio.create_task(metrics.watch_loop_lag())
+
 # on guild join, send message in first channel
 @bot.event
 async def on_guild_join(guild: nextcord.Guild):
     await database.set_guild(guild.id, {"channel_id": None, "model": "gemini-1.5-flash", "system": "google"})
+    await shared_state.add_guild(SHARD_PROCESS, guild.id, guild.name, guild.shard_id)
     # get first channel with send permissions
     first_channel = next((channel for channel in guild.text_channels if channel.permissions_for(guild.me).send_messages), None)
     if not first_channel:
@@ -131,6 +219,10 @@ async def on_guild_join(guild: nextcord.Guild):
         return
     await first_channel.send(f"Hello, I am {bot.user.name}. To set me up, use the `/setchannel` command in the channel you want me to respond in.")
 
+@bot.event
+async def on_guild_remove(guild: nextcord.Guild):
+    await shared_state.remove_guild(guild.id)
+
 @bot.slash_command(description="Welcome to the world of AI!")
 async def hello(interaction: Interaction):
     await interaction.response.send_message("Hello, world!")
@@ -152,6 +244,8 @@ async def shutdown(interaction: Interaction):
         await interaction.response.send_message("You do not have permissions to use this command.", ephemeral=True)
         return
     await interaction.response.send_message("Shutting down...", ephemeral=True)
+    await database.flush()
+    await usage_ledger.flush()
     await bot.close()
 
 @admin.subcommand()
@@ -161,6 +255,10 @@ async def restart(interaction: Interaction):
         return
     await set_presence(type=nextcord.ActivityType.watching, name="myself restart")
     await interaction.response.send_message("Restarting...", ephemeral=True)
+    await database.flush()
+    await usage_ledger.flush()
+    if worker_pool is not None:
+        worker_pool.close()
     os.execl(sys.executable, sys.executable, *sys.argv)
 
 @admin.subcommand()
@@ -184,20 +282,136 @@ async def check_usage(interaction: Interaction, guild_id: str | None = None):
         return
     if not guild_id:
         # check global usage
-        global_daily_usage = sum([guild["usage"]["today"] for guild in database.data.get("guilds", {}).values()])
-        global_total_usage = sum([guild["usage"]["total"] for guild in database.data.get("guilds", {}).values()])
-        await interaction.response.send_message(f"Global daily usage: {global_daily_usage} | Global total usage: {global_total_usage}", ephemeral=True)
+        # the ledger only sees this process's shards, the shared database sees all of them
+        global_usage = usage_ledger.totals() if shared_state.local else await database.get_usage_totals()
+        global_daily_usage = global_usage["today"]
+        global_total_usage = global_usage["total"]
+        cache_text = ""
+        # with workers, each has its own response cache
+        cache_stats = worker_pool.cache_stats() if worker_pool else chat_provider.cache and chat_provider.cache.stats()
+        if cache_stats:
+            cache_text = f" | Response cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['entries']} entries"
+        await interaction.response.send_message(f"Global daily usage: {global_daily_usage} | Global total usage: {global_total_usage}{cache_text}", ephemeral=True)
         return
     guild_id = int(guild_id)
-    usage = await database.get_guild_property(guild_id, "usage")
+    if shared_state.local:
+        usage = usage_ledger.totals(guild_id)
+    else:
+        # straight from the row: add_usage leaves changed alone, so other processes' cached configs lag behind
+        usage = (await database.get_guild(guild_id)).get("usage") or {"today": 0, "total": 0}
     await interaction.response.send_message(f"Today's usage: {usage['today']} | Total usage: {usage['total']}", ephemeral=True)
 
+@admin.subcommand("rollup")
+async def usage_rollup(interaction: Interaction, bucket: str = "hour", hours: int = 24, guild_id: str | None = None):
+    if not (interaction.user.id in ADMIN_USERS):
+        await interaction.response.send_message("You do not have permissions to use this command.", ephemeral=True)
+        return
+    since, guild_id = time.time() - hours * 3600, int(guild_id) if guild_id else None
+    rollup = usage_ledger.rollup(bucket, since, guild_id) if shared_state.local else await usage_ledger.shared_rollup(bucket, since, guild_id)
+    if not rollup:
+        await interaction.response.send_message("No usage recorded in that window.", ephemeral=True)
+        return
+    time_format = "%Y-%m-%d" if bucket == "day" else "%Y-%m-%d %H:00"
+    lines = [
+        f"{datetime.datetime.fromtimestamp(start, datetime.timezone.utc).strftime(time_format)} {model}: {values['requests']} requests, {values['input']} in ({values['cached']} cached) / {values['output']} out, {values['latency_ms']}ms avg"
+        for (start, model), values in rollup.items()
+    ]
+    # keep the newest lines that fit in one message
+    text = ""
+    for line in reversed(lines):
+        if len(text) + len(line) + 1 > 1900:
+            break
+        text = line + "\n" + text
+    await interaction.response.send_message(text, ephemeral=True)
+
 @admin.subcommand("activetyping")
 async def currently_typing(interaction: Interaction):
     if not (interaction.user.id in ADMIN_USERS):
         await interaction.response.send_message("You do not have permissions to use this command.", ephemeral=True)
         return
-    await interaction.response.send_message(f"Currently typing in channels: {TYPING_IN_CHANNELS}", ephemeral=True)
+    stats = channel_queue.stats()
+    if not stats:
+        await interaction.response.send_message("Not typing in any channels.", ephemeral=True)
+        return
+    lines = [
+        f"{channel_id}: {entry['queued']} queued, " + (f"in flight for {entry['in_flight']:.1f}s" if entry["in_flight"] is not None else "idle")
+        for channel_id, entry in stats.items()
+    ]
+    await interaction.response.send_message("Currently typing in channels:\n" + "\n".join(lines), ephemeral=True)
+
+@admin.subcommand("pools")
+async def connection_pools(interaction: Interaction):
+    if not (interaction.user.id in ADMIN_USERS):
+        await interaction.response.send_message("You do not have permissions to use this command.", ephemeral=True)
+        return
+    stats = pool_stats()
+    if not stats:
+        await interaction.response.send_message("No connection pools open.", ephemeral=True)
+        return
+    lines = [f"{provider}: {entry['in_use']}/{entry['max']} in use, {entry['idle']} idle, {entry['waits']} waits, {entry['requests']} requests" for provider, entry in stats.items()]
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
+@admin.subcommand("workers")
+async def generation_workers(interaction: Interaction):
+    if not (interaction.user.id in ADMIN_USERS):
+        await interaction.response.send_message("You do not have permissions to use this command.", ephemeral=True)
+        return
+    if worker_pool is None or not worker_pool.workers:
+        await interaction.response.send_message("Generating in the gateway process.", ephemeral=True)
+        return
+    lines = [
+        f"worker {entry['index']} (pid {entry['pid']}): {'alive' if entry['alive'] else 'dead'}, {entry['jobs']} jobs, {entry['restarts']} restarts, last health check {entry['last_pong']:.0f}s ago"
+        for entry in worker_pool.stats()
+    ]
+    lines.append(f"{worker_pool.timeouts} jobs timed out")
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
+@admin.subcommand("ollama")
+async def ollama_models(interaction: Interaction):
+    if not (interaction.user.id in ADMIN_USERS):
+        await interaction.response.send_message("You do not have permissions to use this command.", ephemeral=True)
+        return
+    pool = chat_provider.ollama_pool
+    if not pool.enabled or not pool.models:
+        await interaction.response.send_message("The ollama warm pool is off.", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True)
+    try:
+        await pool.refresh()
+        await pool.read_traffic()
+    except Exception as e:
+        logging.error(f"Error reading ollama models: {e}")
+    lines = []
+    for entry in pool.stats():
+        line = f"{entry['model']}: " + (f"resident, {entry['size_mb']}MB ({entry['vram_mb']}MB vram)" if entry["resident"] else "not loaded")
+        line += f", {'hot' if entry['hot'] else 'cold'} ({entry['requests']} requests from {entry['guilds']} servers)"
+        if entry["idle"] is not None:
+            line += f", idle {entry['idle']:.0f}s"
+        line += f", {entry['loads']} loads" + (f" (last {entry['load_seconds']:.1f}s)" if entry["load_seconds"] is not None else "")
+        line += f", {entry['unloads']} unloads" + (f" (last {entry['unload_seconds']:.1f}s)" if entry["unload_seconds"] is not None else "")
+        lines.append(line)
+    await interaction.followup.send("\n".join(lines)[:2000], ephemeral=True)
+
+@admin.subcommand("breakers")
+async def circuit_breakers(interaction: Interaction):
+    if not (interaction.user.id in ADMIN_USERS):
+        await interaction.response.send_message("You do not have permissions to use this command.", ephemeral=True)
+        return
+    # workers report theirs with each health check
+    breakers = worker_pool.breakers() if worker_pool else {key: breaker.stats() for key, breaker in chat_provider.breakers.items()}
+    if not breakers:
+        await interaction.response.send_message("No provider calls made yet.", ephemeral=True)
+        return
+    lines = []
+    for key, stats in breakers.items():
+        line = f"{key}: {stats['state']}, {stats['failures']} consecutive failures ({stats['total_failures']} failed / {stats['total_successes']} ok)"
+        if stats["reopens_in"] is not None:
+            line += f", retrying in {stats['reopens_in']:.0f}s"
+        lines.append(line)
+    hedges = worker_pool.hedge_stats() if worker_pool else chat_provider.hedge_budget.stats()
+    if hedges["hedges"]:
+        lines.append(f"hedged {hedges['hedges']} of {hedges['requests']} requests, {hedges['wins']} answered first")
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
 
 @admin.subcommand("delm")
 async def delete_message(interaction: Interaction, message_id: str):
@@ -257,7 +471,7 @@ async def echo(interaction: Interaction, message: str, ephemeral: bool = True):
 
 # region Hidden
 
-HIDDEN_GUILDS = [int(guild) for guild in os.getenv("HIDDEN_GUILDS", "").split(",")] + [1]
+HIDDEN_GUILDS = [int(guild) for guild in os.getenv("HIDDEN_GUILDS", "").split(",") if guild] + [1]
 
 @application_checks.is_owner()
 @bot.slash_command("hidden", guild_ids=HIDDEN_GUILDS)
@@ -267,10 +481,13 @@ async def hidden(interaction: Interaction):
 @application_checks.is_owner()
 @hidden.subcommand("activeguilds")
 async def active_guilds(interaction: Interaction):
-    # do not retrieve database guilds - retrieve from bot.guilds
-    guilds = bot.guilds
-    text = "\n".join(f"{guild.name} ({guild.id})" for guild in guilds)
-    await interaction.response.send_message(text)
+    # do not retrieve database guilds - retrieve what every shard process is connected to
+    guilds = await shared_state.guilds()
+    text = "\n".join(f"{name} ({guild_id}) shard {shard_id}" for guild_id, name, shard_id, _ in guilds)
+    chunks = chunk_message(text) or ["Not in any guilds."]
+    await interaction.response.send_message(chunks[0])
+    for chunk in chunks[1:]:
+        await interaction.followup.send(chunk)
 
 @application_checks.is_owner()
 @hidden.subcommand("guildinfo")
@@ -317,35 +534,72 @@ async def set_guild_property(interaction: Interaction, guild_id: str, key: str,
 @application_checks.is_owner()
 @hidden.subcommand("resetallusage")
 async def reset_all_usage(interaction: Interaction):
-    await _reset_usage()
+    await database.reset_daily_usage()
+    usage_ledger.reset_today()
     await interaction.response.send_message("Reset all daily usage.")
 
+def _resolve_channel(channel_id):
+    # guilds on other shards are not in this process's cache, but REST sends work for any channel
+    return bot.get_channel(channel_id) or bot.get_partial_messageable(channel_id)
+
+# one broadcast at a time; taken before the first await, so two commands cannot both get past the check
+broadcast_lock = asyncio.Lock()
+active_broadcast = None
+
+async def _broadcast_running(interaction: Interaction):
+    if not broadcast_lock.locked():
+        return False
+    summary = active_broadcast.summary() if active_broadcast is not None else "Collecting channels..."
+    await interaction.response.send_message(f"A broadcast is already running.\n{summary}")
+    return True
+
+async def _run_broadcast(interaction: Interaction, targets, message, skipped=0):
+    global active_broadcast
+    broadcast = Broadcast(
+        targets,
+        message,
+        workers=bot_config.get("broadcastWorkers", 8),
+        rate=bot_config.get("broadcastRate", 40),
+        skipped=skipped,
+    )
+    status = await interaction.followup.send(f"Sending to {len(targets)} channels...", wait=True)
+
+    async def progress(broadcast):
+        await status.edit(content=broadcast.summary())
+
+    active_broadcast = broadcast
+    try:
+        await broadcast.run(progress, bot_config.get("broadcastProgressInterval", 3))
+    finally:
+        active_broadcast = None
+
 @application_checks.is_owner()
 @hidden.subcommand("sendall")
 async def send_all(interaction: Interaction, message: str):
     message = message.replace("nnn", "\n")
-    await interaction.response.defer()
-    for guild in bot.guilds:
-        # look for AI channel
-        channel_id = await database.get_guild_property(guild.id, "channel_id")
-        if not channel_id:
-            continue
-        channel = bot.get_channel(channel_id)
-        await channel.send(message)
-    await interaction.followup.send("Sent message to all guilds' ai channels.")
+    if await _broadcast_running(interaction):
+        return
+    async with broadcast_lock:
+        await interaction.response.defer()
+        # one query for every ai channel instead of a lookup per guild
+        targets, skipped = channel_targets(await database.get_channels(), await shared_state.guilds(), _resolve_channel)
+        await _run_broadcast(interaction, targets, message, skipped)
 
 @application_checks.is_owner()
 @hidden.subcommand("sendguild")
 async def send_guild(interaction: Interaction, guild_id: str, message: str):
     guild_id = int(guild_id)
     message = message.replace("nnn", "\n")
-    channel_id = await database.get_guild_property(guild_id, "channel_id")
-    if not channel_id:
-        await interaction.response.send_message("Channel not set.")
+    if await _broadcast_running(interaction):
         return
-    channel = bot.get_channel(channel_id)
-    await channel.send(message)
-    await interaction.response.send_message("Sent message.")
+    async with broadcast_lock:
+        channel_id = (await database.get_config(guild_id)).channel_id
+        if not channel_id:
+            await interaction.response.send_message("Channel not set.")
+            return
+        await interaction.response.defer()
+        guild = bot.get_guild(guild_id)
+        await _run_broadcast(interaction, [(str(guild_id), guild.name if guild else str(guild_id), _resolve_channel(channel_id))], message)
 
 
 # endregion
@@ -422,9 +676,11 @@ async def help(interaction: Interaction):
     `/system get` - Get the system message
     `/contextlength set [length]` - Set the context length
     `/contextlength get` - Get the context length
+    `/contextlength budget [tokens]` - Size the context in tokens instead of messages
     `/break` - Send a breakpoint message in the channel
     `/toggletts` - Toggle TTS
     `/seebots` - Allow/disallow bots to be responded to
+    `/togglecache` - Allow/disallow reusing answers to identical prompts
     **[User] Commands:**
     `/ignoreme` - The bot will not respond to you or see your messages
     `/peace` - The bot will not ping you
@@ -476,6 +732,19 @@ async def toggle_tts(interaction: Interaction):
     await database.set_guild_property(interaction.guild.id, "tts", tts)
     await interaction.followup.send(f"TTS is now {'enabled' if tts else 'disabled'}", ephemeral=True)
 
+@bot.slash_command("togglecache", description="Allow/disallow reusing answers to identical prompts")
+async def toggle_cache(interaction: Interaction):
+    if not interaction.guild or not interaction.guild.id:
+        await interaction.response.send_message("This command can only be used in a server.", ephemeral=True)
+        return
+    if not interaction.user.guild_permissions.manage_guild and not interaction.user.id in ADMIN_USERS:
+        await interaction.response.send_message("You do not have permissions to use this command.", ephemeral=True)
+        return
+    use_cache = await database.get_guild_property(interaction.guild.id, "response_cache", True)
+    use_cache = not use_cache
+    await database.set_guild_property(interaction.guild.id, "response_cache", use_cache)
+    await interaction.response.send_message(f"Response cache is now {'enabled' if use_cache else 'disabled'}", ephemeral=True)
+
 @bot.slash_command("seebots", description="Allow/disallow bots to be responded to")
 async def see_bots(interaction: Interaction):
     if not interaction.guild or not interaction.guild.id:
@@ -508,11 +777,33 @@ async def set_context_length(interaction: Interaction, length: int):
 @context_length.subcommand("get", description="Get the context length")
 async def get_context_length(interaction: Interaction):
     length = await database.get_guild_property(interaction.guild.id, "context_length")
+    tokens = await database.get_guild_property(interaction.guild.id, "context_tokens")
+    if tokens:
+        await interaction.response.send_message(f"Context budget: {tokens} tokens", ephemeral=True)
+        return
     await interaction.response.send_message(f"Context length: {length}", ephemeral=True)
 
+@application_checks.has_guild_permissions(manage_guild=True)
+@context_length.subcommand("budget", description="Set the context size in tokens instead of messages (0 to turn off)")
+async def set_context_budget(interaction: Interaction, tokens: int):
+    model_info = await database.get_model_info(interaction.guild.id) or ""
+    provider, model = model_info.split("|") if "|" in model_info else ("google", model_info)
+    max_tokens = chat_provider.context_budget(provider, model)
+    if not 0 <= tokens <= max_tokens:
+        await interaction.response.send_message(f"Context budget must be between 0 and {max_tokens} tokens.", ephemeral=True)
+        return
+    await database.set_guild_property(interaction.guild.id, "context_tokens", tokens)
+    if not tokens:
+        await interaction.response.send_message("Context budget turned off, using the context length again.", ephemeral=True)
+        return
+    await interaction.response.send_message(f"Set context budget to {tokens} tokens", ephemeral=True)
+
 # on deletion
 @bot.event
 async def on_message_delete(message: nextcord.Message):
+    # check if it is in last 5 messages (the message is already gone from REST, so only the buffer knows)
+    recent = channel_history.peek(message.channel.id, 5)
+    channel_history.remove(message)
     if message.author == bot.user:
         return
     gchannel = await database.get_guild_property(message.guild.id, "channel_id")
@@ -520,9 +811,7 @@ async def on_message_delete(message: nextcord.Message):
         return
     if not message.channel.id == gchannel:
         return
-    # check if it is in last 5 messages
-    history = await message.channel.history(limit=5).flatten()
-    if not message in history:
+    if not any(recent_message.id == message.id for recent_message in recent):
         return
     # send DELETED <@id>: message
     await message.channel.send(f"DELETED <@{message.author.id}>: {message.content}")
@@ -564,6 +853,7 @@ async def unpeace_me(interaction: Interaction):
 # on edit of most recent message, delete and send new message
 @bot.event
 async def on_message_edit(before: nextcord.Message, after: nextcord.Message):
+    channel_history.edit(after)
     if before.author == bot.user:
         return
     gchannel = await database.get_guild_property(before.guild.id, "channel_id")
@@ -572,55 +862,78 @@ async def on_message_edit(before: nextcord.Message, after: nextcord.Message):
     if not before.channel.id == gchannel:
         return
     # check if it is in last message
-    history = await before.channel.history(limit=1).flatten()
-    if not before in history:
+    history = await channel_history.get(before.channel, 1)
+    if not any(recent_message.id == before.id for recent_message in history):
         return
     # send DELETED <@id>: message
     await before.channel.send(f"EDITED <@{before.author.id}>: {before.content}")
 
 @bot.event
 async def on_message(message: nextcord.Message):
-    see_bots = await database.get_guild_property(message.guild.id, "see_bots", False)
-    if message.author == bot.user or (message.author.bot and not see_bots):
-        return
+    channel_history.add(message)
     if not message.guild:
         return
-    
-    if message.channel.id in TYPING_IN_CHANNELS:
+    config = await database.get_config(message.guild.id)
+    if message.author == bot.user or (message.author.bot and not config.see_bots):
         return
-    
-    if (not (await database.get_guild_property(message.guild.id, "channel_id")) == message.channel.id ) and not bot.user.mentioned_in(message):
+
+    if (not config.channel_id == message.channel.id ) and not bot.user.mentioned_in(message):
         return
 
-    # check if guild is bypassing limits
-    TYPING_IN_CHANNELS.append(message.channel.id)
+    # if the channel is already generating, this gets folded into its next turn
+    channel_queue.submit(message)
+
+async def respond(message: nextcord.Message):
     try:
       await message.channel.trigger_typing()
     except Exception as e:
       logging.error(f"Error typing: {e}")
-      TYPING_IN_CHANNELS.remove(message.channel.id)
       return
 
-    if not await database.get_guild_property(message.guild.id, "usage"):
+    # one snapshot of the guild's settings for the whole turn
+    config = await database.get_config(message.guild.id)
+    see_bots = config.see_bots
+
+    if not config.has_usage:
         await database.set_guild_property(message.guild.id, "usage", {"today": 0, "total": 0})
 
-    if not await database.get_guild_property(message.guild.id, "bypass_limits"):
-        await database.set_guild_property(message.guild.id, "bypass_limits", False)
-    
-    guild_token_limit = int((await database.get_guild_property(message.guild.id, "token_limit")) or bot_config.get("tokenLimit", 1000))
+    guild_token_limit = int(config.token_limit or bot_config.get("tokenLimit", 1000))
 
-    if not await database.get_guild_property(message.guild.id, "bypass_limits") and (await database.get_guild_property(message.guild.id, "usage"))["today"] >= guild_token_limit:
-        
-        # check if already sent message
-        if (h := await message.channel.history(limit=1).flatten()):
-            if h[0].author == bot.user and h[0].content == "You have reached the token limit for today.":
-                return
-        logging.info(f"Token limit reached for guild {message.guild.id} ({message.guild.name})")
-        await message.channel.send("You have reached the token limit for today.")
+    # check if guild is bypassing limits
+    bypass_limits = config.bypass_limits
+    if not bypass_limits and config.usage_today >= guild_token_limit:
+        await _send_limit_notice(message)
         return
+    # server_model, server_provider = await database.get_model_info(message.guild.id)
+    server_model_info = config.model
+    if "|" in server_model_info:
+        server_provider, server_model = server_model_info.split("|")
+    else:
+        server_model = server_model_info
+        server_provider = "google"
+    if server_provider == "ollama":
+        chat_provider.ollama_pool.touch(server_model, message.guild.id)
+    server_system = config.system
+    if not server_system:
+        server_system = bot_config.get("defaultSystem", "You are an assistant.")
+    server_system += "\n\nYour name is " + bot.user.name + ". Refer to users by their Display Name, not their mention username."
+
+    # summary of what has scrolled out of the window, dropped below if the window reaches a break
+    summary = summarizer.current(config, message.channel.id) if summarizer.enabled else None
+
     # now look through channel history - if empty, stop
-    context_limit = (await database.get_guild_property(message.guild.id, "context_length")) or bot_config.get("contextLimit", 5)
-    history = await message.channel.history(limit=context_limit).flatten()
+    context_tokens = config.context_tokens
+    estimated_input = 0
+    if context_tokens:
+        # token budget mode: as many of the newest messages as fit next to the system prompt
+        budget = min(context_tokens, chat_provider.context_budget(server_provider, server_model))
+        system_tokens = estimate_tokens(server_system + (summary or ""), server_provider)
+        candidates = await channel_history.get(message.channel, channel_history.size)
+        history, _ = pack_history(candidates, budget - calibrated(system_tokens, server_provider), lambda m: calibrated(channel_history.tokens(m, server_provider), server_provider))
+        estimated_input = system_tokens + sum(channel_history.tokens(m, server_provider) for m in history)
+    else:
+        context_limit = config.context_length or bot_config.get("contextLimit", 5)
+        history = await channel_history.get(message.channel, context_limit)
     # if breakpoint, stop
     if not history or not len(history) > 1:
         return
@@ -630,28 +943,34 @@ async def on_message(message: nextcord.Message):
     temp_display_names[message.author.name] = message.author.display_name
     # dict: user_name -> user_id
     # convert above to loop
-    ignored_users = await database.get_guild_property(message.guild.id, "ignored_users", [])
-    formatted_history = []
+    ignored_users = config.ignored_users
+    included = []
+    hit_break = False
     for fmessage in history:
         if fmessage.author.id in ignored_users:
             continue
-        if fmessage.content == "-- BREAK --":
+        if fmessage.content == BREAK:
+            hit_break = True
             break
         for mention in fmessage.mentions:
             temp_user_names[mention.name] = mention.id
             temp_display_names[mention.name] = mention.display_name
+        included.append(fmessage)
+
+    mentions = MentionTranslator(temp_user_names, bot.user.name, bot.user.mention, config.no_ping_users)
+    formatted_history = []
+    for fmessage in included:
         # replace <@id> with <@name>
         # if message is prefixed with DELETED <@id>: ...content..., treat it as a message from that user and remove the prefix
+        # (history messages are shared with the buffer, so never modify them in place)
         if fmessage.content.startswith("DELETED <@"):
-            fmessage.content = fmessage.content.split(": ", 1)[1]
-            formatted_history.append({"content": f"<@{fmessage.author.name}>: {fmessage.content} <END>", "role": "user" if not fmessage.author.bot else "assistant"})
+            content = fmessage.content.split(": ", 1)[1]
+            formatted_history.append({"content": f"<@{fmessage.author.name}>: {content} <END>", "role": "user" if not fmessage.author.bot else "assistant"})
         else:
-          temp_content = f"<@{fmessage.author.name}>: {fmessage.content} <END>"
-          for name, id in temp_user_names.items():
-              temp_content = temp_content.replace(f"<@{id}>", f"<@{name}>")
+          temp_content = mentions.to_names(f"<@{fmessage.author.name}>: {fmessage.content} <END>")
           is_user = not fmessage.author.bot if not see_bots else fmessage.author.id != bot.user.id
           formatted_history.append({"content": temp_content, "role": "user" if is_user else "assistant"})
-                
+
     temp = []
     # go through and join consecutive messages from the same role
     for fmessage in formatted_history:
@@ -664,21 +983,18 @@ async def on_message(message: nextcord.Message):
             temp.append(fmessage)
     formatted_history = temp
 
-    
-    # server_model, server_provider = await database.get_model_info(message.guild.id)
-    server_model_info = await database.get_model_info(message.guild.id)
-    if "|" in server_model_info:
-        server_provider, server_model = server_model_info.split("|")
-    else:
-        server_model = server_model_info
-        server_provider = "google"
-    server_system = await database.get_guild_property(message.guild.id, "system")
-    if not server_system:
-        server_system = bot_config.get("defaultSystem", "You are an assistant.")
-    server_system += "\n\nYour name is " + bot.user.name + ". Refer to users by their Display Name, not their mention username."
-    for name, display_name in temp_display_names.items():
-        server_system += f"\n{name} is displayed as {display_name}"
-
+    if summarizer.enabled:
+        if hit_break:
+            summary = None
+            await summarizer.reset(config, message.guild.id, message.channel.id)
+        else:
+            summarizer.schedule(message.guild.id, message.channel, history[-1].id, ignored_users, guild_token_limit, bypass_limits)
+    # what changes from turn to turn goes after the example, so the system prompt stays a stable
+    # prefix that providers can cache (see prompt_cache.py)
+    turn_context = [f"{name} is displayed as {display_name}" for name, display_name in temp_display_names.items()]
+    if summary:
+        turn_context.insert(0, "Summary of the conversation before these messages: " + summary)
+    formatted_history.append({"content": "SYSTEM: " + "\n".join(turn_context) + " <END>", "role": "system"})
 
     # example message to show example formatting
     formatted_history.append({"content": f"<@{bot.user.name}>: Example response! <END>", "role": "assistant"})
@@ -688,95 +1004,106 @@ async def on_message(message: nextcord.Message):
     formatted_history.append({"content": "SYSTEM: " + server_system + " <END>", "role": "system"})
 
     formatted_history.reverse()
-    usage, response = await chat_provider.generate_text(formatted_history, override_model=server_model, override_provider=server_provider, usage=True)
-
-    total_usage = sum(usage.values())
-    current_guild_usage = await database.get_guild_property(message.guild.id, "usage")
-    current_guild_usage["today"] += total_usage
-    current_guild_usage["total"] += total_usage
 
     botusername = bot.user.name
     ulen = len(botusername)
 
-    if response[:ulen+1] == f"{botusername}:":
-        response = response[ulen+1:]
-    if response[:ulen+4] == f"<@{botusername}>:":
-        response = response[ulen+4:]
-
-    response = response.replace(f"<@{botusername}>", bot.user.mention)
-
-    # match <@name> -> <@id>
-    for name, id in temp_user_names.items():
-        response = response.replace(f"<@{name}>", f"<@{id}>")
-
-    response = response.replace("@everyone", "@ everyone")
-    response = response.replace("@here", "@ here")
-    no_ping_users = await database.get_guild_property(message.guild.id, "no_ping_users", [])
-    for user in no_ping_users:
-        response = response.replace(f"<@{user['id']}>", user['name'])
-
-    await database.set_guild_property(message.guild.id, "usage", current_guild_usage)
-    if not response:
-        logging.warning("No response from AI - check stop sequences")
-        response = "..."
-    use_tts = await database.get_guild_property(message.guild.id, "tts", False)
-    if not use_tts:
-        use_tts = False
-    if len(response) > 2000:
-        # split on newlines - ADD THE NEWLINE BACK
-        response = response.split("\n")
-        temp = []
-        current = ""
-        for r in response:
-            if len(current + r) < 1500:
-                temp.append(current)
-                current = ""
-            else:
-                # do the same thing as above, but with " " instead of "\n"
-                for r_split in r.split(" "):
-                    if len(current + r_split) < 1500:
-                        current += r_split + " "
-                    else:
-                        temp.append(current)
-                        current = r_split + " "
-                temp.append(current)
-                current = ""
-            current += r + "\n"
-        temp.append(current)
-        for t in temp:
-            if not t.strip():
-                continue
-            if len(t) >= 1500:
-                logging.warning("Message too long to send")
-                logging.debug(t)
-                for i in range(0, len(t), 1500):
-                    if not t[i:i+1500]:
-                        continue
-                    await message.channel.send(t[i:i+1500], tts=use_tts)
-            await message.channel.send(t, tts=use_tts)
+    def postprocess(response):
+        if response[:ulen+1] == f"{botusername}:":
+            response = response[ulen+1:]
+        if response[:ulen+4] == f"<@{botusername}>:":
+            response = response[ulen+4:]
+        # match <@name> -> <@id>, drop pings for /peace users and defuse @everyone/@here
+        return mentions.to_mentions(response)
 
-    else:
-      try: 
-            if message.author.id in ignored_users:
-                await message.reply(response, tts=use_tts, mention_author=False)
-            else:
-                await message.reply(response, tts=use_tts)
-      except Exception as e:
-            logging.error(f"Error sending message: {e}")
+    use_tts = config.tts
+    use_cache = config.response_cache
+
+    # reserve the estimated cost up front so concurrent requests cannot overshoot the limits
+    estimate = sum(estimate_tokens(entry["content"], server_provider) for entry in formatted_history) + bot_config.get("reserveOutputTokens", 500)
+    try:
+        reservation = admission.admit(message.guild.id, server_provider, server_model, estimate, guild_token_limit, bypass_limits)
+    except AdmissionRejected as e:
+        logging.info(f"Rejected request in guild {message.guild.id}: {e}")
+        if e.scope == "guild":
+            await _send_limit_notice(message)
+        else:
+            await message.channel.send("Too many requests right now, please try again in a moment.")
+        return
+
+    usage = {}
+    started = time.monotonic()
+    try:
+        # tts only reads the first version of a message, so it never streams
+        if bot_config.get("streamResponses", True) and not use_tts:
+            reply = StreamingReply(message, postprocess, bot_config.get("streamEditInterval", 1.2), mention_author=not message.author.id in ignored_users)
             try:
-                await message.channel.send(response)
+                async for chunk in generator.generate_stream(formatted_history, override_model=server_model, override_provider=server_provider, usage_dict=usage, use_cache=use_cache):
+                    await reply.feed(chunk)
             except Exception as e:
-                logging.error(f"Error sending message: {e}")
+                logging.error(f"Error streaming response: {e}")
+                if not reply.sent:
+                    reply.text = "There was an error."
+            if not reply.text.strip():
+                logging.warning("No response from AI - check stop sequences")
+                reply.text = "..."
+            await reply.finish()
+            calibrate(server_provider, estimated_input, usage.get("input"))
+            await _add_usage(message.guild.id, usage, server_provider, server_model, time.monotonic() - started)
+            return
+
+        usage, response = await generator.generate_text(formatted_history, override_model=server_model, override_provider=server_provider, usage=True, use_cache=use_cache)
+
+        response = postprocess(response)
+        calibrate(server_provider, estimated_input, usage["input"])
+        await _add_usage(message.guild.id, usage, server_provider, server_model, time.monotonic() - started)
+        if not response.strip():
+            logging.warning("No response from AI - check stop sequences")
+            response = "..."
+        chunks = chunk_message(response)
+        send_started = time.perf_counter()
+        if len(chunks) > 1:
+            for chunk in chunks:
+                await message.channel.send(chunk, tts=use_tts)
 
-          
-    TYPING_IN_CHANNELS.remove(message.channel.id)
+        else:
+          try: 
+                if message.author.id in ignored_users:
+                    await message.reply(response, tts=use_tts, mention_author=False)
+                else:
+                    await message.reply(response, tts=use_tts)
+          except Exception as e:
+                logging.error(f"Error sending message: {e}")
+                try:
+                    await message.channel.send(response)
+                except Exception as e:
+                    logging.error(f"Error sending message: {e}")
+        metrics.DISCORD_REST.labels("send").observe(time.perf_counter() - send_started)
+    finally:
+        reservation.reconcile(usage.get("input", 0) + usage.get("output", 0))
+
+channel_queue = ChannelQueue(respond)
+
+async def _send_limit_notice(message: nextcord.Message):
+    # check if already sent message
+    if (h := await channel_history.get(message.channel, 1)):
+        if h[0].author == bot.user and h[0].content == "You have reached the token limit for today.":
+            return
+    logging.info(f"Token limit reached for guild {message.guild.id} ({message.guild.name})")
+    await message.channel.send("You have reached the token limit for today.")
+
+async def _add_usage(guild_id, usage, provider, model, latency):
+    usage_ledger.record(guild_id, provider, model, usage.get("input", 0), usage.get("output", 0), latency, usage.get("cached", 0))
+    # cached tokens are already part of input
+    await database.add_usage(guild_id, usage.get("input", 0) + usage.get("output", 0))
+
+summarizer = Summarizer(generator, database, channel_history, SUMMARIES, _add_usage, admission)
 
 async def _reset_usage():
-    for guild in list(database.data.get("guilds", {}).keys()):
-        current_guild_usage = await database.get_guild_property(guild, "usage", {"today": 0, "total": 0})
-        current_guild_usage["today"] = 0
-        await database.set_guild_property(guild, "usage", current_guild_usage)
-    database.save()
+    # every process resets its own ledger totals, the shared database only needs it once
+    if SHARD_PROCESS == "0":
+        await database.reset_daily_usage()
+    usage_ledger.reset_today()
 
 # reset daily usage at midnight
 @tasks.loop(time=datetime.time(hour=0, minute=0))
@@ -787,6 +1114,13 @@ async def reset_usage():
 async def before_reset_usage():
     await bot.wait_until_ready()
 
-reset_usage.start()
-change_presence.start()
-bot.run(os.getenv("TOKEN"))
\ No newline at end of file
+# importing bot (e.g. from benchmarks/pipeline.py) sets everything up without connecting
+if __name__ == "__main__":
+    reset_usage.start()
+    change_presence.start()
+    bot.run(os.getenv("TOKEN"))
+    # write out anything the write-behind task has not flushed yet
+    database.close()
+    usage_ledger.close()
+    if worker_pool is not None:
+        worker_pool.close()
\ No newline at end of file
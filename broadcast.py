@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import time
+
+from admission import TokenBucket
+from metrics import DISCORD_REST
+
+# sends one message to many guilds' ai channels (/hidden sendall, sendguild).
+# a fixed number of workers pull targets off a queue and every send takes from one bucket kept under
+# discord's global limit (50 requests/s per bot). each target is a different channel and so a different
+# route bucket; a 429 holds that route back for its retry_after (or every route, for a global 429)
+# and the target is tried again, other errors (missing permissions, deleted channel) are reported
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def channel_targets(channels, guilds, resolve):
+    # channels: {guild_id: channel_id} from one database query, guilds: shared_state.guilds()
+    # -> ([(guild_id, name, channel)], guilds without an ai channel)
+    targets = []
+    skipped = 0
+    for guild_id, name, _, _ in guilds:
+        channel_id = channels.get(str(guild_id))
+        channel = resolve(channel_id) if channel_id else None
+        if channel is None:
+            skipped += 1
+            continue
+        targets.append((str(guild_id), name, channel))
+    return targets, skipped
+
+
+def _rate_limit(error):
+    # -> (retry_after seconds, global) for a 429, otherwise None
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    retry_after = getattr(error, "retry_after", None) or headers.get("Retry-After")
+    if getattr(error, "status", None) != 429 and retry_after is None:
+        return None
+    is_global = headers.get("X-RateLimit-Global") == "true" or headers.get("X-RateLimit-Scope") == "global"
+    return float(retry_after or 1), is_global
+
+
+class Broadcast():
+    def __init__(self, targets, message, workers=8, rate=40, attempts=3, skipped=0):
+        self.targets = targets
+        self.message = message
+        self.workers = max(1, workers)
+        self.bucket = TokenBucket(rate, rate)
+        self.attempts = attempts
+        self.skipped = skipped
+        self.sent = 0
+        self.failures = [] # (guild_id, name, reason)
+        self.retries = 0
+        self.routes = {} # channel id -> monotonic time its bucket resets
+        self.paused_until = 0 # a global 429 holds every worker
+        self.started = None
+        self.finished = None
+
+    @property
+    def done(self):
+        return self.sent + len(self.failures)
+
+    async def _take(self, route):
+        while True:
+            now = time.monotonic()
+            wait = max(self.paused_until, self.routes.get(route, 0)) - now
+            if wait <= 0:
+                if self.bucket.can_take(1):
+                    self.bucket.take(1)
+                    return
+                wait = (1 - self.bucket.available()) / self.bucket.refill_per_second
+            await asyncio.sleep(wait)
+
+    async def _send(self, guild_id, name, channel):
+        route = getattr(channel, "id", guild_id)
+        for attempt in range(self.attempts):
+            await self._take(route)
+            started = time.perf_counter()
+            try:
+                await channel.send(self.message)
+                DISCORD_REST.labels("send").observe(time.perf_counter() - started)
+                self.sent += 1
+                return
+            except Exception as e:
+                limited = _rate_limit(e)
+                if limited:
+                    retry_after, is_global = limited
+                    until = time.monotonic() + retry_after
+                    if is_global:
+                        self.paused_until = max(self.paused_until, until)
+                    else:
+                        self.routes[route] = until
+                elif getattr(e, "status", None) in RETRY_STATUS:
+                    self.routes[route] = time.monotonic() + attempt + 1
+                else:
+                    self.failures.append((guild_id, name, str(e) or type(e).__name__))
+                    return
+                if attempt == self.attempts - 1:
+                    self.failures.append((guild_id, name, str(e) or type(e).__name__))
+                    return
+                self.retries += 1
+
+    async def _worker(self, queue):
+        while True:
+            try:
+                guild_id, name, channel = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await self._send(guild_id, name, channel)
+
+    async def _report(self, progress, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await self._progress(progress)
+
+    async def _progress(self, progress):
+        try:
+            await progress(self)
+        except Exception as e:
+            logging.warning(f"Could not report broadcast progress: {e}")
+
+    async def run(self, progress=None, interval=3):
+        # progress: async callable given this broadcast every interval seconds and once at the end
+        self.started = time.monotonic()
+        queue = asyncio.Queue()
+        for target in self.targets:
+            queue.put_nowait(target)
+        reporter = asyncio.create_task(self._report(progress, interval)) if progress else None
+        try:
+            await asyncio.gather(*(self._worker(queue) for _ in range(min(self.workers, len(self.targets)))))
+        finally:
+            self.finished = time.monotonic()
+            if reporter is not None:
+                reporter.cancel()
+        logging.info(f"Broadcast sent to {self.sent}/{len(self.targets)} channels, {len(self.failures)} failed, {self.retries} retries")
+        if progress:
+            await self._progress(progress)
+        return self
+
+    def summary(self, max_failures=15):
+        elapsed = (self.finished or time.monotonic()) - self.started if self.started else 0
+        state = "Sent" if self.finished else "Sending"
+        lines = [f"{state}: {self.sent}/{len(self.targets)} channels, {len(self.failures)} failed, {self.skipped} without an AI channel ({elapsed:.1f}s)"]
+        for guild_id, name, reason in self.failures[-max_failures:]:
+            lines.append(f"- {name} ({guild_id}): {reason[:120]}")
+        if len(self.failures) > max_failures:
+            lines.insert(1, f"Last {max_failures} failures:")
+        return "\n".join(lines)[:2000]
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+import time
+
+from metrics import MESSAGE_LATENCY
+
+
+class ChannelQueue():
+    # one worker per channel: messages that arrive while a reply is generating are
+    # coalesced into a single follow-up turn instead of being dropped
+    def __init__(self, handler):
+        self.handler = handler
+        self.pending = {} # channel_id -> messages waiting for the next turn
+        self.workers = {} # channel_id -> worker task
+        self.started = {} # channel_id -> monotonic start of the generation in flight
+        self.arrived = {} # channel_id -> when the oldest pending message was queued
+
+    def submit(self, message):
+        channel_id = message.channel.id
+        self.pending.setdefault(channel_id, []).append(message)
+        self.arrived.setdefault(channel_id, time.monotonic())
+        if channel_id not in self.workers:
+            self.workers[channel_id] = asyncio.create_task(self._work(channel_id))
+
+    def __contains__(self, channel_id):
+        return channel_id in self.workers
+
+    async def _work(self, channel_id):
+        try:
+            while self.pending.get(channel_id):
+                messages = self.pending.pop(channel_id)
+                arrived = self.arrived.pop(channel_id)
+                if len(messages) > 1:
+                    logging.debug(f"Coalesced {len(messages)} messages in channel {channel_id}")
+                self.started[channel_id] = time.monotonic()
+                try:
+                    # the newest message is answered; the earlier ones are part of its history. by id, not by
+                    # arrival: on_message awaits the guild config first, so submits can come in out of order
+                    await self.handler(max(messages, key=lambda message: message.id))
+                    MESSAGE_LATENCY.observe(time.monotonic() - arrived)
+                except Exception as e:
+                    logging.exception(f"Error responding in channel {channel_id}: {e}")
+                finally:
+                    self.started.pop(channel_id, None)
+        finally:
+            self.workers.pop(channel_id, None)
+            self.started.pop(channel_id, None)
+            self.arrived.pop(channel_id, None)
+
+    def depths(self):
+        # for the queue depth gauge: ((channel_id,), queued) per busy channel
+        return [((str(channel_id),), len(messages)) for channel_id, messages in self.pending.items()]
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            channel_id: {
+                "queued": len(self.pending.get(channel_id, [])),
+                "in_flight": now - self.started[channel_id] if channel_id in self.started else None,
+            }
+            for channel_id in self.workers
+        }
@@ -0,0 +1,71 @@
+MESSAGE_LIMIT = 2000
+FENCE = "```"
+
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    # split a reply into discord-sized pieces in one pass over its lines -> [(head, body, tail)].
+    # the bodies are consecutive slices of text; head and tail are what the split added: a code block
+    # cut in two is closed at the end of one piece (tail) and reopened, with its language tag, at the
+    # start of the next (head). breaks on newlines, then spaces, then anywhere
+    pieces = []
+    current = []
+    size = 0
+    head = "" # the reopened fence at the start of current, not real content
+    fence = None # opening fence line while inside a code block
+
+    def close():
+        nonlocal current, size, head
+        if current:
+            body = "".join(current)
+            tail = ""
+            if fence is not None:
+                tail = ("" if body.endswith("\n") else "\n") + FENCE
+            pieces.append((head, body, tail))
+        current = []
+        size = 0
+        head = ""
+        if fence is not None:
+            head = fence + "\n"
+            size = len(head)
+
+    for line in text.splitlines(keepends=True):
+        stripped = line.strip()
+        # a line like ```x``` opens and closes on its own; overly long "fences" are just text
+        is_fence = stripped.startswith(FENCE) and stripped.count(FENCE) % 2 == 1 and len(stripped) <= 100
+        if is_fence and fence is not None:
+            if size + len(line) > limit:
+                close()
+            current.append(line)
+            size += len(line)
+            fence = None
+            continue
+        # room for a closing fence has to stay free while a block is open
+        reserve = len(FENCE) + 1 if fence is not None or is_fence else 0
+        if size + len(line) + reserve > limit and current:
+            close()
+        # a long line is cut at offsets into it, so each part is sliced once (no copying the rest each time)
+        start = 0
+        while size + len(line) - start + reserve > limit:
+            room = limit - size - reserve
+            cut = line.rfind(" ", start, start + room)
+            cut = cut + 1 if cut > start else start + room
+            current.append(line[start:cut])
+            size += cut - start
+            start = cut
+            close()
+        current.append(line[start:])
+        size += len(line) - start
+        if is_fence:
+            fence = stripped
+    close()
+    return pieces
+
+
+def chunk_message(text, limit=MESSAGE_LIMIT):
+    # the messages to send; pieces that are only whitespace cannot be sent and are skipped
+    chunks = []
+    for head, body, tail in split_message(text, limit):
+        chunk = head + body + tail
+        if chunk.strip():
+            chunks.append(chunk)
+    return chunks
@@ -1,8 +1,15 @@
-# TODO: switch to sqlite3 instead of just JSON
+import asyncio
 import json
+import os
+import sqlite3
+import threading
+import time
 from asyncio import to_thread
 import logging
 
+from guild_config import GuildConfig
+from metrics import DATABASE_FLUSH, DATABASE_FLUSH_BYTES
+
 """
 {
 "token_limit": 1000,
@@ -21,10 +28,33 @@ import logging
 
 """
 
+def _write_atomic(path, text):
+    # write to a temp file next to the target, fsync it, then rename over the old file
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
 class BotDatabase():
-    def __init__(self, path):
+    def __init__(self, path, write_behind_ms=0, write_behind_max_pending=50):
         self.path = path
         self.data = self.load()
+        # write-behind: mutations only mark guilds dirty, a background task flushes them
+        self.write_behind_ms = write_behind_ms
+        self.write_behind_max_pending = write_behind_max_pending
+        self.dirty_guilds = set()
+        self.pending = 0
+        # guild_id -> serialized guild, only dirty guilds are re-serialized on flush
+        self.fragments = None
+        self.flush_task = None
+        self.flush_lock = asyncio.Lock()
+        self.dirty_event = asyncio.Event()
+        self.full_event = asyncio.Event()
+        self.configs = {}
+        self.config_version = 0
 
     def load(self):
         try:
@@ -32,25 +62,138 @@ class BotDatabase():
                 return json.load(f)
         except FileNotFoundError:
             return {}
-        
-    def save(self):
-        with open(self.path, "w") as f:
-            f.write(json.dumps(self.data, indent=2))
+
+    def save(self, guild_id=None):
+        # guild_id=None means anything may have changed
+        self.invalidate_config(guild_id)
+        if guild_id is None:
+            self.dirty_guilds.update(self.data.get("guilds", {}).keys())
+            self.fragments = None
+        else:
+            self.dirty_guilds.add(str(guild_id))
+        self.pending += 1
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.write()
+            return
+        if not self.write_behind_ms:
+            self.write()
+            return
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_loop())
+        self.dirty_event.set()
+        if self.pending >= self.write_behind_max_pending:
+            self.full_event.set()
+
+    def _snapshot(self):
+        # runs on the loop: re-serialize only what changed, the worker thread joins the pieces
+        guilds = self.data.get("guilds", {})
+        if self.fragments is None:
+            self.fragments = dict.fromkeys(guilds.keys())
+            self.dirty_guilds = set(guilds.keys())
+        for guild_id in self.dirty_guilds:
+            if guild_id in guilds:
+                self.fragments[guild_id] = json.dumps(guilds[guild_id])
+            else:
+                self.fragments.pop(guild_id, None)
+        top_level = {key: value for key, value in self.data.items() if key != "guilds"}
+        flushed = self.dirty_guilds
+        self.dirty_guilds = set()
+        self.pending = 0
+        self.dirty_event.clear()
+        self.full_event.clear()
+        return json.dumps(top_level), list(self.fragments.items()), flushed
+
+    @staticmethod
+    def _render(top_level, fragments):
+        guilds = "{" + ", ".join(f"{json.dumps(guild_id)}: {fragment}" for guild_id, fragment in fragments) + "}"
+        if top_level == "{}":
+            return '{"guilds": ' + guilds + "}"
+        return top_level[:-1] + ', "guilds": ' + guilds + "}"
+
+    def _write_snapshot(self, top_level, fragments):
+        text = self._render(top_level, fragments)
+        _write_atomic(self.path, text)
+        return len(text)
+
+    def write(self):
+        # synchronous flush, used when there is no running loop or write-behind is off
+        if not self.pending:
+            return
+        top_level, fragments, _ = self._snapshot()
+        self._write_snapshot(top_level, fragments)
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.pending:
+                return
+            top_level, fragments, flushed = self._snapshot()
+            started = time.perf_counter()
+            try:
+                size = await to_thread(self._write_snapshot, top_level, fragments)
+            except Exception as e:
+                logging.error(f"Error flushing database: {e}")
+                self.dirty_guilds |= flushed
+                self.pending += 1
+                raise
+            DATABASE_FLUSH.labels("json").observe(time.perf_counter() - started)
+            DATABASE_FLUSH_BYTES.observe(size)
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.dirty_event.wait()
+            deadline = loop.time() + self.write_behind_ms / 1000
+            while self.pending < self.write_behind_max_pending and (remaining := deadline - loop.time()) > 0:
+                try:
+                    await asyncio.wait_for(self.full_event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self.flush()
+            except Exception:
+                await asyncio.sleep(self.write_behind_ms / 1000)
+
+    def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        self.write()
+
+    def invalidate_config(self, guild_id=None):
+        self.config_version += 1
+        if guild_id is None:
+            self.configs.clear()
+        else:
+            self.configs.pop(str(guild_id), None)
+
+    async def get_config(self, guild_id):
+        guild_id = str(guild_id)
+        config = self.configs.get(guild_id)
+        if config is None:
+            version = self.config_version
+            config = GuildConfig(guild_id, await self.get_guild(guild_id))
+            # a write that landed while the guild was read would leave this snapshot stale
+            if version == self.config_version:
+                self.configs[guild_id] = config
+        return config
 
     async def get_guild(self, guild_id):
         return self.data.get("guilds", {}).get(str(guild_id), {})
-    
+
+    async def get_guilds(self):
+        return self.data.get("guilds", {})
+
     async def set_guild(self, guild_id, data):
         self.data["guilds"] = self.data.get("guilds", {})
         self.data["guilds"][str(guild_id)] = data
-        self.save()
+        self.save(guild_id)
 
     async def set_guild_property(self, guild_id, key, value):
         guild = await self.get_guild(guild_id)
         guild[key] = value
         await self.set_guild(guild_id, guild)
-        self.save()
-    
+
     async def append_guild_property(self, guild_id, key, value):
         guild = await self.get_guild(guild_id)
         guild[key] = guild.get(key, [])
@@ -62,7 +205,6 @@ class BotDatabase():
             logging.error(e)
             return f"Fatal error: {e}"
         await self.set_guild(guild_id, guild)
-        self.save()
 
     async def remove_item_guild_property(self, guild_id, key, value):
         guild = await self.get_guild(guild_id)
@@ -75,12 +217,322 @@ class BotDatabase():
             logging.error(e)
             return f"Fatal error: {e}"
         await self.set_guild(guild_id, guild)
-        self.save()
-        
+
+    async def update_guild_property(self, guild_id, key, change):
+        # change(current value or None) -> new value; nothing else writes the guild in between
+        guild = await self.get_guild(guild_id)
+        guild[key] = change(guild.get(key))
+        await self.set_guild(guild_id, guild)
+
 
     async def get_guild_property(self, guild_id, key, default=None):
         return (await self.get_guild(guild_id)).get(key, default)
 
+    async def add_usage(self, guild_id, tokens):
+        usage = await self.get_guild_property(guild_id, "usage") or {"today": 0, "total": 0}
+        usage["today"] = usage.get("today", 0) + tokens
+        usage["total"] = usage.get("total", 0) + tokens
+        await self.set_guild_property(guild_id, "usage", usage)
+
+    async def watch_changes(self, interval=0.25):
+        pass # only this process writes the json file
+
     async def get_model_info(self, guild_id) -> str:
         return (await self.get_guild(guild_id)).get("model")
-    
\ No newline at end of file
+
+    async def get_usage_totals(self):
+        guilds = (await self.get_guilds()).values()
+        today = sum(guild.get("usage", {}).get("today", 0) for guild in guilds)
+        total = sum(guild.get("usage", {}).get("total", 0) for guild in guilds)
+        return {"today": today, "total": total}
+
+    async def get_guild_by_channel(self, channel_id):
+        return next((guild_id for guild_id, guild in (await self.get_guilds()).items() if guild.get("channel_id") == channel_id), None)
+
+    async def get_channels(self):
+        # {guild_id: channel_id} for every guild with an ai channel
+        return {guild_id: guild["channel_id"] for guild_id, guild in (await self.get_guilds()).items() if guild.get("channel_id")}
+
+    async def reset_daily_usage(self):
+        for guild_id, guild in (await self.get_guilds()).items():
+            if "usage" in guild:
+                guild["usage"]["today"] = 0
+        self.save()
+
+
+# the hot guild properties get real (indexed) columns, everything else lives in the json blob
+# a NULL column means the key was never set, so get_guild returns the same shape as the json store
+FLAG_COLUMNS = ["bypass_limits", "tts", "see_bots"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS guilds (
+    guild_id TEXT PRIMARY KEY,
+    channel_id INTEGER,
+    usage_today INTEGER,
+    usage_total INTEGER,
+    bypass_limits INTEGER,
+    tts INTEGER,
+    see_bots INTEGER,
+    data TEXT NOT NULL DEFAULT '{}',
+    changed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS guilds_channel_id ON guilds (channel_id);
+CREATE INDEX IF NOT EXISTS guilds_usage_today ON guilds (usage_today);
+CREATE INDEX IF NOT EXISTS guilds_flags ON guilds (bypass_limits, tts, see_bots);
+CREATE INDEX IF NOT EXISTS guilds_changed ON guilds (changed);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+# stamps a guild row on every write to its settings; writes are serialized, so stamps only go up and
+# watch_changes can ask for the rows written since the last stamp it saw
+NEXT_CHANGE = "(SELECT COALESCE(MAX(changed), 0) + 1 FROM guilds)"
+
+
+def _row_to_guild(row):
+    channel_id, usage_today, usage_total, bypass_limits, tts, see_bots, data = row
+    guild = json.loads(data)
+    if channel_id is not None:
+        guild["channel_id"] = channel_id
+    if usage_today is not None:
+        guild["usage"] = {"today": usage_today, "total": usage_total or 0}
+    for key, value in zip(FLAG_COLUMNS, (bypass_limits, tts, see_bots)):
+        if value is not None:
+            guild[key] = bool(value)
+    return guild
+
+
+def _guild_to_row(guild_id, guild):
+    guild = dict(guild)
+    # an explicit None (e.g. from /disable) stays in the blob so the key round-trips
+    channel_id = guild.pop("channel_id") if guild.get("channel_id") is not None else None
+    usage = guild.pop("usage") if guild.get("usage") is not None else None
+    flags = [int(bool(guild.pop(key))) if guild.get(key) is not None else None for key in FLAG_COLUMNS]
+    return (
+        str(guild_id),
+        channel_id,
+        usage.get("today", 0) if usage is not None else None,
+        usage.get("total", 0) if usage is not None else None,
+        *flags,
+        json.dumps(guild),
+    )
+
+
+class SQLiteBotDatabase(BotDatabase):
+    def __init__(self, path):
+        self.path = path
+        # queries run in worker threads, the lock keeps the shared connection to one at a time
+        self.lock = threading.Lock()
+        # shard processes may share the file, so wait for their write locks instead of failing
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+        self.connection.executescript(SCHEMA)
+        self.configs = {}
+        self.config_version = 0
+
+    def _migrate(self):
+        # files from before the changed column; it has to exist before SCHEMA indexes it
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(guilds)")]
+        if columns and "changed" not in columns:
+            self.connection.execute("ALTER TABLE guilds ADD COLUMN changed INTEGER NOT NULL DEFAULT 0")
+
+    def _execute(self, query, params=(), fetch=None):
+        with self.lock:
+            cursor = self.connection.execute(query, params)
+            if fetch == "one":
+                return cursor.fetchone()
+            if fetch == "all":
+                return cursor.fetchall()
+
+    def _write_guilds(self, rows):
+        started = time.perf_counter()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany(
+                    f"INSERT OR REPLACE INTO guilds (guild_id, channel_id, usage_today, usage_total, bypass_limits, tts, see_bots, data, changed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, {NEXT_CHANGE})",
+                    rows,
+                )
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        DATABASE_FLUSH.labels("sqlite").observe(time.perf_counter() - started)
+
+    def _property_update(self, key, value):
+        # -> (SET clause, params) writing only key: its own column, or its field in the json blob
+        if key == "usage":
+            if value is not None:
+                return "usage_today = ?, usage_total = ?, data = json_remove(data, '$.usage')", (value.get("today", 0), value.get("total", 0))
+            return "usage_today = NULL, usage_total = NULL, data = json_set(data, '$.usage', json('null'))", ()
+        if key == "channel_id" or key in FLAG_COLUMNS:
+            if value is not None:
+                column_value = value if key == "channel_id" else int(bool(value))
+                return f"{key} = ?, data = json_remove(data, '$.{key}')", (column_value,)
+            # an explicit None stays in the blob, as in _guild_to_row
+            return f"{key} = NULL, data = json_set(data, '$.{key}', json('null'))", ()
+        return "data = json_set(data, ?, json(?))", (f'$."{key}"', json.dumps(value))
+
+    def _update_property(self, guild_id, key, change):
+        # change(guild) -> new value of key. the read and the write share one write transaction and only key is
+        # written back, so nothing another writer changed in between (add_usage especially) is overwritten
+        started = time.perf_counter()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute("INSERT OR IGNORE INTO guilds (guild_id) VALUES (?)", (str(guild_id),))
+                row = self.connection.execute("SELECT channel_id, usage_today, usage_total, bypass_limits, tts, see_bots, data FROM guilds WHERE guild_id = ?", (str(guild_id),)).fetchone()
+                assignments, params = self._property_update(key, change(_row_to_guild(row)))
+                self.connection.execute(f"UPDATE guilds SET {assignments}, changed = {NEXT_CHANGE} WHERE guild_id = ?", (*params, str(guild_id)))
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        DATABASE_FLUSH.labels("sqlite").observe(time.perf_counter() - started)
+
+    async def set_guild_property(self, guild_id, key, value):
+        await to_thread(self._update_property, guild_id, key, lambda guild: value)
+        self.invalidate_config(guild_id)
+
+    async def update_guild_property(self, guild_id, key, change):
+        await to_thread(self._update_property, guild_id, key, lambda guild: change(guild.get(key)))
+        self.invalidate_config(guild_id)
+
+    async def append_guild_property(self, guild_id, key, value):
+        def append(guild):
+            current = guild.get(key, [])
+            try:
+                current.append(value)
+            except AttributeError:
+                current = value
+            return current
+        try:
+            await to_thread(self._update_property, guild_id, key, append)
+        except Exception as e:
+            logging.error(e)
+            return f"Fatal error: {e}"
+        self.invalidate_config(guild_id)
+
+    async def remove_item_guild_property(self, guild_id, key, value):
+        def remove(guild):
+            current = guild.get(key, [])
+            try:
+                current.remove(value)
+            except AttributeError:
+                current = value
+            return current
+        try:
+            await to_thread(self._update_property, guild_id, key, remove)
+        except Exception as e:
+            logging.error(e)
+            return f"Fatal error: {e}"
+        self.invalidate_config(guild_id)
+
+    def load(self):
+        return {}
+
+    def save(self, guild_id=None):
+        pass # every write is committed as it happens
+
+    async def flush(self):
+        pass
+
+    async def get_guild(self, guild_id):
+        row = await to_thread(self._execute, "SELECT channel_id, usage_today, usage_total, bypass_limits, tts, see_bots, data FROM guilds WHERE guild_id = ?", (str(guild_id),), "one")
+        return _row_to_guild(row) if row else {}
+
+    async def get_guilds(self):
+        rows = await to_thread(self._execute, "SELECT guild_id, channel_id, usage_today, usage_total, bypass_limits, tts, see_bots, data FROM guilds", (), "all")
+        return {row[0]: _row_to_guild(row[1:]) for row in rows}
+
+    async def set_guild(self, guild_id, data):
+        await to_thread(self._write_guilds, [_guild_to_row(guild_id, data)])
+        self.invalidate_config(guild_id)
+
+    async def get_usage_totals(self):
+        today, total = await to_thread(self._execute, "SELECT COALESCE(SUM(usage_today), 0), COALESCE(SUM(usage_total), 0) FROM guilds", (), "one")
+        return {"today": today, "total": total}
+
+    async def reset_daily_usage(self):
+        await to_thread(self._execute, f"UPDATE guilds SET usage_today = 0, changed = {NEXT_CHANGE} WHERE usage_today IS NOT NULL")
+        self.invalidate_config()
+
+    async def add_usage(self, guild_id, tokens):
+        # a single statement, so shard processes sharing the file never lose each other's increments.
+        # changed is left alone: only the process that owns the guild's shard adds to its usage, and it
+        # drops its own cached config below, so the other processes have nothing to reload
+        started = time.perf_counter()
+        await to_thread(self._execute, "UPDATE guilds SET usage_today = COALESCE(usage_today, 0) + ?, usage_total = COALESCE(usage_total, 0) + ? WHERE guild_id = ?", (tokens, tokens, str(guild_id)))
+        DATABASE_FLUSH.labels("sqlite").observe(time.perf_counter() - started)
+        self.invalidate_config(guild_id)
+
+    def _data_version(self):
+        return self._execute("PRAGMA data_version", (), "one")[0]
+
+    def _last_change(self):
+        return self._execute("SELECT COALESCE(MAX(changed), 0) FROM guilds", (), "one")[0]
+
+    def _changed_since(self, change):
+        return self._execute("SELECT guild_id, changed FROM guilds WHERE changed > ?", (change,), "all")
+
+    async def watch_changes(self, interval=0.25):
+        # data_version moves when another connection (another shard process) commits to the file;
+        # the guilds whose settings were written since the last look have their cached GuildConfig
+        # dropped then, so no process serves settings older than interval. usage-only writes do not count
+        version = await to_thread(self._data_version)
+        change = await to_thread(self._last_change)
+        while True:
+            await asyncio.sleep(interval)
+            current = await to_thread(self._data_version)
+            if current == version:
+                continue
+            version = current
+            for guild_id, guild_change in await to_thread(self._changed_since, change):
+                self.invalidate_config(guild_id)
+                change = max(change, guild_change)
+
+    async def get_guild_by_channel(self, channel_id):
+        row = await to_thread(self._execute, "SELECT guild_id FROM guilds WHERE channel_id = ?", (channel_id,), "one")
+        return row[0] if row else None
+
+    async def get_channels(self):
+        rows = await to_thread(self._execute, "SELECT guild_id, channel_id FROM guilds WHERE channel_id IS NOT NULL", (), "all")
+        return dict(rows)
+
+    def import_json(self, json_path):
+        # one-shot import of an existing data.json, existing rows for the same guild are replaced
+        with open(json_path) as f:
+            data = json.load(f)
+        guilds = data.pop("guilds", {})
+        self._write_guilds([_guild_to_row(guild_id, guild) for guild_id, guild in guilds.items()])
+        for key, value in data.items():
+            self._execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+        logging.info(f"Imported {len(guilds)} guilds from {json_path} into {self.path}")
+        return len(guilds)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def open_database(engine="json", path=None, write_behind_ms=0, write_behind_max_pending=50):
+    if engine == "sqlite":
+        return SQLiteBotDatabase(path or "data.db")
+    return BotDatabase(path or "data.json", write_behind_ms=write_behind_ms, write_behind_max_pending=write_behind_max_pending)
+
+
+if __name__ == "__main__":
+    # python database.py data.json data.db
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 3:
+        print("Usage: python database.py <data.json> <data.db>")
+        sys.exit(1)
+    database = SQLiteBotDatabase(sys.argv[2])
+    database.import_json(sys.argv[1])
+    database.close()
@@ -0,0 +1,40 @@
+class GuildConfig():
+    # read-only snapshot of one guild's settings, built once per write instead of walking the
+    # guild dict for every property a message needs. BotDatabase.get_config caches these
+    __slots__ = (
+        "guild_id", "channel_id", "model", "system", "has_usage", "usage_today", "usage_total",
+        "bypass_limits", "token_limit", "context_length", "context_tokens", "tts", "see_bots",
+        "response_cache", "ignored_users", "no_ping_users", "summaries",
+    )
+
+    def __init__(self, guild_id, guild):
+        usage = guild.get("usage") or {}
+        values = {
+            "guild_id": str(guild_id),
+            "channel_id": guild.get("channel_id"),
+            "model": guild.get("model"),
+            "system": guild.get("system"),
+            "has_usage": bool(usage),
+            "usage_today": usage.get("today", 0),
+            "usage_total": usage.get("total", 0),
+            "bypass_limits": bool(guild.get("bypass_limits")),
+            "token_limit": guild.get("token_limit"),
+            "context_length": guild.get("context_length"),
+            "context_tokens": guild.get("context_tokens"),
+            "tts": bool(guild.get("tts")),
+            "see_bots": bool(guild.get("see_bots")),
+            "response_cache": guild.get("response_cache", True),
+            "ignored_users": frozenset(guild.get("ignored_users") or ()),
+            # str(id) -> plain name, the shape MentionTranslator looks ids up in
+            "no_ping_users": {str(user["id"]): user["name"] for user in guild.get("no_ping_users") or ()},
+            # str(channel_id) -> {"text", "through"}, see summaries.py
+            "summaries": dict(guild.get("summaries") or {}),
+        }
+        for key, value in values.items():
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("GuildConfig is read-only, write through the database instead")
+
+    def __repr__(self):
+        return f"GuildConfig({self.guild_id}, channel_id={self.channel_id}, model={self.model})"
@@ -0,0 +1,57 @@
+import collections
+
+
+class LatencyTracker():
+    # recent latencies for one model, used to decide when a call counts as slow
+    def __init__(self, size=200):
+        self.samples = collections.deque(maxlen=size)
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, p):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(len(ordered) * p / 100))
+        return ordered[index]
+
+    def __len__(self):
+        return len(self.samples)
+
+
+class HedgeBudget():
+    # caps hedged requests to max_rate of the last `window` requests, bounding the extra spend
+    def __init__(self, max_rate=0.05, window=200):
+        self.max_rate = max_rate
+        self.decisions = collections.deque(maxlen=window)
+        self.recent_hedges = 0
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0 # hedges that answered first
+
+    def record(self, hedged):
+        if len(self.decisions) == self.decisions.maxlen and self.decisions[0]:
+            self.recent_hedges -= 1
+        self.decisions.append(hedged)
+        self.requests += 1
+        if hedged:
+            self.recent_hedges += 1
+            self.hedges += 1
+
+    def record_win(self):
+        # the hedge answered before the primary
+        self.wins += 1
+
+    def allow(self):
+        allowed = (self.recent_hedges + 1) / (len(self.decisions) + 1) <= self.max_rate
+        self.record(allowed)
+        return allowed
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "wins": self.wins,
+            "recent_rate": self.recent_hedges / len(self.decisions) if self.decisions else 0,
+        }
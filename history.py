@@ -0,0 +1,136 @@
+import asyncio
+import collections
+import logging
+import time
+
+from metrics import DISCORD_REST
+from tokens import estimate_tokens
+
+
+class ChannelHistory():
+    # bounded per-channel message buffer so context building does not hit REST on every message
+    # buffers hold nextcord Messages oldest first; get() returns newest first like channel.history()
+    def __init__(self, size=50, max_channels=1000):
+        self.size = size
+        self.max_channels = max_channels
+        self.buffers = collections.OrderedDict() # channel_id -> deque
+        # channel_id -> True if the seed fetch returned everything the channel has
+        self.complete = {}
+        # channel_id -> messages that arrived while the seed fetch was in flight
+        self.seeding = {}
+        self.locks = {}
+        # message_id -> {provider: token estimate}, dropped when the message changes or leaves the buffer
+        self.token_counts = {}
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, message):
+        channel_id = message.channel.id
+        if channel_id in self.seeding:
+            self.seeding[channel_id].append(message)
+            return
+        buffer = self.buffers.get(channel_id)
+        if buffer is None:
+            return # not seeded yet, the first fetch will include it
+        if any(cached.id == message.id for cached in buffer):
+            return
+        if len(buffer) == buffer.maxlen:
+            self.complete[channel_id] = False # the oldest message falls off
+            self._forget_tokens(buffer[0].id)
+        buffer.append(message)
+
+    def edit(self, message):
+        buffer = self.buffers.get(message.channel.id)
+        if buffer is None:
+            return
+        for i, cached in enumerate(buffer):
+            if cached.id == message.id:
+                buffer[i] = message
+                self._forget_tokens(message.id)
+                return
+
+    def remove(self, message):
+        buffer = self.buffers.get(message.channel.id)
+        if buffer is None:
+            return
+        for cached in buffer:
+            if cached.id == message.id:
+                buffer.remove(cached)
+                self._forget_tokens(message.id)
+                return
+
+    def invalidate(self, channel_id=None):
+        # after a gateway gap we may have missed events, so drop everything and reseed lazily
+        if channel_id is None:
+            self.buffers.clear()
+            self.complete.clear()
+            self.token_counts.clear()
+            return
+        for message in self.buffers.pop(channel_id, []):
+            self._forget_tokens(message.id)
+        self.complete.pop(channel_id, None)
+
+    def _forget_tokens(self, message_id):
+        self.token_counts.pop(message_id, None)
+
+    def tokens(self, message, provider=None):
+        # estimate is computed once per message and provider
+        if message.channel.id not in self.buffers:
+            return estimate_tokens(f"<@{message.author.name}>: {message.content} <END>", provider)
+        counts = self.token_counts.setdefault(message.id, {})
+        count = counts.get(provider)
+        if count is None:
+            count = counts[provider] = estimate_tokens(f"<@{message.author.name}>: {message.content} <END>", provider)
+        return count
+
+    def peek(self, channel_id, limit):
+        # cached messages only, never touches REST
+        buffer = self.buffers.get(channel_id)
+        if buffer is None:
+            return []
+        return list(reversed(buffer))[:limit]
+
+    async def _seed(self, channel):
+        self.seeding[channel.id] = []
+        started = time.perf_counter()
+        try:
+            fetched = await channel.history(limit=self.size).flatten()
+            DISCORD_REST.labels("history").observe(time.perf_counter() - started)
+        except Exception:
+            self.seeding.pop(channel.id, None)
+            raise
+        late = self.seeding.pop(channel.id)
+        fetched.reverse()
+        buffer = collections.deque(fetched, maxlen=self.size)
+        self.buffers[channel.id] = buffer
+        self.complete[channel.id] = len(fetched) < self.size
+        for message in late:
+            self.add(message)
+        while len(self.buffers) > self.max_channels:
+            evicted, evicted_buffer = self.buffers.popitem(last=False)
+            self.complete.pop(evicted, None)
+            for evicted_message in evicted_buffer:
+                self._forget_tokens(evicted_message.id)
+        logging.debug(f"Seeded history for channel {channel.id} with {len(fetched)} messages")
+
+    async def get(self, channel, limit):
+        if limit > self.size:
+            # larger than we keep around, go straight to REST
+            self.misses += 1
+            started = time.perf_counter()
+            fetched = await channel.history(limit=limit).flatten()
+            DISCORD_REST.labels("history").observe(time.perf_counter() - started)
+            return fetched
+        buffer = self.buffers.get(channel.id)
+        if buffer is None or (len(buffer) < limit and not self.complete.get(channel.id)):
+            # never seeded, or deletions left us short of what the channel actually has
+            self.misses += 1
+            self.buffers.pop(channel.id, None)
+            lock = self.locks.setdefault(channel.id, asyncio.Lock())
+            async with lock:
+                if channel.id not in self.buffers:
+                    await self._seed(channel)
+        else:
+            self.hits += 1
+        self.buffers.move_to_end(channel.id)
+        return self.peek(channel.id, limit)
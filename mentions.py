@@ -0,0 +1,50 @@
+import re
+
+INBOUND_PATTERN = re.compile(r"<@!?(\d+)>")
+
+
+class MentionTranslator():
+    # built once per request: rewrites <@id> -> <@name> in history going to the model, and
+    # <@name> -> <@id>, no-ping users and @everyone/@here on the way back, one regex pass each
+    def __init__(self, user_names, bot_name=None, bot_mention=None, no_ping_users=None):
+        self.names = {name: str(id) for name, id in user_names.items()} # name -> id
+        self.ids = {str(id): name for name, id in user_names.items()} # id -> name
+        self.bot_name = bot_name
+        self.bot_mention = bot_mention
+        self.no_ping = no_ping_users or {} # str(id) -> plain name, see GuildConfig.no_ping_users
+        names = list(self.names)
+        if bot_name and bot_name not in self.names:
+            names.append(bot_name)
+        # longest first so a name that is a prefix of another never wins the alternation
+        names.sort(key=len, reverse=True)
+        name_pattern = r"<@(" + "|".join(re.escape(name) for name in names) + r")>|" if names else ""
+        self.outbound_pattern = re.compile(name_pattern + r"<@(\d+)>|@(everyone|here)")
+        self.has_names = bool(names)
+
+    def _inbound(self, match):
+        name = self.ids.get(match.group(1))
+        return f"<@{name}>" if name is not None else match.group(0)
+
+    def to_names(self, text):
+        return INBOUND_PATTERN.sub(self._inbound, text)
+
+    def _mention(self, id):
+        if id in self.no_ping:
+            return self.no_ping[id]
+        return f"<@{id}>"
+
+    def _outbound(self, match):
+        if self.has_names:
+            name, id, mass = match.group(1), match.group(2), match.group(3)
+        else:
+            name, id, mass = None, match.group(1), match.group(2)
+        if mass:
+            return f"@ {mass}"
+        if name is not None:
+            if name == self.bot_name:
+                return self.bot_mention
+            return self._mention(self.names[name])
+        return self._mention(id)
+
+    def to_mentions(self, text):
+        return self.outbound_pattern.sub(self._outbound, text)
@@ -0,0 +1,232 @@
+import asyncio
+import logging
+from bisect import bisect_left
+
+# counters, gauges and histograms served in prometheus text format on a local port.
+# recording only bumps numbers in slots allocated the first time a label set is seen;
+# all formatting happens when the endpoint is scraped. hot callers can keep the child
+# returned by labels() to skip even the dict lookup.
+# generation workers send snapshot() to the gateway with each health check; load() keeps the
+# latest one per worker, and counters and histograms are rendered as this process's plus theirs
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Value():
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def state(self):
+        return self.value
+
+    def add(self, state):
+        self.value += state
+
+
+class _Buckets():
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # the last slot is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def state(self):
+        return [list(self.counts), self.sum, self.count]
+
+    def add(self, state):
+        counts, total, count = state
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.sum += total
+        self.count += count
+
+
+class _Metric():
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.sources = {} # worker -> {label values: state}, from load()
+        REGISTRY.append(self)
+
+    def _new_child(self):
+        return _Value()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._new_child()
+        return child
+
+    def combined(self):
+        # this process's children, plus the last snapshot of every worker that sent one
+        if not self.sources:
+            return self.children
+        combined = {}
+        for values, child in self.children.items():
+            combined[values] = self._new_child()
+            combined[values].add(child.state())
+        for states in self.sources.values():
+            for values, state in states.items():
+                if values not in combined:
+                    combined[values] = self._new_child()
+                combined[values].add(state)
+        return combined
+
+    def samples(self):
+        return [(values, child.value) for values, child in self.combined().items()]
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        for values, value in self.samples():
+            lines.append(f"{self.name}{_labels(self.label_names, values)} {value}")
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        # collect() -> iterable of (label values, value), read at scrape time instead of set()
+        self.collect = collect
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def samples(self):
+        if self.collect is not None:
+            return list(self.collect())
+        return super().samples()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        for values, child in list(self.combined().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), child.counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, values)} {child.sum}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, values)} {child.count}")
+
+
+PROVIDER_LATENCY = Histogram("discord_ai_provider_latency_seconds", "Successful provider calls, start to last token.", ("provider", "model"))
+PROVIDER_FIRST_CHUNK = Histogram("discord_ai_provider_first_chunk_seconds", "Time to the first streamed chunk.", ("provider", "model"))
+PROVIDER_FAILURES = Counter("discord_ai_provider_failures_total", "Failed provider call attempts.", ("provider", "model"))
+PROVIDER_TOKENS = Counter("discord_ai_provider_tokens_total", "Tokens reported by the provider.", ("provider", "model", "direction"))
+MESSAGE_LATENCY = Histogram("discord_ai_message_latency_seconds", "From a message being queued to its reply being sent.")
+DISCORD_REST = Histogram("discord_ai_discord_rest_seconds", "Discord REST calls made by the bot.", ("operation",))
+DATABASE_FLUSH = Histogram("discord_ai_database_flush_seconds", "Database writes to disk.", ("engine",))
+DATABASE_FLUSH_BYTES = Histogram("discord_ai_database_flush_bytes", "Size of each json database flush.", buckets=(1e3, 1e4, 1e5, 1e6, 1e7, 1e8))
+QUEUE_DEPTH = Gauge("discord_ai_channel_queue_depth", "Messages waiting for a channel's next turn.", ("channel",))
+LOOP_LAG = Histogram("discord_ai_event_loop_lag_seconds", "How late the event loop wakes up a sleeping task.", buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+
+
+def snapshot():
+    # {name: [[label values, state]]} of every counter and histogram, plain lists so it pickles small
+    return {
+        metric.name: [[list(values), child.state()] for values, child in metric.children.items()]
+        for metric in REGISTRY
+        if metric.kind != "gauge" and metric.children
+    }
+
+
+def load(source, snapshot):
+    # replaces what source sent last time; a restarted worker is a new source, so its
+    # predecessor's counts stay in the totals
+    metrics = {metric.name: metric for metric in REGISTRY}
+    for name, children in snapshot.items():
+        if name in metrics:
+            metrics[name].sources[source] = {tuple(values): state for values, state in children}
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        metric.render(lines)
+    return "\n".join(lines) + "\n"
+
+
+async def watch_loop_lag(interval=0.5):
+    loop = asyncio.get_running_loop()
+    child = LOOP_LAG.labels()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        child.observe(max(0.0, loop.time() - started - interval))
+
+
+async def _handle(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)).strip():
+            pass # headers
+        parts = request.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/metrics", "/"):
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except Exception as e:
+        logging.debug(f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+
+async def serve(port, host="127.0.0.1"):
+    server = await asyncio.start_server(_handle, host, port)
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
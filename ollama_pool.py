@@ -0,0 +1,227 @@
+import asyncio
+import collections
+import logging
+import time
+
+# keeps ollama models loaded ahead of the messages that need them, configured by "ollamaWarmPool" in models.json.
+# the configured models are loaded at startup, models with recent guild traffic have their keep_alive
+# refreshed so the server does not drop them, and when resident models go over maxResidentMb the
+# idle ones are unloaded, least recently used first. everything goes through the provider's AsyncClient.
+# with several shard processes only process "0" manages the models; the others publish the traffic they
+# see to the shared state every interval, and process 0 counts it in with its own
+
+
+def _tagged(name):
+    # the server lists "llama3:latest" for "llama3"
+    return name if ":" in name else f"{name}:latest"
+
+
+class ModelState():
+    def __init__(self, name):
+        self.name = name
+        self.resident = False
+        self.size = 0
+        self.size_vram = 0
+        self.expires_at = None
+        self.requests = collections.deque() # timestamps inside the traffic window
+        self.guilds = {} # guild_id -> last request
+        self.last_used = None
+        # what the other shard processes last published
+        self.remote_requests = 0
+        self.remote_guilds = 0
+        self.remote_last_used = None
+        self.loads = 0
+        self.unloads = 0
+        self.load_seconds = None
+        self.unload_seconds = None
+
+
+class OllamaWarmPool():
+    def __init__(self, config, get_client):
+        self.enabled = config.get("enabled", False)
+        self.preload = config.get("preload") # None preloads every ollama model in "providers"
+        self.interval = config.get("interval", 60)
+        self.window = config.get("windowSeconds", 900)
+        self.hot_requests = config.get("hotRequests", 5)
+        self.hot_keep_alive = config.get("hotKeepAlive", "30m")
+        self.idle_seconds = config.get("idleSeconds", 600)
+        self.max_resident = config.get("maxResidentMb", 0) * 1024 * 1024
+        self.get_client = get_client
+        self.models = {} # tagged name -> ModelState
+        self.task = None
+        self.shared_state = None
+        self.process = "0"
+
+    def _state(self, model):
+        name = _tagged(model)
+        if name not in self.models:
+            self.models[name] = ModelState(name)
+        return self.models[name]
+
+    def touch(self, model, guild_id=None):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        state = self._state(model)
+        state.requests.append(now)
+        state.last_used = now
+        if guild_id is not None:
+            state.guilds[guild_id] = now
+
+    def _trim(self, state, now):
+        cutoff = now - self.window
+        while state.requests and state.requests[0] < cutoff:
+            state.requests.popleft()
+        state.guilds = {guild_id: at for guild_id, at in state.guilds.items() if at >= cutoff}
+
+    def is_hot(self, state):
+        return len(state.requests) + state.remote_requests >= self.hot_requests
+
+    def _last_used(self, state):
+        return max((at for at in (state.last_used, state.remote_last_used) if at is not None), default=None)
+
+    def _idle(self, state, now):
+        last_used = self._last_used(state)
+        return last_used is None or now - last_used >= self.idle_seconds
+
+    def _traffic(self):
+        # this process's own traffic, with last_used on the wall clock so other processes can read it
+        now, wall = time.monotonic(), time.time()
+        rows = []
+        for state in self.models.values():
+            self._trim(state, now)
+            if state.last_used is not None:
+                rows.append((state.name, len(state.requests), len(state.guilds), wall - (now - state.last_used)))
+        return rows
+
+    async def read_traffic(self):
+        # what the other processes published; a process that missed a few intervals is not counted
+        if self.shared_state is None:
+            return
+        now, wall = time.monotonic(), time.time()
+        rows = await self.shared_state.model_traffic(wall - 3 * self.interval)
+        for state in self.models.values():
+            state.remote_requests, state.remote_guilds, state.remote_last_used = 0, 0, None
+        for model, process, requests, guilds, last_used in rows:
+            if process == self.process:
+                continue
+            state = self._state(model)
+            state.remote_requests += requests
+            state.remote_guilds += guilds
+            last_used = now - (wall - last_used)
+            state.remote_last_used = max(state.remote_last_used or last_used, last_used)
+
+    async def load(self, model, keep_alive=None):
+        # an empty prompt only loads the model; on a resident model it just moves keep_alive
+        state = self._state(model)
+        started = time.monotonic()
+        res = await self.get_client().generate(model=state.name, prompt="", keep_alive=keep_alive or self.hot_keep_alive)
+        if not state.resident:
+            # the server's own load time, not the request around it
+            load_duration = res.get("load_duration")
+            state.load_seconds = load_duration / 1e9 if load_duration else time.monotonic() - started
+            state.loads += 1
+            state.resident = True
+            logging.info(f"Loaded ollama model {state.name} in {state.load_seconds:.2f}s")
+
+    async def unload(self, model):
+        state = self._state(model)
+        started = time.monotonic()
+        await self.get_client().generate(model=state.name, prompt="", keep_alive=0)
+        state.unload_seconds = time.monotonic() - started
+        state.unloads += 1
+        state.resident = False
+        logging.info(f"Unloaded ollama model {state.name} in {state.unload_seconds:.2f}s")
+
+    async def refresh(self):
+        # -> bytes held by every model the server has loaded, ours or not
+        running = {entry["name"]: entry for entry in (await self.get_client().ps())["models"]}
+        for state in self.models.values():
+            entry = running.get(state.name)
+            state.resident = entry is not None
+            state.size = entry.get("size", 0) if entry else 0
+            state.size_vram = entry.get("size_vram", 0) if entry else 0
+            state.expires_at = entry.get("expires_at") if entry else None
+        return sum(entry.get("size", 0) for entry in running.values())
+
+    async def tick(self):
+        await self.read_traffic()
+        now = time.monotonic()
+        resident = await self.refresh()
+        for state in list(self.models.values()):
+            self._trim(state, now)
+            if self.is_hot(state):
+                await self.load(state.name)
+        if not self.max_resident or resident <= self.max_resident:
+            return
+        # memory pressure: idle models go first, the longest unused before the rest
+        idle = sorted((state for state in self.models.values() if state.resident and not self.is_hot(state) and self._idle(state, now)), key=lambda state: self._last_used(state) or 0)
+        for state in idle:
+            if resident <= self.max_resident:
+                break
+            resident -= state.size
+            await self.unload(state.name)
+        if resident > self.max_resident:
+            logging.warning(f"Ollama models still use {resident // 1024 // 1024}MB, over maxResidentMb, but none of ours are idle")
+
+    async def _run(self, models):
+        for model in self.preload if self.preload is not None else models:
+            try:
+                await self.load(model)
+            except Exception as e:
+                logging.error(f"Could not preload ollama model {model}: {e}")
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick()
+            except Exception as e:
+                logging.error(f"Ollama warm pool check failed: {e}")
+
+    async def _publish(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.shared_state.publish_traffic(self.process, self._traffic())
+            except Exception as e:
+                logging.error(f"Could not publish ollama traffic: {e}")
+
+    def start(self, models, shared_state=None, process="0"):
+        # models: the ollama models from models.json; only starts once. process "0" runs the pool,
+        # any other process publishes its traffic to shared_state for it
+        if not self.enabled or self.task is not None:
+            return
+        self.shared_state = shared_state
+        self.process = process
+        for model in models:
+            self._state(model)
+        if process == "0":
+            self.task = asyncio.create_task(self._run(models))
+        elif shared_state is not None:
+            self.task = asyncio.create_task(self._publish())
+
+    def stats(self):
+        now = time.monotonic()
+        stats = []
+        for state in self.models.values():
+            self._trim(state, now)
+            last_used = self._last_used(state)
+            stats.append({
+                "model": state.name,
+                "resident": state.resident,
+                "size_mb": state.size // 1024 // 1024,
+                "vram_mb": state.size_vram // 1024 // 1024,
+                "expires_at": state.expires_at,
+                "hot": self.is_hot(state),
+                "requests": len(state.requests) + state.remote_requests,
+                "guilds": len(state.guilds) + state.remote_guilds,
+                "idle": now - last_used if last_used is not None else None,
+                "loads": state.loads,
+                "unloads": state.unloads,
+                "load_seconds": state.load_seconds,
+                "unload_seconds": state.unload_seconds,
+            })
+        return stats
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
@@ -0,0 +1,82 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import time
+from asyncio import to_thread
+
+from tokens import estimate_tokens
+
+# provider-side prompt caching, configured by "promptCaching" in models.json.
+# every prompt respond builds starts with one system message that only changes when the guild's
+# settings do (its system prompt and the fixed instructions); everything after it changes per turn.
+# that leading message is what anthropic marks with cache_control and what gemini uploads as cached content
+
+
+def split_prefix(history):
+    # -> (stable prefix, rest)
+    if history and history[0].get("role") == "system":
+        return history[:1], history[1:]
+    return [], history
+
+
+def prefix_key(prefix):
+    return hashlib.sha256("\n".join(message["content"] for message in prefix).encode()).hexdigest()
+
+
+class GoogleContextCache():
+    # gemini context caching: one CachedContent per distinct stable prefix, kept for ttl seconds.
+    # gemini refuses to cache prompts under a model-specific minimum, so shorter prefixes are sent as usual
+    def __init__(self, config):
+        self.enabled = config.get("enabled", False)
+        self.model = config.get("model", "models/gemini-1.5-flash-001")
+        self.ttl = config.get("ttl", 3600)
+        self.min_tokens = config.get("minTokens", 32768)
+        self.max_entries = config.get("maxEntries", 50)
+        self.entries = {} # prefix key -> (GenerativeModel bound to the cached content or None, cached content, expires at)
+        self.lock = asyncio.Lock()
+        self.created = 0
+
+    def eligible(self, prefix):
+        return self.enabled and prefix and estimate_tokens(prefix[0]["content"], "google") >= self.min_tokens
+
+    async def model_for(self, prefix):
+        # -> GenerativeModel that already holds the prefix, or None to send the whole prompt
+        key = prefix_key(prefix)
+        entry = self.entries.get(key)
+        if entry is None or entry[2] < time.monotonic():
+            async with self.lock:
+                entry = self.entries.get(key)
+                if entry is None or entry[2] < time.monotonic():
+                    entry = self.entries[key] = await self._create(prefix[0]["content"])
+                    await self._evict()
+        return entry[0]
+
+    async def _create(self, system_instruction):
+        import google.generativeai as genai
+        from google.generativeai import caching
+        # refresh a minute before the server drops it
+        expires = time.monotonic() + max(60, self.ttl - 60)
+        try:
+            cached = await to_thread(caching.CachedContent.create, model=self.model, system_instruction=system_instruction, ttl=datetime.timedelta(seconds=self.ttl))
+        except Exception as e:
+            # usually a prefix under the model's minimum, do not try again until it would have expired
+            logging.warning(f"Could not create gemini context cache: {e}")
+            return None, None, expires
+        self.created += 1
+        return genai.GenerativeModel.from_cached_content(cached), cached, expires
+
+    async def _evict(self):
+        if len(self.entries) <= self.max_entries:
+            return
+        oldest = sorted(self.entries, key=lambda key: self.entries[key][2])[:len(self.entries) - self.max_entries]
+        for key in oldest:
+            _, cached, _ = self.entries.pop(key)
+            if cached is not None:
+                try:
+                    await to_thread(cached.delete)
+                except Exception as e:
+                    logging.warning(f"Could not delete gemini context cache: {e}")
+
+    def stats(self):
+        return {"entries": sum(1 for model, _, _ in self.entries.values() if model is not None), "created": self.created}
@@ -0,0 +1,111 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from asyncio import to_thread
+
+from resilience import ProviderError
+
+# record-and-replay backend for the "replay" provider, configured by "replay" in models.json.
+# a capture is one json line per call in <directory>/<capture>.jsonl:
+# {"key", "request": [[role, content], ...], "text", "chunks": [[delay_ms, text], ...] | null, "usage", "latency_ms"}
+# in record mode a capture wraps a real "provider|model" and appends every call it makes;
+# in replay mode calls are answered from the file, matched on the exact request, otherwise in file order
+
+
+def request_key(history):
+    request = [[message.get("role"), message.get("content")] for message in history]
+    return hashlib.sha256(json.dumps(request).encode()).hexdigest()[:32], request
+
+
+class Capture():
+    def __init__(self, name, path, mode="replay", target=None, pacing=False):
+        self.name = name
+        self.path = path
+        self.recording = mode == "record"
+        self.target = tuple(target.split("|", 1)) if target else None
+        self.pacing = pacing
+        self.entries = []
+        self.by_key = {} # key -> indexes into entries, served in order and then repeated
+        self.key_cursors = {}
+        self.cursor = 0
+        self.loaded = False
+        self.lock = asyncio.Lock()
+        if self.recording and not self.target:
+            raise ValueError(f"Capture {name} records but has no target provider|model")
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.by_key.setdefault(entry["key"], []).append(len(self.entries))
+                    self.entries.append(entry)
+        self.loaded = True
+        logging.info(f"Loaded {len(self.entries)} recorded calls from {self.path}")
+
+    async def _next(self, history):
+        if not self.loaded:
+            async with self.lock:
+                if not self.loaded:
+                    await to_thread(self._load)
+        if not self.entries:
+            raise ProviderError(f"Capture {self.name} is empty")
+        key, _ = request_key(history)
+        indexes = self.by_key.get(key)
+        if indexes:
+            position = self.key_cursors.get(key, 0)
+            self.key_cursors[key] = position + 1
+            return self.entries[indexes[position % len(indexes)]]
+        logging.debug(f"No recording of this request in {self.name}, replaying in order")
+        entry = self.entries[self.cursor % len(self.entries)]
+        self.cursor += 1
+        return entry
+
+    async def replay(self, history, usage_dict):
+        entry = await self._next(history)
+        if self.pacing:
+            await asyncio.sleep(entry["latency_ms"] / 1000)
+        usage_dict.update(entry["usage"])
+        return entry["text"]
+
+    async def replay_stream(self, history, usage_dict):
+        entry = await self._next(history)
+        for delay_ms, text in entry["chunks"] or [[entry["latency_ms"], entry["text"]]]:
+            if self.pacing:
+                await asyncio.sleep(delay_ms / 1000)
+            yield text
+        usage_dict.update(entry["usage"])
+
+    def _append(self, line):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(line)
+
+    async def record(self, history, text, usage, latency, chunks=None):
+        key, request = request_key(history)
+        entry = {"key": key, "request": request, "text": text, "chunks": chunks, "usage": dict(usage), "latency_ms": int(latency * 1000)}
+        async with self.lock:
+            await to_thread(self._append, json.dumps(entry, separators=(",", ":")) + "\n")
+
+
+class ReplayBackend():
+    def __init__(self, config):
+        self.directory = config.get("directory", "captures")
+        self.pacing = config.get("pacing", False)
+        self.config = config.get("captures", {})
+        self.captures = {}
+
+    def capture(self, name):
+        capture = self.captures.get(name)
+        if capture is None:
+            options = self.config.get(name, {})
+            capture = self.captures[name] = Capture(
+                name,
+                os.path.join(self.directory, f"{name}.jsonl"),
+                options.get("mode", "replay"),
+                options.get("target"),
+                options.get("pacing", self.pacing),
+            )
+        return capture
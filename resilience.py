@@ -0,0 +1,122 @@
+import asyncio
+import random
+import time
+
+# retries, circuit breakers and failover for provider calls, configured by "resilience" in models.json
+DEFAULT_RESILIENCE = {
+    "retries": 2,
+    "baseDelay": 0.5,
+    "maxDelay": 8,
+    "failureThreshold": 5,
+    "resetTimeout": 30,
+}
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+# exception class names across the sdks that mean "try again", so none of them has to be imported
+RETRYABLE_NAMES = {
+    "APIConnectionError", "APITimeoutError", "InternalServerError", "RateLimitError", "OverloadedError", # openai / anthropic
+    "ConnectError", "ReadError", "ReadTimeout", "ConnectTimeout", "RemoteProtocolError", "PoolTimeout", # httpx
+    "ServiceUnavailable", "TooManyRequests", "DeadlineExceeded", "ResourceExhausted", # google.api_core
+}
+# the request itself was refused (too long, malformed, filtered, not allowed): the provider is fine
+CLIENT_ERROR_NAMES = {
+    "BadRequestError", "AuthenticationError", "PermissionDeniedError", "NotFoundError", "UnprocessableEntityError", # openai / anthropic
+    "InvalidArgument", "FailedPrecondition", "PermissionDenied", "NotFound", "Unauthenticated", # google.api_core
+    "BlockedPromptException", "StopCandidateException", # google.generativeai
+}
+
+
+class ProviderError(Exception):
+    pass
+
+
+def is_retryable(error):
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, "status_code", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS
+    return any(cls.__name__ in RETRYABLE_NAMES for cls in type(error).__mro__)
+
+
+def is_provider_fault(error):
+    # what a circuit breaker counts: timeouts, connection errors, 429 and 5xx
+    if is_retryable(error):
+        return True
+    status = getattr(error, "status_code", None)
+    return isinstance(status, int) and status >= 500
+
+
+def is_client_error(error):
+    # another model would refuse the same request, so it is not retried or failed over
+    status = getattr(error, "status_code", None)
+    if isinstance(status, int):
+        return 400 <= status < 500 and status not in RETRYABLE_STATUS
+    return any(cls.__name__ in CLIENT_ERROR_NAMES for cls in type(error).__mro__)
+
+
+def retry_delay(attempt, base, cap):
+    # full jitter: anywhere between 0 and the exponential backoff
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker():
+    # closed -> open after failure_threshold consecutive failures; open -> half open after
+    # reset_timeout, where one trial call decides whether it closes again. a trial that never
+    # reports back is given up after another reset_timeout, so the breaker cannot stay wedged
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.trial_started = None
+        self.total_failures = 0
+        self.total_successes = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and (not self.trial_running or time.monotonic() - self.trial_started >= self.reset_timeout):
+            self.trial_running = True
+            self.trial_started = time.monotonic()
+            return True
+        return False
+
+    def abandon(self):
+        # the call was cancelled or its stream closed: no verdict either way, the trial slot is free again
+        self.trial_running = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.total_successes += 1
+
+    def record_failure(self):
+        self.failures += 1
+        self.total_failures += 1
+        if self.trial_running or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.trial_running = False
+
+    def stats(self):
+        remaining = None
+        if self.state == "open":
+            remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "total_failures": self.total_failures,
+            "total_successes": self.total_successes,
+            "reopens_in": remaining,
+        }
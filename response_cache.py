@@ -0,0 +1,51 @@
+import collections
+import hashlib
+import json
+import time
+
+
+class ResponseCache():
+    # LRU + TTL cache of finished responses, keyed on provider, model and the normalized prompt
+    def __init__(self, max_entries=1000, max_bytes=5_000_000, ttl=600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = collections.OrderedDict() # key -> (expires_at, text)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(provider, model, history):
+        # whitespace and case do not change the answer we want back
+        normalized = [(message.get("role"), " ".join(str(message.get("content", "")).lower().split())) for message in history]
+        digest = hashlib.sha256(json.dumps(normalized).encode()).hexdigest()
+        return f"{provider}|{model}|{digest}"
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, text):
+        if len(text) > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, text)
+        self.size += len(text)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        _, text = self.entries.pop(key)
+        self.size -= len(text)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.size}
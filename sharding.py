@@ -0,0 +1,104 @@
+# runs the bot's gateway shards split across several processes, restarting any that exit
+# python sharding.py --processes 4 [--shard-count 16]
+# every process runs bot.py with SHARD_IDS/SHARD_COUNT/SHARD_PROCESS set; they share the sqlite database
+import argparse
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+RESTART_DELAY = 5
+
+
+def parse_shard_ids(spec):
+    # "0-3" or "0,2,5" or "0-1,4" -> [0, 1, 2, 3]; None/"" -> None (let discord decide)
+    if not spec:
+        return None
+    ids = []
+    for part in spec.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            ids.extend(range(int(start), int(end) + 1))
+        else:
+            ids.append(int(part))
+    return ids
+
+
+def shard_ranges(shard_count, processes):
+    # contiguous, as even as possible: 10 shards over 3 processes -> 0-3, 4-6, 7-9
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for index in range(processes):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(range(start, end))
+        start = end
+    return ranges
+
+
+def recommended_shard_count(token):
+    import httpx
+    response = httpx.get("https://discord.com/api/v10/gateway/bot", headers={"Authorization": f"Bot {token}"}, timeout=10)
+    response.raise_for_status()
+    return response.json()["shards"]
+
+
+def _spawn(index, shards, shard_count, debug=False):
+    env = {
+        **os.environ,
+        "SHARD_IDS": f"{shards[0]}-{shards[-1]}",
+        "SHARD_COUNT": str(shard_count),
+        "SHARD_PROCESS": str(index),
+    }
+    logging.info(f"Starting process {index} with shards {shards[0]}-{shards[-1]} of {shard_count}")
+    return subprocess.Popen([sys.executable, "bot.py"] + (["--debug"] if debug else []), env=env)
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--shard-count", type=int, help="defaults to what discord recommends for the bot")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+
+    with open("botconfig.json") as f:
+        engine = json.load(f).get("databaseEngine", "json")
+    if args.processes > 1 and engine != "sqlite":
+        sys.exit("Separate shard processes share state through sqlite, set databaseEngine to \"sqlite\" in botconfig.json")
+
+    shard_count = args.shard_count or recommended_shard_count(os.getenv("TOKEN"))
+    ranges = shard_ranges(shard_count, args.processes)
+    children = {index: _spawn(index, shards, shard_count, args.debug) for index, shards in enumerate(ranges)}
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for child in children.values():
+            child.send_signal(signal.SIGINT) # bot.run closes cleanly and the database is flushed
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while not stopping:
+        time.sleep(1)
+        for index, child in list(children.items()):
+            if child.poll() is not None and not stopping:
+                logging.warning(f"Shard process {index} exited with {child.returncode}, restarting in {RESTART_DELAY}s")
+                time.sleep(RESTART_DELAY)
+                if stopping:
+                    break # stop() ran during the delay, a new child would never be signalled
+                children[index] = _spawn(index, ranges[index], shard_count, args.debug)
+    for child in children.values():
+        child.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import logging
+import sqlite3
+import threading
+import time
+from asyncio import to_thread
+
+# what every shard process needs to see of the others: which guilds each one is connected to, and the
+# ollama traffic it sees (for the warm pool, which only runs in process 0).
+# guild settings and usage are shared through the sqlite database itself; LocalSharedState is the
+# in-process stand-in used with a single process (and the json database)
+
+
+class LocalSharedState():
+    local = True
+
+    def __init__(self):
+        self.rows = {} # guild_id -> (name, shard_id, process, updated_at)
+        self.traffic = {} # (model, process) -> (requests, guilds, last_used, updated_at)
+
+    async def publish_guilds(self, process, guilds):
+        # replaces everything this process published before, guilds: [(guild_id, name, shard_id)]
+        self.rows = {guild_id: row for guild_id, row in self.rows.items() if row[2] != process}
+        now = time.time()
+        for guild_id, name, shard_id in guilds:
+            self.rows[str(guild_id)] = (name, shard_id, process, now)
+
+    async def add_guild(self, process, guild_id, name, shard_id):
+        self.rows[str(guild_id)] = (name, shard_id, process, time.time())
+
+    async def remove_guild(self, guild_id):
+        self.rows.pop(str(guild_id), None)
+
+    async def guilds(self):
+        # [(guild_id, name, shard_id, process)] across every process, ordered by shard
+        return sorted(((guild_id, *row[:3]) for guild_id, row in self.rows.items()), key=lambda row: (row[2], row[1] or ""))
+
+    async def publish_traffic(self, process, models):
+        # replaces this process's ollama traffic, models: [(model, requests, guilds, last_used as time.time())]
+        self.traffic = {key: row for key, row in self.traffic.items() if key[1] != process}
+        now = time.time()
+        for model, requests, guilds, last_used in models:
+            self.traffic[(model, process)] = (requests, guilds, last_used, now)
+
+    async def model_traffic(self, since):
+        # [(model, process, requests, guilds, last_used)] published at or after since
+        return [(model, process, *row[:3]) for (model, process), row in self.traffic.items() if row[3] >= since]
+
+    def close(self):
+        pass
+
+
+SHARED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shard_guilds (
+    guild_id TEXT PRIMARY KEY,
+    name TEXT,
+    shard_id INTEGER,
+    process TEXT,
+    updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS shard_guilds_process ON shard_guilds (process);
+CREATE TABLE IF NOT EXISTS model_traffic (
+    model TEXT,
+    process TEXT,
+    requests INTEGER,
+    guilds INTEGER,
+    last_used REAL,
+    updated_at REAL,
+    PRIMARY KEY (model, process)
+);
+"""
+
+
+class SQLiteSharedState(LocalSharedState):
+    local = False
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SHARED_SCHEMA)
+
+    def _run(self, statements):
+        # [(query, params or list of params)] in one transaction
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                for query, params in statements:
+                    if isinstance(params, list):
+                        self.connection.executemany(query, params)
+                    else:
+                        self.connection.execute(query, params)
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def _query(self, query, params=()):
+        with self.lock:
+            return self.connection.execute(query, params).fetchall()
+
+    async def publish_guilds(self, process, guilds):
+        now = time.time()
+        await to_thread(self._run, [
+            ("DELETE FROM shard_guilds WHERE process = ?", (process,)),
+            ("INSERT OR REPLACE INTO shard_guilds (guild_id, name, shard_id, process, updated_at) VALUES (?, ?, ?, ?, ?)",
+             [(str(guild_id), name, shard_id, process, now) for guild_id, name, shard_id in guilds]),
+        ])
+        logging.info(f"Published {len(guilds)} guilds for shard process {process}")
+
+    async def add_guild(self, process, guild_id, name, shard_id):
+        await to_thread(self._run, [("INSERT OR REPLACE INTO shard_guilds (guild_id, name, shard_id, process, updated_at) VALUES (?, ?, ?, ?, ?)", (str(guild_id), name, shard_id, process, time.time()))])
+
+    async def remove_guild(self, guild_id):
+        await to_thread(self._run, [("DELETE FROM shard_guilds WHERE guild_id = ?", (str(guild_id),))])
+
+    async def guilds(self):
+        return await to_thread(self._query, "SELECT guild_id, name, shard_id, process FROM shard_guilds ORDER BY shard_id, name")
+
+    async def publish_traffic(self, process, models):
+        now = time.time()
+        await to_thread(self._run, [
+            ("DELETE FROM model_traffic WHERE process = ?", (process,)),
+            ("INSERT INTO model_traffic (model, process, requests, guilds, last_used, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+             [(model, process, requests, guilds, last_used, now) for model, requests, guilds, last_used in models]),
+        ])
+
+    async def model_traffic(self, since):
+        return await to_thread(self._query, "SELECT model, process, requests, guilds, last_used FROM model_traffic WHERE updated_at >= ?", (since,))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def open_shared_state(engine="json", path=None):
+    # processes can only share what is on disk, so the sqlite engine is what makes multi-process work
+    if engine == "sqlite":
+        return SQLiteSharedState(path or "data.db")
+    return LocalSharedState()
@@ -0,0 +1,56 @@
+import logging
+import time
+
+import nextcord
+
+from chunker import chunk_message
+from metrics import DISCORD_REST
+
+
+class StreamingReply():
+    # posts the reply as soon as the first tokens arrive, then edits it in place
+    # no more often than edit_interval (discord allows roughly 5 edits per 5s per channel),
+    # rolling over to a new message when the text passes the 2000 character limit
+    def __init__(self, message: nextcord.Message, transform=None, edit_interval=1.2, mention_author=True):
+        self.message = message
+        self.transform = transform or (lambda text: text)
+        self.edit_interval = edit_interval
+        self.mention_author = mention_author
+        self.text = ""
+        self.sent = [] # (discord message, content) pairs, in order
+        self.last_sync = 0
+
+    async def feed(self, chunk):
+        self.text += chunk
+        if time.monotonic() - self.last_sync >= self.edit_interval:
+            await self.sync()
+
+    async def finish(self):
+        await self.sync()
+
+    async def _post(self, content):
+        started = time.perf_counter()
+        if not self.sent:
+            try:
+                sent = await self.message.reply(content, mention_author=self.mention_author)
+                DISCORD_REST.labels("send").observe(time.perf_counter() - started)
+                return sent
+            except Exception as e:
+                logging.error(f"Error sending message: {e}")
+        sent = await self.message.channel.send(content)
+        DISCORD_REST.labels("send").observe(time.perf_counter() - started)
+        return sent
+
+    async def sync(self):
+        self.last_sync = time.monotonic()
+        pieces = chunk_message(self.transform(self.text))
+        for i, piece in enumerate(pieces):
+            if i < len(self.sent):
+                sent_message, sent_content = self.sent[i]
+                if sent_content != piece:
+                    started = time.perf_counter()
+                    await sent_message.edit(content=piece)
+                    DISCORD_REST.labels("edit").observe(time.perf_counter() - started)
+                    self.sent[i] = (sent_message, piece)
+            else:
+                self.sent.append((await self._post(piece), piece))
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import time
+
+from admission import AdmissionRejected
+from ai import ERROR_TEXT
+from tokens import estimate_tokens
+
+# rolling per-channel summaries, configured by "summaries" in models.json.
+# messages that have scrolled out of the live window are folded into a bounded summary by a cheap model
+# in the background, and respond puts that summary next to the system prompt, so a long conversation
+# costs about the same per turn as a short one. summaries live in the guild's data:
+# "summaries": {channel_id: {"text", "through": id of the newest message folded in}}
+# a "-- BREAK --" starts the summary over. folds are charged to the guild like replies: admitted against
+# its limits up front and reconciled with the real usage after
+
+BREAK = "-- BREAK --"
+
+
+class Summarizer():
+    def __init__(self, chat_provider, database, channel_history, config, record_usage=None, admission=None):
+        self.chat_provider = chat_provider
+        self.database = database
+        self.channel_history = channel_history
+        self.enabled = config.get("enabled", False)
+        self.provider, self.model = config.get("model", "google|gemini-1.5-flash").split("|", 1)
+        self.max_words = config.get("maxWords", 150)
+        self.min_messages = config.get("minMessages", 4)
+        self.record_usage = record_usage
+        self.admission = admission
+        self.tasks = {} # channel id -> running fold
+        self.epochs = {} # channel id -> bumped by every reset, so a fold that started before one is dropped
+        self.folds = 0
+
+    def current(self, config, channel_id):
+        return (config.summaries.get(str(channel_id)) or {}).get("text") or None
+
+    async def reset(self, config, guild_id, channel_id):
+        self.epochs[channel_id] = self.epochs.get(channel_id, 0) + 1
+        if str(channel_id) not in config.summaries:
+            return
+        # read and written in one step, so folds of other channels in the guild are kept
+        await self.database.update_guild_property(guild_id, "summaries", lambda summaries: {key: value for key, value in (summaries or {}).items() if key != str(channel_id)})
+
+    def schedule(self, guild_id, channel, oldest_live_id, ignored_users=(), token_limit=None, bypass_limits=False):
+        # at most one fold per channel at a time, the next turn picks up whatever it missed
+        if not self.enabled or channel.id in self.tasks:
+            return
+        task = asyncio.create_task(self._fold(guild_id, channel, oldest_live_id, ignored_users, token_limit, bypass_limits))
+        self.tasks[channel.id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(channel.id, None))
+
+    async def _fold(self, guild_id, channel, oldest_live_id, ignored_users, token_limit=None, bypass_limits=False):
+        try:
+            epoch = self.epochs.get(channel.id, 0)
+            stored = (await self.database.get_config(guild_id)).summaries.get(str(channel.id)) or {}
+            text, through = stored.get("text", ""), stored.get("through", 0)
+            buffered = await self.channel_history.get(channel, self.channel_history.size)
+            # oldest first, only what is newer than the summary and older than the live window
+            older = [message for message in reversed(buffered) if through < message.id < oldest_live_id]
+            breaks = [i for i, message in enumerate(older) if message.content == BREAK]
+            if breaks:
+                through = older[breaks[-1]].id
+                older = older[breaks[-1] + 1:]
+                text = ""
+            elif len(older) < self.min_messages:
+                return
+            lines = [f"{message.author.display_name}: {message.content}" for message in older if message.author.id not in ignored_users]
+            if lines:
+                reservation = None
+                if self.admission is not None:
+                    # the previous summary and the new lines in, about two tokens per word out
+                    estimate = estimate_tokens(text + "\n".join(lines), self.provider) + self.max_words * 2
+                    try:
+                        reservation = self.admission.admit(guild_id, self.provider, self.model, estimate, token_limit, bypass_limits)
+                    except AdmissionRejected as e:
+                        logging.info(f"Skipped summarizing channel {channel.id}: {e}")
+                        return
+                usage = {}
+                started = time.monotonic()
+                try:
+                    usage, summary = await self.chat_provider.summarize(text, lines, self.provider, self.model, self.max_words)
+                finally:
+                    if reservation is not None:
+                        reservation.reconcile(usage.get("input", 0) + usage.get("output", 0))
+                if self.record_usage:
+                    await self.record_usage(guild_id, usage, self.provider, self.model, time.monotonic() - started)
+                if summary == ERROR_TEXT or not summary.strip():
+                    return
+                # the model does not always keep to max_words
+                text = summary.strip()[:self.max_words * 10]
+                through = older[-1].id
+            if self.epochs.get(channel.id, 0) != epoch:
+                return
+
+            def store(summaries):
+                # a reset that got in first wins
+                if self.epochs.get(channel.id, 0) != epoch:
+                    return summaries
+                return {**(summaries or {}), str(channel.id): {"text": text, "through": through}}
+            await self.database.update_guild_property(guild_id, "summaries", store)
+            self.folds += 1
+        except Exception as e:
+            logging.error(f"Error summarizing channel {channel.id}: {e}")
@@ -0,0 +1,33 @@
+import asyncio
+from types import SimpleNamespace
+
+from channel_queue import ChannelQueue
+
+
+def message(message_id):
+    return SimpleNamespace(id=message_id, channel=SimpleNamespace(id=1))
+
+
+def test_out_of_order_submits_answer_the_newest_message():
+    answered = []
+    release = None
+
+    async def handler(message):
+        answered.append(message.id)
+        if message.id == 1:
+            await release.wait()
+
+    async def run():
+        nonlocal release
+        release = asyncio.Event()
+        queue = ChannelQueue(handler)
+        queue.submit(message(1))
+        await asyncio.sleep(0)
+        # 3 overtook 2 while both were being looked up
+        queue.submit(message(3))
+        queue.submit(message(2))
+        release.set()
+        while 1 in queue:
+            await asyncio.sleep(0)
+    asyncio.run(run())
+    assert answered == [1, 3]
@@ -0,0 +1,83 @@
+import random
+
+import pytest
+
+from chunker import FENCE, MESSAGE_LIMIT, chunk_message, split_message
+
+# property tests on seeded random markdown: long words and lines, code blocks with and without
+# language tags, inline ```x``` lines, blank and whitespace-only lines, \r\n endings
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "`tick`", "x" * 300, "y" * 2500]
+CASES = 300
+
+
+def random_markdown(rng, size):
+    lines = []
+    length = 0
+    in_fence = False
+    while length < size:
+        roll = rng.random()
+        if roll < 0.06:
+            line = FENCE if in_fence else FENCE + rng.choice(["", "python", "js"])
+            in_fence = not in_fence
+        elif roll < 0.08:
+            line = "```inline```"
+        elif roll < 0.14:
+            line = rng.choice(["", "   ", "\t"])
+        else:
+            line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 60)))
+        lines.append(line)
+        length += len(line) + 1
+    newline = "\r\n" if rng.random() < 0.2 else "\n"
+    return newline.join(lines) + rng.choice(["", newline, newline * 3])
+
+
+def is_fence(line):
+    stripped = line.strip()
+    return stripped.startswith(FENCE) and stripped.count(FENCE) % 2 == 1 and len(stripped) <= 100
+
+
+def cases():
+    rng = random.Random(20261018)
+    for _ in range(CASES):
+        yield rng.choice([200, 500, MESSAGE_LIMIT]), random_markdown(rng, rng.randint(0, 12000))
+
+
+@pytest.mark.parametrize("limit,text", list(cases()))
+def test_chunks_fit_and_are_not_empty(limit, text):
+    for chunk in chunk_message(text, limit):
+        assert chunk.strip()
+        assert len(chunk) <= limit
+
+
+@pytest.mark.parametrize("limit,text", list(cases()))
+def test_fences_balanced_per_chunk(limit, text):
+    for chunk in chunk_message(text, limit):
+        assert sum(1 for line in chunk.splitlines() if is_fence(line)) % 2 == 0
+
+
+@pytest.mark.parametrize("limit,text", list(cases()))
+def test_rejoining_without_reopened_fences_gives_back_text(limit, text):
+    pieces = split_message(text, limit)
+    chunks = chunk_message(text, limit)
+    sent = [(head, body, tail) for head, body, tail in pieces if (head + body + tail).strip()]
+    assert len(chunks) == len(sent)
+    rebuilt = []
+    for chunk, (head, body, tail) in zip(chunks, sent):
+        assert chunk.startswith(head) and chunk.endswith(tail)
+        rebuilt.append(chunk[len(head):len(chunk) - len(tail)])
+    # only whitespace is ever left out, where a piece had nothing else to send
+    assert "".join(rebuilt) == "".join(body for head, body, tail in pieces if (head + body + tail).strip())
+    assert all(not body.strip() for head, body, tail in pieces if not (head + body + tail).strip())
+    assert "".join(body for _, body, _ in pieces) == text
+
+
+def test_split_code_block_is_reopened_with_its_language():
+    text = "```python\n" + "print(1)\n" * 400 + "```\n"
+    chunks = chunk_message(text)
+    assert len(chunks) > 1
+    assert all(chunk.startswith("```python\n") and chunk.rstrip().endswith(FENCE) for chunk in chunks)
+
+
+@pytest.mark.parametrize("text", ["", " ", "\n\n", " \t \n  "])
+def test_whitespace_only_text_has_no_chunks(text):
+    assert chunk_message(text) == []
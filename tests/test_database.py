@@ -0,0 +1,48 @@
+import asyncio
+import sqlite3
+
+from database import SQLiteBotDatabase
+
+
+def test_watch_changes_drops_only_guilds_whose_settings_changed(tmp_path):
+    path = str(tmp_path / "data.db")
+    here, other = SQLiteBotDatabase(path), SQLiteBotDatabase(path)
+
+    async def run():
+        for guild_id in ("1", "2", "3"):
+            await other.set_guild_property(guild_id, "model", "openai|gpt-4o-mini")
+            await here.get_config(guild_id)
+        watch = asyncio.create_task(here.watch_changes(interval=0.01))
+        await asyncio.sleep(0.05)
+        await other.set_guild_property("1", "system", "Be brief.")
+        await other.add_usage("2", 50)
+        await asyncio.sleep(0.05)
+        watch.cancel()
+        assert set(here.configs) == {"2", "3"}
+        assert (await here.get_config("1")).system == "Be brief."
+        await other.reset_daily_usage()
+        watch = asyncio.create_task(here.watch_changes(interval=0.01))
+        await asyncio.sleep(0.01)
+        await other.set_guild_property("3", "tts", True)
+        await asyncio.sleep(0.05)
+        watch.cancel()
+        assert "3" not in here.configs
+    asyncio.run(run())
+    here.close()
+    other.close()
+
+
+def test_files_without_the_changed_column_are_migrated(tmp_path):
+    path = str(tmp_path / "data.db")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE guilds (guild_id TEXT PRIMARY KEY, channel_id INTEGER, usage_today INTEGER, usage_total INTEGER, bypass_limits INTEGER, tts INTEGER, see_bots INTEGER, data TEXT NOT NULL DEFAULT '{}')")
+    connection.execute("INSERT INTO guilds (guild_id, channel_id, data) VALUES ('1', 5, '{\"model\": \"openai|gpt-4o\"}')")
+    connection.commit()
+    connection.close()
+    database = SQLiteBotDatabase(path)
+    guild = asyncio.run(database.get_guild("1"))
+    assert guild["channel_id"] == 5 and guild["model"] == "openai|gpt-4o"
+    assert database._last_change() == 0
+    asyncio.run(database.set_guild_property("1", "system", "hi"))
+    assert database._last_change() == 1
+    database.close()
@@ -0,0 +1,22 @@
+import metrics
+
+
+def test_worker_snapshots_add_to_this_process():
+    counter = metrics.Counter("test_worker_calls_total", "Calls.", ("model",))
+    histogram = metrics.Histogram("test_worker_seconds", "Latency.", ("model",), buckets=(1,))
+    try:
+        counter.labels("a").inc(2)
+        histogram.labels("a").observe(0.5)
+        worker = {name: children for name, children in metrics.snapshot().items() if name.startswith("test_worker")}
+        metrics.load(100, worker)
+        # a later snapshot from the same worker replaces its earlier one
+        metrics.load(100, worker)
+        counter.labels("b").inc()
+        text = metrics.render()
+        assert 'test_worker_calls_total{model="a"} 4' in text
+        assert 'test_worker_calls_total{model="b"} 1' in text
+        assert 'test_worker_seconds_bucket{model="a",le="1"} 2' in text
+        assert 'test_worker_seconds_count{model="a"} 2' in text
+    finally:
+        metrics.REGISTRY.remove(counter)
+        metrics.REGISTRY.remove(histogram)
@@ -0,0 +1,48 @@
+import asyncio
+
+from ollama_pool import OllamaWarmPool
+from shared_state import SQLiteSharedState
+
+CONFIG = {"enabled": True, "interval": 1, "windowSeconds": 60, "hotRequests": 3}
+
+
+class Client():
+    def __init__(self):
+        self.loaded = []
+
+    async def generate(self, model, prompt, keep_alive):
+        self.loaded.append(model)
+        return {"load_duration": 1e9}
+
+    async def ps(self):
+        return {"models": []}
+
+
+def test_traffic_from_other_processes_makes_a_model_hot(tmp_path):
+    shared_state = SQLiteSharedState(str(tmp_path / "data.db"))
+    client = Client()
+    manager, shard = OllamaWarmPool(CONFIG, lambda: client), OllamaWarmPool(CONFIG, lambda: client)
+    manager.shared_state, shard.shared_state, shard.process = shared_state, shared_state, "1"
+    for guild_id in (1, 2, 3):
+        shard.touch("llama3", guild_id)
+
+    async def run():
+        await shared_state.publish_traffic("1", shard._traffic())
+        await manager.tick()
+    asyncio.run(run())
+    assert client.loaded == ["llama3:latest"]
+    stats = manager.stats()[0]
+    assert stats["hot"] and stats["requests"] == 3 and stats["guilds"] == 3
+    assert stats["idle"] < 5
+    shared_state.close()
+
+
+def test_only_requests_inside_the_window_count():
+    pool = OllamaWarmPool(CONFIG, None)
+    for _ in range(5):
+        pool.touch("llama3")
+    state = pool.models["llama3:latest"]
+    state.requests[0] -= 120
+    state.requests[1] -= 120
+    pool._trim(state, state.requests[-1])
+    assert len(state.requests) == 3 and pool.is_hot(state)
@@ -0,0 +1,181 @@
+import asyncio
+import time
+
+import pytest
+
+from resilience import CircuitBreaker
+
+
+def half_open(breaker):
+    breaker.opened_at = time.monotonic() - breaker.reset_timeout
+    return breaker
+
+
+def test_opens_after_threshold_and_lets_one_trial_through():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+    half_open(breaker)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_abandoned_trial_frees_the_slot():
+    breaker = half_open(CircuitBreaker(reset_timeout=30))
+    assert breaker.allow()
+    breaker.abandon()
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+
+
+def test_trial_that_never_reports_back_expires():
+    breaker = half_open(CircuitBreaker(reset_timeout=30))
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.trial_started -= 30
+    assert breaker.allow()
+
+
+# the failover loop itself; ai needs the provider transport (httpx) to import
+def chat_provider(monkeypatch):
+    pytest.importorskip("httpx")
+    import ai
+    from transport import transport_config
+    monkeypatch.setattr(ai, "FALLBACKS", {})
+    monkeypatch.setitem(ai.TRANSPORT, "stub", transport_config({}, "stub"))
+    chat = ai.ChatProvider("stub", "slow")
+    half_open(chat.breaker("stub", "slow"))
+    return chat
+
+
+def test_cancelled_generate_gives_back_half_open_trial(monkeypatch):
+    chat = chat_provider(monkeypatch)
+
+    async def hang(history, model, usage_dict):
+        await asyncio.Event().wait()
+    chat._generate_stub = hang
+
+    async def run():
+        task = asyncio.create_task(chat._generate_with_failover([], "stub", "slow", {}))
+        await asyncio.sleep(0.01)
+        assert chat.breaker("stub", "slow").trial_running
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    asyncio.run(run())
+    assert chat.breaker("stub", "slow").allow()
+
+
+def test_closed_stream_gives_back_half_open_trial(monkeypatch):
+    chat = chat_provider(monkeypatch)
+
+    async def stream(history, model, usage_dict):
+        yield "first"
+        await asyncio.Event().wait()
+    chat._stream_stub = stream
+
+    async def run():
+        chunks = chat._stream_with_failover([], "stub", "slow", {})
+        assert await chunks.__anext__() == "first"
+        assert chat.breaker("stub", "slow").trial_running
+        await chunks.aclose()
+    asyncio.run(run())
+    assert chat.breaker("stub", "slow").allow()
+
+
+def hedged(chat, monkeypatch):
+    from hedging import HedgeBudget
+    chat.hedge_budget = HedgeBudget(max_rate=1)
+    monkeypatch.setattr(chat, "_hedge_plan", lambda trackers, provider, model: (0.01, ("stub", "fast")))
+
+
+def test_cancelled_hedge_loser_gives_back_half_open_trial(monkeypatch):
+    chat = chat_provider(monkeypatch)
+    hedged(chat, monkeypatch)
+
+    async def generate(history, model, usage_dict):
+        if model == "slow":
+            await asyncio.Event().wait()
+        return "fast answer"
+    chat._generate_stub = generate
+
+    assert asyncio.run(chat._generate_hedged([], "stub", "slow", {})) == "fast answer"
+    assert chat.hedge_budget.wins == 1
+    assert chat.breaker("stub", "slow").allow()
+
+
+def test_closed_hedge_loser_stream_gives_back_half_open_trial(monkeypatch):
+    chat = chat_provider(monkeypatch)
+    hedged(chat, monkeypatch)
+
+    async def stream(history, model, usage_dict):
+        if model == "slow":
+            await asyncio.Event().wait()
+        yield "fast answer"
+    chat._stream_stub = stream
+
+    async def run():
+        return [chunk async for chunk in chat._stream_hedged([], "stub", "slow", {})]
+    assert asyncio.run(run()) == ["fast answer"]
+    assert chat.hedge_budget.wins == 1
+    assert chat.breaker("stub", "slow").allow()
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+@pytest.mark.parametrize("status,fault,client", [(400, False, True), (413, False, True), (429, True, False), (500, True, False), (501, True, False)])
+def test_only_provider_faults_count(status, fault, client):
+    from resilience import is_client_error, is_provider_fault
+    assert is_provider_fault(StatusError(status)) == fault
+    assert is_client_error(StatusError(status)) == client
+
+
+def test_refused_requests_do_not_open_the_breaker(monkeypatch):
+    chat = chat_provider(monkeypatch)
+    breaker = chat.breaker("stub", "slow")
+    breaker.opened_at = None
+    calls = []
+
+    async def refuse(history, model, usage_dict):
+        calls.append(model)
+        raise StatusError(400)
+    chat._generate_stub = refuse
+
+    async def run():
+        return [await chat.generate_text([], "stub", "slow", use_cache=False) for _ in range(breaker.failure_threshold + 1)]
+    import ai
+    assert asyncio.run(run()) == [ai.ERROR_TEXT] * (breaker.failure_threshold + 1)
+    # no retries either, and the breaker never saw them
+    assert len(calls) == breaker.failure_threshold + 1
+    assert breaker.state == "closed" and breaker.total_failures == 0
+
+
+def test_cancelling_the_caller_while_losers_drain_is_not_swallowed(monkeypatch):
+    chat = chat_provider(monkeypatch)
+    hedged(chat, monkeypatch)
+
+    async def generate(history, model, usage_dict):
+        if model == "slow":
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                await asyncio.sleep(0.2) # a loser that takes a while to wind down
+                raise
+        return "fast answer"
+    chat._generate_stub = generate
+
+    async def run():
+        task = asyncio.create_task(chat._generate_hedged([], "stub", "slow", {}))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    asyncio.run(run())
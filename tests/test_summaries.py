@@ -0,0 +1,80 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("httpx") # summaries imports ai
+from admission import AdmissionController
+from database import SQLiteBotDatabase
+from summaries import Summarizer
+
+
+class History():
+    def __init__(self, messages):
+        self.size = len(messages)
+        self.messages = messages # newest first
+
+    async def get(self, channel, limit):
+        return self.messages[:limit]
+
+
+class Provider():
+    def __init__(self):
+        self.calls = 0
+
+    async def summarize(self, previous, lines, provider, model, max_words):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return {"input": 100, "output": 20}, f"{len(lines)} lines"
+
+
+def messages(count):
+    author = SimpleNamespace(id=1, display_name="ann")
+    return [SimpleNamespace(id=index, content=f"message {index}", author=author) for index in range(count, 0, -1)]
+
+
+def summarizer(tmp_path, admission=None):
+    database = SQLiteBotDatabase(str(tmp_path / "data.db"))
+    config = {"enabled": True, "model": "openai|gpt-4o-mini", "minMessages": 2}
+    return Summarizer(Provider(), database, History(messages(10)), config, admission=admission)
+
+
+def test_folds_of_two_channels_in_one_guild_both_land(tmp_path):
+    folder = summarizer(tmp_path)
+
+    async def run():
+        await asyncio.gather(*(folder._fold("1", SimpleNamespace(id=channel_id), 8, ()) for channel_id in (10, 20)))
+        return await folder.database.get_config("1")
+    summaries = asyncio.run(run()).summaries
+    assert summaries == {"10": {"text": "7 lines", "through": 7}, "20": {"text": "7 lines", "through": 7}}
+    folder.database.close()
+
+
+def test_reset_during_a_fold_wins(tmp_path):
+    folder = summarizer(tmp_path)
+
+    async def run():
+        await folder.database.set_guild_property("1", "summaries", {"10": {"text": "old", "through": 1}})
+        fold = asyncio.create_task(folder._fold("1", SimpleNamespace(id=10), 8, ()))
+        await asyncio.sleep(0)
+        await folder.reset(await folder.database.get_config("1"), "1", 10)
+        await fold
+        return await folder.database.get_config("1")
+    assert asyncio.run(run()).summaries == {}
+    folder.database.close()
+
+
+def test_fold_is_admitted_and_reconciled(tmp_path):
+    admission = AdmissionController()
+    folder = summarizer(tmp_path, admission)
+    bucket = admission.guild_bucket("1", 10_000)
+    fold = folder._fold("1", SimpleNamespace(id=10), 8, (), 10_000)
+    bucket.take(10_000)
+    asyncio.run(fold)
+    assert folder.chat_provider.calls == 0 and admission.rejected["guild"] == 1
+    bucket.give(10_000)
+    asyncio.run(folder._fold("1", SimpleNamespace(id=10), 8, (), 10_000))
+    assert folder.chat_provider.calls == 1
+    # what was reserved has been swapped for the 120 tokens the fold used
+    assert 9_879 <= bucket.available() <= 9_881
+    folder.database.close()
@@ -0,0 +1,20 @@
+import asyncio
+
+from usage_ledger import UsageLedger
+
+
+def test_shared_rollup_covers_every_shard_process(tmp_path):
+    async def run():
+        first = UsageLedger(str(tmp_path), process=0)
+        second = UsageLedger(str(tmp_path), process=1)
+        first.record(1, "openai", "small", 10, 5, 0.2)
+        second.record(2, "openai", "small", 20, 5, 0.4)
+        await second.flush()
+        # first only knows its own record, the shared rollup reads second's file too
+        assert [values["requests"] for values in first.rollup().values()] == [1]
+        rollup = await first.shared_rollup()
+        first.close()
+        second.close()
+        return rollup
+    (values,) = asyncio.run(run()).values()
+    assert values["requests"] == 2 and values["input"] == 30 and values["latency_ms"] == 300
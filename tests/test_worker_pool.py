@@ -0,0 +1,25 @@
+import asyncio
+
+import pytest
+
+
+def test_worker_answers_health_checks_and_stops():
+    pytest.importorskip("httpx")
+    from worker_pool import GenerationPool
+    pool = GenerationPool("replay", "capture", size=1, health_interval=0.5)
+
+    async def run():
+        pool._start()
+        worker = pool.workers[0]
+        started = worker.last_pong
+        for _ in range(100):
+            await asyncio.sleep(0.1)
+            if worker.last_pong > started:
+                break
+        assert worker.last_pong > started and pool.workers[0] is worker
+        assert pool.stats()[0]["alive"]
+        # the pong carries the worker's provider state, nothing called yet
+        assert worker.provider_stats["breakers"] == {} and pool.hedge_stats()["requests"] == 0
+        pool.close()
+        assert worker.process.returncode == 0
+    asyncio.run(run())
@@ -0,0 +1,45 @@
+# token estimates for context packing. no provider ships a tokenizer we can run locally for
+# all four backends, so this is a characters-per-token heuristic per provider that is
+# calibrated against the prompt token counts the providers report back
+
+CHARS_PER_TOKEN = {
+    "openai": 4.0,
+    "anthropic": 3.5,
+    "google": 4.0,
+    "ollama": 3.7,
+}
+# role markers and separators each message costs on top of its text
+MESSAGE_OVERHEAD = 4
+
+# provider -> multiplier learned from reported usage, applied on top of the cached estimates
+CALIBRATION = {}
+
+
+def estimate_tokens(text, provider=None):
+    return int(len(text) / CHARS_PER_TOKEN.get(provider, 4.0)) + MESSAGE_OVERHEAD
+
+
+def calibrated(tokens, provider):
+    return int(tokens * CALIBRATION.get(provider, 1.0))
+
+
+def calibrate(provider, estimated, actual):
+    # exponential moving average of actual/estimated, clamped so one odd reply cannot swing it far
+    if not estimated or not actual:
+        return
+    ratio = min(max(actual / estimated, 0.5), 2.0)
+    CALIBRATION[provider] = CALIBRATION.get(provider, 1.0) * 0.9 + ratio * 0.1
+
+
+def pack_history(history, budget, estimate):
+    # history is newest first; keep the newest messages whose estimates fit in the budget.
+    # the newest message is always kept, even if it is over budget on its own
+    packed = []
+    used = 0
+    for message in history:
+        tokens = estimate(message)
+        if packed and used + tokens > budget:
+            break
+        packed.append(message)
+        used += tokens
+    return packed, used
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+
+import httpx
+
+# per-provider connection pool and timeout settings, overridden by "transport" in models.json
+DEFAULT_TRANSPORT = {
+    "maxConnections": 20,
+    "maxKeepalive": 10,
+    "keepaliveExpiry": 30,
+    "connectTimeout": 5,
+    "readTimeout": 60,
+    "totalTimeout": 120,
+}
+
+
+def transport_config(config, provider):
+    return {**DEFAULT_TRANSPORT, **config.get("default", {}), **config.get(provider, {})}
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    # the connection stays checked out until the response body is closed
+    def __init__(self, stream, on_close):
+        self.stream = stream
+        self.on_close = on_close
+        self.closed = False
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if not self.closed:
+                self.closed = True
+                self.on_close()
+
+
+class PooledTransport(httpx.AsyncBaseTransport):
+    # httpx transport with a bounded keep-alive pool that counts its own usage
+    def __init__(self, provider, config):
+        self.provider = provider
+        self.max_connections = config["maxConnections"]
+        self.transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(
+            max_connections=config["maxConnections"],
+            max_keepalive_connections=config["maxKeepalive"],
+            keepalive_expiry=config["keepaliveExpiry"],
+        ))
+        self.in_use = 0
+        self.requests = 0
+        self.waits = 0 # requests that arrived with every connection busy
+
+    def _release(self):
+        self.in_use -= 1
+
+    async def handle_async_request(self, request):
+        if self.in_use >= self.max_connections:
+            self.waits += 1
+        self.in_use += 1
+        self.requests += 1
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            self._release()
+            raise
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_TrackedStream(response.stream, self._release),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+    def stats(self):
+        # httpcore does not expose pool state publicly, so idle connections are best effort
+        connections = getattr(getattr(self.transport, "_pool", None), "connections", [])
+        idle = sum(1 for connection in connections if connection.is_idle())
+        return {
+            "in_use": self.in_use,
+            "idle": idle,
+            "waits": self.waits,
+            "requests": self.requests,
+            "max": self.max_connections,
+        }
+
+
+TRANSPORTS = {} # provider -> PooledTransport
+
+
+def pooled_transport(provider, config):
+    # one pool per provider, shared by everything talking to that provider
+    transport = TRANSPORTS.get(provider)
+    if transport is None:
+        transport = TRANSPORTS[provider] = PooledTransport(provider, config)
+    return transport
+
+
+def http_client(provider, config, **kwargs):
+    return httpx.AsyncClient(transport=pooled_transport(provider, config), timeout=http_timeout(config), **kwargs)
+
+
+def http_timeout(config):
+    return httpx.Timeout(config["readTimeout"], connect=config["connectTimeout"])
+
+
+def pool_stats():
+    return {provider: transport.stats() for provider, transport in TRANSPORTS.items()}
+
+
+async def with_deadline(stream, total_timeout):
+    # bound a whole async generator by one deadline, not just each read
+    deadline = time.monotonic() + total_timeout
+    iterator = stream.__aiter__()
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            try:
+                chunk = await asyncio.wait_for(iterator.__anext__(), remaining)
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        closer = getattr(iterator, "aclose", None)
+        if closer is not None:
+            try:
+                await closer()
+            except Exception as e:
+                logging.debug(f"Error closing stream: {e}")
@@ -0,0 +1,188 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import time
+from asyncio import to_thread
+
+# append-only record of every generation, one file per (utc) day with a json array per line
+# (one file per day and shard process when processes share the directory):
+# [timestamp, guild_id, provider, model, input, output, latency_ms, cached]
+# (cached: how many of the input tokens the provider served from its prompt cache, absent in older records)
+# running totals and hourly rollups live in memory, so reading usage never scans the records
+
+
+def _day(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y-%m-%d")
+
+
+class UsageLedger():
+    def __init__(self, directory="usage", flush_ms=2000, max_pending=100, retention_days=14, process=None):
+        self.directory = directory
+        self.suffix = f".{process}.jsonl" if process is not None else ".jsonl"
+        self.flush_ms = flush_ms
+        self.max_pending = max_pending
+        self.retention = retention_days * 86400
+        self.pending = []
+        self.today = 0
+        self.total = 0
+        self.guilds = {} # guild_id -> [today, total]
+        # (hour start, guild_id, "provider|model") -> [requests, input, output, latency_ms, cached]
+        self.hourly = {}
+        self.oldest_hour = None
+        self.seeded = False
+        self.flush_task = None
+        self.flush_lock = asyncio.Lock()
+        self.full_event = asyncio.Event()
+        self.load()
+
+    def load(self):
+        # rebuild the hourly rollups from the files still inside the retention window
+        if not os.path.isdir(self.directory):
+            return
+        cutoff = _day(time.time() - self.retention)
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".jsonl") or name[:10] < cutoff:
+                continue
+            with open(os.path.join(self.directory, name)) as f:
+                for line in f:
+                    try:
+                        self._roll(*json.loads(line))
+                    except (ValueError, TypeError):
+                        logging.warning(f"Skipping bad usage record in {name}")
+        self._prune(time.time())
+
+    def seed(self, guilds):
+        # running totals start from what the database already counted (usage predates the ledger)
+        if self.seeded:
+            return
+        self.seeded = True
+        for guild_id, guild in guilds.items():
+            usage = guild.get("usage") or {}
+            totals = self.guilds.setdefault(str(guild_id), [0, 0])
+            totals[0] += usage.get("today", 0)
+            totals[1] += usage.get("total", 0)
+            self.today += usage.get("today", 0)
+            self.total += usage.get("total", 0)
+
+    def _roll(self, timestamp, guild_id, provider, model, input, output, latency_ms, cached=0):
+        hour = int(timestamp // 3600 * 3600)
+        key = (hour, guild_id, f"{provider}|{model}")
+        bucket = self.hourly.get(key)
+        if bucket is None:
+            bucket = self.hourly[key] = [0, 0, 0, 0, 0]
+            if self.oldest_hour is None or hour < self.oldest_hour:
+                self.oldest_hour = hour
+        bucket[0] += 1
+        bucket[1] += input
+        bucket[2] += output
+        bucket[3] += latency_ms
+        bucket[4] += cached
+
+    def _prune(self, now):
+        cutoff = now - self.retention
+        if self.oldest_hour is None or self.oldest_hour >= cutoff:
+            return
+        self.hourly = {key: bucket for key, bucket in self.hourly.items() if key[0] >= cutoff}
+        self.oldest_hour = min((key[0] for key in self.hourly), default=None)
+
+    def record(self, guild_id, provider, model, input, output, latency, cached=0):
+        now = time.time()
+        entry = [round(now, 3), str(guild_id), provider, model, input, output, int(latency * 1000), cached]
+        self.pending.append(entry)
+        tokens = input + output
+        self.today += tokens
+        self.total += tokens
+        totals = self.guilds.setdefault(entry[1], [0, 0])
+        totals[0] += tokens
+        totals[1] += tokens
+        self._roll(*entry)
+        self._prune(now)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.write()
+            return
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_loop())
+        if len(self.pending) >= self.max_pending:
+            self.full_event.set()
+
+    def totals(self, guild_id=None):
+        if guild_id is None:
+            return {"today": self.today, "total": self.total}
+        today, total = self.guilds.get(str(guild_id), (0, 0))
+        return {"today": today, "total": total}
+
+    def reset_today(self):
+        self.today = 0
+        for totals in self.guilds.values():
+            totals[0] = 0
+
+    def rollup(self, bucket="hour", since=None, guild_id=None):
+        # {(bucket start, "provider|model"): {"requests", "input", "output", "latency_ms", "cached"}}, oldest first
+        size = 86400 if bucket == "day" else 3600
+        guild_id = str(guild_id) if guild_id is not None else None
+        rolled = {}
+        for (hour, key_guild, model), values in self.hourly.items():
+            if (since is not None and hour < since) or (guild_id is not None and key_guild != guild_id):
+                continue
+            totals = rolled.setdefault((hour // size * size, model), [0, 0, 0, 0, 0])
+            for i, value in enumerate(values):
+                totals[i] += value
+        return {
+            key: {"requests": requests, "input": input, "output": output, "latency_ms": latency_ms // requests, "cached": cached}
+            for key, (requests, input, output, latency_ms, cached) in sorted(rolled.items())
+        }
+
+    async def shared_rollup(self, bucket="hour", since=None, guild_id=None):
+        # the in-memory rollups only gain this process's records after startup, so when shard
+        # processes share the directory, read every process's files back instead
+        await self.flush()
+        return await to_thread(lambda: UsageLedger(self.directory, retention_days=self.retention // 86400).rollup(bucket, since, guild_id))
+
+    def _append(self, entries):
+        os.makedirs(self.directory, exist_ok=True)
+        by_day = {}
+        for entry in entries:
+            by_day.setdefault(_day(entry[0]), []).append(json.dumps(entry, separators=(",", ":")) + "\n")
+        for day, lines in by_day.items():
+            with open(os.path.join(self.directory, day + self.suffix), "a") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def write(self):
+        entries, self.pending = self.pending, []
+        if entries:
+            self._append(entries)
+
+    async def flush(self):
+        async with self.flush_lock:
+            entries, self.pending = self.pending, []
+            self.full_event.clear()
+            if not entries:
+                return
+            try:
+                await to_thread(self._append, entries)
+            except Exception as e:
+                logging.error(f"Error writing usage ledger: {e}")
+                self.pending = entries + self.pending
+                raise
+
+    async def _flush_loop(self):
+        while self.pending:
+            try:
+                await asyncio.wait_for(self.full_event.wait(), self.flush_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception:
+                await asyncio.sleep(self.flush_ms / 1000)
+
+    def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        self.write()
@@ -0,0 +1,310 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import subprocess
+import sys
+import time
+
+import metrics
+from ai import ERROR_TEXT, summary_history
+from resilience import ProviderError
+
+# generation off the gateway process: the bot prepares the prompt, a pool of local worker processes
+# runs ChatProvider and sends the reply (or its streamed chunks) back over a pipe.
+# GenerationPool has the same generate_text/generate_stream/summarize interface as ChatProvider
+#
+# gateway -> worker: {"kind": "text" | "stream" | "ping" | "cancel", "id", ...} or None to stop
+# worker -> gateway: {"id", "chunk"} while streaming, then {"id", "done", "text", "usage"} or {"id", "error"};
+# {"id", "pong", "stats"} answers a ping with the worker's breakers, hedges, response cache and metrics
+#
+# workers are started as `python worker_pool.py <pipe fd> <provider> <model>`, not with multiprocessing's
+# spawn, which would import the gateway's __main__ (bot.py: config, database, discord client) in every worker
+
+
+def _worker_main(conn, provider, model):
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_serve(conn, provider, model))
+
+
+async def _serve(conn, provider, model):
+    from ai import ChatProvider
+    chat_provider = ChatProvider(provider, model)
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+    tasks = {} # job id -> task
+
+    def send(message):
+        try:
+            conn.send(message)
+        except (BrokenPipeError, OSError):
+            if not stopped.done():
+                stopped.set_result(None)
+
+    async def run(job):
+        try:
+            if job["kind"] == "stream":
+                usage = {}
+                async for chunk in chat_provider.generate_stream(job["history"], job["provider"], job["model"], usage, job["use_cache"]):
+                    send({"id": job["id"], "chunk": chunk})
+                send({"id": job["id"], "done": True, "usage": usage})
+            else:
+                usage, text = await chat_provider.generate_text(job["history"], job["provider"], job["model"], usage=True, use_cache=job["use_cache"])
+                send({"id": job["id"], "done": True, "text": text, "usage": usage})
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            send({"id": job["id"], "error": repr(e)})
+        finally:
+            tasks.pop(job["id"], None)
+
+    def receive():
+        try:
+            while conn.poll():
+                job = conn.recv()
+                if job is None:
+                    stopped.set_result(None)
+                    return
+                if job["kind"] == "ping":
+                    send({"id": job["id"], "pong": len(tasks), "stats": _provider_stats(chat_provider)})
+                elif job["kind"] == "cancel":
+                    if job["id"] in tasks:
+                        tasks[job["id"]].cancel()
+                else:
+                    tasks[job["id"]] = loop.create_task(run(job))
+        except (EOFError, OSError):
+            # the gateway is gone
+            if not stopped.done():
+                stopped.set_result(None)
+
+    loop.add_reader(conn.fileno(), receive)
+    await stopped
+    loop.remove_reader(conn.fileno())
+    for task in tasks.values():
+        task.cancel()
+
+
+def _provider_stats(chat_provider):
+    return {
+        "breakers": {key: breaker.stats() for key, breaker in chat_provider.breakers.items()},
+        "hedges": chat_provider.hedge_budget.stats(),
+        "cache": chat_provider.cache.stats() if chat_provider.cache else None,
+        "metrics": metrics.snapshot(),
+    }
+
+
+class Worker():
+    def __init__(self, index, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.jobs = {} # job id -> asyncio.Queue of replies
+        self.started = time.monotonic()
+        self.last_pong = time.monotonic()
+        self.restarts = 0
+        self.provider_stats = None # from the last pong
+
+
+class GenerationPool():
+    def __init__(self, provider, model, size=2, job_timeout=120, health_interval=10, concurrency=8):
+        self.provider = provider
+        self.model = model
+        self.size = size
+        self.job_timeout = job_timeout
+        self.health_interval = health_interval
+        self.concurrency = concurrency
+        self.workers = []
+        self.ids = itertools.count()
+        self.slots = None
+        self.health_task = None
+        self.timeouts = 0
+
+    def _spawn(self, index):
+        parent, child = multiprocessing.Pipe()
+        process = subprocess.Popen([sys.executable, __file__, str(child.fileno()), self.provider or "", self.model or ""], pass_fds=(child.fileno(),))
+        child.close()
+        worker = Worker(index, process, parent)
+        asyncio.get_running_loop().add_reader(parent.fileno(), self._receive, worker)
+        logging.info(f"Started generation worker {index} (pid {process.pid})")
+        return worker
+
+    def _start(self):
+        # lazily, the pipes need the running loop
+        if self.workers:
+            return
+        self.slots = asyncio.Semaphore(self.size * self.concurrency)
+        self.workers = [self._spawn(index) for index in range(self.size)]
+        self.health_task = asyncio.create_task(self._watch())
+
+    def _receive(self, worker):
+        try:
+            while worker.conn.poll():
+                reply = worker.conn.recv()
+                if "pong" in reply:
+                    worker.last_pong = time.monotonic()
+                    worker.provider_stats = reply["stats"]
+                    metrics.load(worker.process.pid, reply["stats"]["metrics"])
+                    continue
+                queue = worker.jobs.get(reply["id"])
+                if queue is not None:
+                    queue.put_nowait(reply)
+        except (EOFError, OSError):
+            self._restart(worker, "exited")
+
+    def _restart(self, worker, reason):
+        if worker not in self.workers:
+            return
+        logging.warning(f"Generation worker {worker.index} {reason}, restarting")
+        asyncio.get_running_loop().remove_reader(worker.conn.fileno())
+        worker.conn.close()
+        if worker.process.poll() is None:
+            worker.process.kill()
+        for queue in worker.jobs.values():
+            queue.put_nowait({"error": f"worker {reason}"})
+        replacement = self._spawn(worker.index)
+        replacement.restarts = worker.restarts + 1
+        self.workers[self.workers.index(worker)] = replacement
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            for worker in list(self.workers):
+                if worker.process.poll() is not None:
+                    self._restart(worker, "died")
+                elif time.monotonic() - worker.last_pong > 3 * self.health_interval:
+                    self._restart(worker, "stopped answering health checks")
+                else:
+                    self._send(worker, {"kind": "ping", "id": next(self.ids)})
+
+    def _send(self, worker, message):
+        try:
+            worker.conn.send(message)
+        except (BrokenPipeError, OSError):
+            self._restart(worker, "closed its pipe")
+
+    async def _submit(self, kind, history, provider, model, use_cache):
+        # -> (worker, job id, queue); the least busy worker gets the job
+        self._start()
+        await self.slots.acquire()
+        worker = min(self.workers, key=lambda worker: len(worker.jobs))
+        job_id = next(self.ids)
+        queue = asyncio.Queue()
+        worker.jobs[job_id] = queue
+        self._send(worker, {"kind": kind, "id": job_id, "history": history, "provider": provider, "model": model, "use_cache": use_cache})
+        return worker, job_id, queue
+
+    def _finish(self, worker, job_id, cancel):
+        worker.jobs.pop(job_id, None)
+        self.slots.release()
+        if cancel and worker in self.workers:
+            self._send(worker, {"kind": "cancel", "id": job_id})
+
+    def _resolve(self, override_provider, override_model):
+        return override_provider or self.provider, override_model or self.model
+
+    async def generate_text(self, history, override_provider=None, override_model=None, usage=False, use_cache=True):
+        provider, model = self._resolve(override_provider, override_model)
+        worker, job_id, queue = await self._submit("text", history, provider, model, use_cache)
+        usage_dict, text, finished = {"input": 0, "output": 0}, ERROR_TEXT, False
+        try:
+            reply = await asyncio.wait_for(queue.get(), self.job_timeout)
+            finished = True
+            if "error" in reply:
+                logging.error(f"Generation worker {worker.index} failed: {reply['error']}")
+            else:
+                usage_dict, text = reply["usage"], reply["text"]
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logging.error(f"Generation job {job_id} timed out after {self.job_timeout}s")
+        finally:
+            self._finish(worker, job_id, not finished)
+        if usage:
+            return usage_dict, text
+        return text
+
+    async def generate_stream(self, history, override_provider=None, override_model=None, usage_dict=None, use_cache=True):
+        provider, model = self._resolve(override_provider, override_model)
+        if usage_dict is None:
+            usage_dict = {}
+        usage_dict.update({"input": 0, "output": 0})
+        worker, job_id, queue = await self._submit("stream", history, provider, model, use_cache)
+        deadline = time.monotonic() + self.job_timeout
+        finished = False
+        try:
+            while True:
+                try:
+                    reply = await asyncio.wait_for(queue.get(), max(0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    raise ProviderError(f"Generation job {job_id} timed out after {self.job_timeout}s")
+                if "error" in reply:
+                    finished = True
+                    raise ProviderError(reply["error"])
+                if "chunk" in reply:
+                    yield reply["chunk"]
+                    continue
+                finished = True
+                usage_dict.update(reply["usage"])
+                return
+        finally:
+            self._finish(worker, job_id, not finished)
+
+    async def summarize(self, previous, lines, provider, model, max_words=150):
+        return await self.generate_text(summary_history(previous, lines, max_words), provider, model, usage=True, use_cache=False)
+
+    def breakers(self):
+        # "worker N provider|model" -> breaker stats, as of each worker's last health check
+        return {
+            f"worker {worker.index} {key}": stats
+            for worker in self.workers if worker.provider_stats
+            for key, stats in worker.provider_stats["breakers"].items()
+        }
+
+    def hedge_stats(self):
+        totals = {"requests": 0, "hedges": 0, "wins": 0}
+        for worker in self.workers:
+            for key in totals:
+                totals[key] += worker.provider_stats["hedges"][key] if worker.provider_stats else 0
+        return totals
+
+    def cache_stats(self):
+        # None without a response cache, summed over the workers otherwise
+        caches = [worker.provider_stats["cache"] for worker in self.workers if worker.provider_stats and worker.provider_stats["cache"]]
+        if not caches:
+            return None
+        return {key: sum(cache[key] for cache in caches) for key in caches[0]}
+
+    def stats(self):
+        now = time.monotonic()
+        return [
+            {
+                "index": worker.index,
+                "pid": worker.process.pid,
+                "alive": worker.process.poll() is None,
+                "jobs": len(worker.jobs),
+                "restarts": worker.restarts,
+                "last_pong": now - worker.last_pong,
+            }
+            for worker in self.workers
+        ]
+
+    def close(self):
+        if self.health_task is not None:
+            self.health_task.cancel()
+        for worker in self.workers:
+            try:
+                worker.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self.workers:
+            try:
+                worker.process.wait(5)
+            except subprocess.TimeoutExpired:
+                worker.process.kill()
+        self.workers = []
+
+
+if __name__ == "__main__":
+    # a generation worker, see GenerationPool._spawn
+    from multiprocessing.connection import Connection
+    _worker_main(Connection(int(sys.argv[1])), sys.argv[2] or None, sys.argv[3] or None)